@@ -8,8 +8,12 @@ from requests_aws4auth import AWS4Auth
 from langchain.llms.bedrock import Bedrock
 from langchain.prompts import PromptTemplate
 from langchain_aws import BedrockEmbeddings
+from sentence_transformers import SentenceTransformer
 
 from inference.src.model_inference import ModelInference
+from data_processing.src.retrieval_backends import MANIFEST_FILE, RetrievalBackend, OpenSearchBackend, LocalVectorBackend
+from data_processing.src.vector_storage import get_live_index, load_index_projection
+from data_processing.src.config import EMBEDDING_MODEL_ID, BEDROCK_EMBEDDING_MODEL_ID
 
 
 INDEX_NAME = "vegan_papers_index"
@@ -36,6 +40,18 @@ AWS_REGION = os.environ.get("AWS_REGION")
 
 OPENSEARCH_ENDPOINT = os.environ.get("OPENSEARCH_ENDPOINT")
 
+# the embedding backend the index was built with: the queries have to be embedded with the same model,
+# EMBEDDING_MODEL_ID for "torch" and "onnx", BEDROCK_EMBEDDING_MODEL_ID for "bedrock"
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "torch")
+
+# "opensearch", or "local" to search a local index written by the data processing pipeline, in process
+RETRIEVAL_BACKEND = os.environ.get("RETRIEVAL_BACKEND", "opensearch")
+LOCAL_INDEX_DIR = os.environ.get("LOCAL_INDEX_DIR", "local_index")
+# candidates rescored exactly per result, for an index with compressed vectors; unset to not rescore OpenSearch hits
+RESCORE_OVERSAMPLE = float(os.environ.get("RESCORE_OVERSAMPLE", 0)) or None
+# how often the app looks up the index version the alias points to, to move to a rebuilt index
+INDEX_REFRESH_SECONDS = int(os.environ.get("INDEX_REFRESH_SECONDS", 60))
+
 bedrock_client = boto3.client(service_name="bedrock-runtime")
 
 PROMPT = PromptTemplate(
@@ -67,9 +83,18 @@ def get_llm(client, light_model=False):
     )
     return llm
 
+@st.cache_resource
+def get_query_embedding_model(model_id: str = EMBEDDING_MODEL_ID) -> SentenceTransformer:
+    """
+    Returns the embedding model the documents of the index were embedded with, loaded once per app process.
+    """
+    return SentenceTransformer(model_id)
+
+
 def embed_query(query_text, client):
     """
-    Embeds a query text into a vector using the Bedrock text embeddings service.
+    Embeds a query text into a vector with the model the documents of the index were embedded with,
+    see EMBEDDING_BACKEND. A reduced index projects the full query vector itself.
 
     Args:
         query_text (str): The text to embed.
@@ -78,73 +103,123 @@ def embed_query(query_text, client):
     Returns:
         list[float]: The embedded vector.
     """
-    bedrock_embeddings=BedrockEmbeddings(model_id="amazon.titan-embed-text-v1", client=client)
-    query_embedding = bedrock_embeddings.embed_query(query_text)
-    
-    # new error, seems to be a mismatch where 
-    # the query embedding is 1536 but size 384 is expected
-    # truncating the query embedding to 384 for now
-    return query_embedding[:384]
+    if EMBEDDING_BACKEND == "bedrock":
+        bedrock_embeddings = BedrockEmbeddings(model_id=BEDROCK_EMBEDDING_MODEL_ID, client=client)
+        return bedrock_embeddings.embed_query(query_text)
+    return get_query_embedding_model().encode(query_text).tolist()
 
 
-def similarity_search(
-    query_embedding: List[float], 
+@st.cache_resource
+def get_opensearch_client(AWS_ACCESS_KEY: str, AWS_SECRET_KEY: str, AWS_REGION: str, OPENSEARCH_ENDPOINT: str) -> OpenSearch:
+    """
+    Returns the OpenSearch client, created once per app process.
+    """
+    awsauth = AWS4Auth(AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_REGION, 'es')
+
+    return OpenSearch(
+        hosts=[{'host': OPENSEARCH_ENDPOINT, 'port': 443}],
+        http_auth=awsauth,
+        use_ssl=True,
+        verify_certs=True,
+        connection_class=RequestsHttpConnection
+    )
+
+
+@st.cache_data(ttl=INDEX_REFRESH_SECONDS)
+def get_index_version(index_name: str, AWS_ACCESS_KEY: str, AWS_SECRET_KEY: str, AWS_REGION: str, OPENSEARCH_ENDPOINT: str) -> str:
+    """
+    Returns the version of the index the alias points to, looked up at most once every INDEX_REFRESH_SECONDS.
+    """
+    client = get_opensearch_client(AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_REGION, OPENSEARCH_ENDPOINT)
+    return get_live_index(client, index_name)
+
+
+@st.cache_resource(max_entries=1)
+def get_opensearch_backend(index_version: str, AWS_ACCESS_KEY: str, AWS_SECRET_KEY: str, AWS_REGION: str, OPENSEARCH_ENDPOINT: str) -> OpenSearchBackend:
+    """
+    Returns the backend of a version of the index, searched by its name rather than the alias, so that its queries
+    are projected with its own projection even while a rebuild swaps the alias.
+    """
+    client = get_opensearch_client(AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_REGION, OPENSEARCH_ENDPOINT)
+    # the queries of an index of reduced embeddings are projected with the projection of the index version
+    return OpenSearchBackend(client, index_version, RESCORE_OVERSAMPLE, load_index_projection(client, index_version))
+
+
+@st.cache_resource(max_entries=1)
+def get_local_backend(directory: str, modified_time: float) -> LocalVectorBackend:
+    """
+    Returns the backend of the local index, loaded once per version of the index, see get_retrieval_backend.
+    """
+    return LocalVectorBackend(directory, rescore_oversample=RESCORE_OVERSAMPLE)
+
+
+def get_retrieval_backend(
     index_name: str, 
     AWS_ACCESS_KEY: str, 
     AWS_SECRET_KEY: str, 
     AWS_REGION: str, 
-    OPENSEARCH_ENDPOINT: str, 
-    top_k: int = 3
-) -> List[Dict[str, str]]:
+    OPENSEARCH_ENDPOINT: str
+) -> RetrievalBackend:
     """
-    Perform a similarity search in the OpenSearch index using the given query embedding.
+    Returns the backend to search in: the OpenSearch index, or the local index in LOCAL_INDEX_DIR
+    if RETRIEVAL_BACKEND is set to local. The backend is loaded once and shared by all the queries,
+    until the index is rebuilt.
 
     Parameters:
-        query_embedding (List[float]): The embedding vector of the query.
         index_name (str): The name of the OpenSearch index.
         AWS_ACCESS_KEY (str): The AWS access key ID.
         AWS_SECRET_KEY (str): The AWS secret access key.
         AWS_REGION (str): The AWS region.
         OPENSEARCH_ENDPOINT (str): The OpenSearch endpoint.
+
+    Returns:
+        RetrievalBackend: The backend.
+    """
+    if RETRIEVAL_BACKEND == "local":
+        # a rebuild replaces the directory of the index and its manifest, which reloads the backend
+        modified_time = os.path.getmtime(os.path.join(LOCAL_INDEX_DIR, MANIFEST_FILE))
+        return get_local_backend(LOCAL_INDEX_DIR, modified_time)
+
+    index_version = get_index_version(index_name, AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_REGION, OPENSEARCH_ENDPOINT)
+    return get_opensearch_backend(index_version, AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_REGION, OPENSEARCH_ENDPOINT)
+
+def similarity_search(
+    query_embedding: List[float], 
+    backend: RetrievalBackend, 
+    top_k: int = 3
+) -> List[Dict[str, str]]:
+    """
+    Perform a similarity search in the index using the given query embedding.
+
+    Parameters:
+        query_embedding (List[float]): The embedding vector of the query.
+        backend (RetrievalBackend): The backend to search in, see get_retrieval_backend.
         top_k (int, optional): The number of similar documents to return. Defaults to 3.
 
     Returns:
         List[Dict[str, str]]: A list of dictionaries containing the title, link, and text of the similar documents.
     """
-    awsauth = AWS4Auth(AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_REGION, 'es')
-
-    client = OpenSearch(
-        hosts=[{'host': OPENSEARCH_ENDPOINT, 'port': 443}],
-        http_auth=awsauth,
-        use_ssl=True,
-        verify_certs=True,
-        connection_class=RequestsHttpConnection
-    )
-    
-    search_body = {
-        "size": top_k,
-        "query": {
-            "knn": {
-                "embedding": {
-                    "vector": query_embedding,
-                    "k": top_k
-                }
-            }
-        },
-        "_source": ["text", "metadata"]
-    }
-
-    response = client.search(index=index_name, body=search_body)
+    # several small matching chunks can share the same parent chunk, so more hits are fetched than returned
+    results = backend.search(query_embedding, k=top_k * 4)
     
     hits = []
+    seen_texts = set()
     
-    for hit in response['hits']['hits']:
+    for result in results:
+        # the prompt gets the parent chunk of the matching chunk, when the index has one
+        text = result['parent_text'] or result['text']
+        if text in seen_texts:
+            continue
+        seen_texts.add(text)
+        metadata = result['metadata']
         hit_dct = {
-            'title': hit['_source']['metadata'].get('title', 'No Title'),
-            'link': hit['_source']['metadata']['url'][0].get('value', 'No Link'),
-            'text': hit['_source']['text']
+            'title': metadata.get('title', 'No Title'),
+            'link': metadata.get('url', [{}])[0].get('value', 'No Link'),
+            'text': text
         }
         hits.append(hit_dct)
+        if len(hits) == top_k:
+            break
         
     return hits
 
@@ -173,7 +248,8 @@ def main(index_name):
         with st.spinner("Generating Answer..."):
             query_embedding = embed_query(user_query, bedrock_client)
             
-            search_results = similarity_search(query_embedding, index_name, AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_REGION, OPENSEARCH_ENDPOINT)
+            backend = get_retrieval_backend(index_name, AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_REGION, OPENSEARCH_ENDPOINT)
+            search_results = similarity_search(query_embedding, backend)
 
             # Prepare contexts for the prompt
             contexts = ""
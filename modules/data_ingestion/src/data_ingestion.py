@@ -1,11 +1,17 @@
 import os
 import re
-import time
+import hashlib
+import threading
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import List, Optional
 from dotenv import load_dotenv, find_dotenv
 
-from .data_transformer import transform_paper_data
-from .s3_storage import upload_to_s3
+from .data_transformer import transform_paper_data_concurrently
+from .manifest import IngestionManifest
+from .rate_limiter import TokenBucket
+from .springer_api_client import ResponseCache, SpringerClient
+from .s3_storage import store_data, split_extension
 from ...utils.logger import setup_logger
 
 logger = setup_logger("data_ingestion", "data_ingestion.log")
@@ -19,7 +25,10 @@ def ingest_data(
     total_records: int,
     base_url: str = "http://api.springernature.com/openaccess/json",
     max_records: int = 25, 
-    file_name: str = "raw_pdf_data.json"
+    file_name: str = "raw_pdf_data.json",
+    requests_per_minute: int = 100,
+    max_workers: int = 8,
+    cache_dir: Optional[str] = None
 ) -> None:
     """
     Retrieves the meta data and full text content of papers that match the query from the Springer Nature API, 
@@ -28,50 +37,325 @@ def ingest_data(
     Args:
         query (str): Description of what kind of papers you want to collect.
         api_key (str): Springer Nature API Key. Note: there is a free version and a premium version.
-        bucket_name (str): The name of the S3 bucket.
+        bucket_name (str): The name of the S3 bucket. If empty, the data is saved to the local file system.
         total_records (int): The total number of records to collect.
         base_url (str, optional): The endpoint of the Springer Nature API to get meta data. 
             Defaults to "http://api.springernature.com/openaccess/json".
         max_records (int, optional): The max number of records you can query at a time. Defaults to 25.
             Will be set to 25 if input is higher (or lower than 1).
         file_name (str, optional): The name of the file object in the S3 bucket. Defaults to "raw_pdf_data.json".
+            Names ending in ".jsonl", ".jsonl.gz" or ".jsonl.zst" are streamed as (compressed) JSON Lines,
+            and names ending in ".parquet" are stored as one row per paper section in a Parquet file.
+        requests_per_minute (int, optional): The request quota of the API key. Defaults to 100, the free plan's limit.
+        max_workers (int, optional): The number of requests that can be in flight at once. Defaults to 8.
+        cache_dir (str, optional): A directory to cache API responses in, so re-runs are served from disk.
+            Defaults to None, which disables the cache.
     """
-    all_data = []
+    # Every page takes one request for the meta data plus one per paper for the full text,
+    # and all of them share one rate limiter, so the quota is the only thing we wait on.
+    rate_limiter = TokenBucket.from_quota(requests_per_minute)
+    records_per_minute = requests_per_minute * max_records // (max_records + 1)
 
-    logger.info(f"Starting ingestion with {total_records} records. Expect 1 minutes per 75 records.")
+    logger.info(f"Starting ingestion with {total_records} records. Expect 1 minute per {records_per_minute} records.")
     
-    for i in np.arange(1, total_records, max_records):
-        data_batch = transform_paper_data(query, api_key, base_url, i, max_records)
-        all_data.extend(data_batch)
-        
-        # The transform_paper_data function makes 26 requests, but the rate limit is 100 per minute.
-        # So we sleep for 20 seconds to limit to 3 functions calls per minute, thus avoiding rate limiting.
-        if total_records > 78:  # Avoid rate limiting
-            time.sleep(20)
+    cache = ResponseCache(cache_dir) if cache_dir else None
+    
+    with SpringerClient(api_key, rate_limiter=rate_limiter, pool_size=max_workers, cache=cache) as client:
+        all_data = transform_paper_data_concurrently(
+            client=client,
+            query=query,
+            starting_records=np.arange(1, total_records, max_records),
+            base_url=base_url,
+            max_records=max_records,
+            max_workers=max_workers
+        )
+        logger.info(f"Request stats: {client.stats.summary()}")
     
     logger.info("Data ingestion completed. Uploading to S3 bucket")
-    upload_to_s3(data=all_data, bucket_name=bucket_name, file_name=file_name)
+    store_data(data=all_data, bucket_name=bucket_name, file_name=file_name)
     logger.info("Data uploaded to S3 bucket")
 
 
+def ingest_data_incrementally(
+    query: str,
+    api_key: str,
+    bucket_name: str,
+    total_records: int,
+    base_url: str = "http://api.springernature.com/openaccess/json",
+    max_records: int = 25,
+    file_name: str = "raw_pdf_data.json",
+    requests_per_minute: int = 100,
+    max_workers: int = 8,
+    cache_dir: Optional[str] = None,
+    pages_per_batch: int = 4,
+    manifest_location: Optional[str] = None,
+    resume: bool = True
+) -> List[str]:
+    """
+    Checkpointed version of ingest_data. Papers are uploaded in batches as soon as they are collected,
+    and a manifest of the stored DOIs is saved after every batch. Papers already in the manifest are never
+    downloaded again, so a crashed run loses at most one batch and a refresh only costs the new papers.
+    Papers whose full text fails are left out of their batch and listed as failed in the manifest, and
+    a refresh tries them again.
+
+    Args:
+        query (str): Description of what kind of papers you want to collect.
+        api_key (str): Springer Nature API Key. Note: there is a free version and a premium version.
+        bucket_name (str): The name of the S3 bucket. If empty, the batches are saved to the local file system.
+        total_records (int): The total number of records to collect.
+        base_url (str, optional): The endpoint of the Springer Nature API to get meta data.
+            Defaults to "http://api.springernature.com/openaccess/json".
+        max_records (int, optional): The max number of records you can query at a time. Defaults to 25.
+        file_name (str, optional): The name the batches are stored under, e.g. "raw_pdf_data.json" stores them
+            as "raw_pdf_data/batch-00000.json". Defaults to "raw_pdf_data.json".
+        requests_per_minute (int, optional): The request quota of the API key. Defaults to 100, the free plan's limit.
+        max_workers (int, optional): The number of requests that can be in flight at once. Defaults to 8.
+        cache_dir (str, optional): A directory to cache API responses in, so re-runs are served from disk.
+            Defaults to None, which disables the cache.
+        pages_per_batch (int, optional): The number of result pages stored in each batch. Defaults to 4.
+        manifest_location (str, optional): The local path, or "s3://bucket/key", of the manifest.
+            Defaults to "manifest.json" next to the batches.
+        resume (bool, optional): Whether to continue from the last starting record of the manifest.
+            If False, the query is walked from the start again but stored papers are still skipped,
+            which is how the corpus is refreshed. Defaults to True.
+
+    Returns:
+        List[str]: The names of all batch objects listed in the manifest.
+    """
+    prefix, extension = split_extension(file_name)
+    if manifest_location is None:
+        manifest_location = f"s3://{bucket_name}/{prefix}/manifest.json" if bucket_name else f"{prefix}/manifest.json"
+    manifest = IngestionManifest.load(manifest_location)
+
+    first_record = manifest.next_starting_record if resume else 1
+    page_starts = list(np.arange(first_record, total_records, max_records))
+    rate_limiter = TokenBucket.from_quota(requests_per_minute)
+
+    logger.info(
+        f"Starting incremental ingestion from record {first_record} of {total_records}, "
+        f"skipping {len(manifest.dois)} stored papers."
+    )
+
+    cache = ResponseCache(cache_dir) if cache_dir else None
+
+    with SpringerClient(api_key, rate_limiter=rate_limiter, pool_size=max_workers, cache=cache) as client:
+        for i in range(0, len(page_starts), pages_per_batch):
+            batch_starts = page_starts[i:i + pages_per_batch]
+            failed_dois = set()
+            data_batch = transform_paper_data_concurrently(
+                client=client,
+                query=query,
+                starting_records=batch_starts,
+                base_url=base_url,
+                max_records=max_records,
+                max_workers=max_workers,
+                skip_dois=manifest,
+                failed_dois=failed_dois
+            )
+            next_starting_record = int(batch_starts[-1]) + max_records
+
+            if not data_batch:
+                logger.info(f"No new papers before record {next_starting_record}.")
+                manifest.add_batch(None, [], next_starting_record, failed_dois)
+                continue
+
+            # The manifest is only saved after the batch is stored, so a crash in between
+            # just means this batch is fetched again and its object overwritten.
+            batch_name = f"{prefix}/batch-{len(manifest.batches):05d}{extension}"
+            store_data(data=data_batch, bucket_name=bucket_name, file_name=batch_name)
+            manifest.add_batch(
+                batch_name,
+                [paper["meta_data"]["doi"] for paper in data_batch],
+                next_starting_record,
+                failed_dois
+            )
+            logger.info(f"Stored {len(data_batch)} new papers in {batch_name}, {len(failed_dois)} failed.")
+
+        logger.info(f"Request stats: {client.stats.summary()}")
+
+    logger.info(
+        f"Incremental ingestion completed, {len(manifest.dois)} papers stored in {len(manifest.batches)} batches, "
+        f"{len(manifest.failed_dois)} papers failed."
+    )
+    return manifest.batches
+
+
+def ingest_queries_sharded(
+    queries: List[str],
+    api_key: str,
+    bucket_name: str,
+    records_per_query: int,
+    base_url: str = "http://api.springernature.com/openaccess/json",
+    max_records: int = 25,
+    file_name: str = "multi_query_data.jsonl.gz",
+    requests_per_minute: int = 100,
+    num_workers: int = 4,
+    max_workers: int = 4,
+    cache_dir: Optional[str] = None,
+    pages_per_unit: int = 4,
+    num_shards: int = 4
+) -> List[str]:
+    """
+    Collects the papers of several topic queries at once. Every query is split into work units of a few
+    result pages, and a pool of workers runs the units of all queries together under one global rate limit,
+    so the total wall time depends on the API quota instead of the number of queries.
+    Papers found by more than one query are only fetched and stored once, and the merged papers are spread
+    over num_shards shards by the hash of their DOI. The papers of each work unit are stored as soon as it
+    completes, as one part per shard, and recorded in a manifest, so a failed unit costs only its own papers
+    and a re-run skips the papers already stored.
+
+    Args:
+        queries (List[str]): The queries to collect papers for, e.g. ["vegan protein", "vegan B12"].
+        api_key (str): Springer Nature API Key. Note: there is a free version and a premium version.
+        bucket_name (str): The name of the S3 bucket. If empty, the shards are saved to the local file system.
+        records_per_query (int): The number of records to collect for each query.
+        base_url (str, optional): The endpoint of the Springer Nature API to get meta data.
+            Defaults to "http://api.springernature.com/openaccess/json".
+        max_records (int, optional): The max number of records you can query at a time. Defaults to 25.
+        file_name (str, optional): The name the shards are stored under, e.g. "multi_query_data.jsonl.gz" stores
+            the parts of the first shard as "multi_query_data/shard-000-of-004/part-00000.jsonl.gz".
+            Defaults to "multi_query_data.jsonl.gz".
+        requests_per_minute (int, optional): The request quota of the API key. Defaults to 100, the free plan's limit.
+        num_workers (int, optional): The number of work units processed at once. Defaults to 4.
+        max_workers (int, optional): The number of requests in flight per work unit. Defaults to 4.
+        cache_dir (str, optional): A directory to cache API responses in, so re-runs are served from disk.
+            Defaults to None, which disables the cache.
+        pages_per_unit (int, optional): The number of result pages in each work unit. Defaults to 4.
+        num_shards (int, optional): The number of output objects. Defaults to 4.
+
+    Returns:
+        List[str]: The names of all parts listed in the manifest.
+    """
+    prefix, extension = split_extension(file_name)
+    page_starts = list(np.arange(1, records_per_query, max_records))
+    work_units = [
+        (query, page_starts[i:i + pages_per_unit])
+        for query in queries
+        for i in range(0, len(page_starts), pages_per_unit)
+    ]
+
+    seen_dois = set()
+    seen_lock = threading.Lock()
+
+    def claim_doi(doi: str) -> bool:
+        with seen_lock:
+            if doi in seen_dois:
+                return False
+            seen_dois.add(doi)
+            return True
+
+    manifest_location = f"s3://{bucket_name}/{prefix}/manifest.json" if bucket_name else f"{prefix}/manifest.json"
+    manifest = IngestionManifest.load(manifest_location)
+
+    rate_limiter = TokenBucket.from_quota(requests_per_minute)
+    cache = ResponseCache(cache_dir) if cache_dir else None
+    failed_units = []
+
+    logger.info(
+        f"Starting sharded ingestion of {len(queries)} queries in {len(work_units)} work units, "
+        f"skipping {len(manifest.dois)} stored papers."
+    )
+
+    with SpringerClient(
+        api_key, rate_limiter=rate_limiter, pool_size=num_workers * max_workers, cache=cache
+    ) as client, ThreadPoolExecutor(max_workers=num_workers) as executor:
+        unit_futures = {}
+        for query, starts in work_units:
+            failed_dois = set()
+            future = executor.submit(
+                transform_paper_data_concurrently,
+                client=client,
+                query=query,
+                starting_records=starts,
+                base_url=base_url,
+                max_records=max_records,
+                max_workers=max_workers,
+                skip_dois=manifest,
+                claim_doi=claim_doi,
+                failed_dois=failed_dois
+            )
+            unit_futures[future] = (query, starts, failed_dois)
+
+        # Units are stored from this thread as they complete, so the manifest is only written by one thread.
+        for future in as_completed(unit_futures):
+            query, starts, failed_dois = unit_futures[future]
+            try:
+                papers = future.result()
+            except Exception as e:
+                logger.error(f"Work unit of '{query}' from record {starts[0]} failed: {e!r}")
+                failed_units.append((query, starts[0]))
+                continue
+
+            parts = {}
+            for paper in papers:
+                shard_index = int(hashlib.sha1(paper["meta_data"]["doi"].encode("utf-8")).hexdigest(), 16) % num_shards
+                parts.setdefault(shard_index, []).append(paper)
+
+            for shard_index, part in sorted(parts.items()):
+                shard_prefix = f"{prefix}/shard-{shard_index:03d}-of-{num_shards:03d}"
+                part_name = f"{shard_prefix}/part-{len(manifest.batches):05d}{extension}"
+                store_data(data=part, bucket_name=bucket_name, file_name=part_name)
+                manifest.add_batch(part_name, [paper["meta_data"]["doi"] for paper in part], manifest.next_starting_record)
+            if failed_dois:
+                manifest.add_batch(None, [], manifest.next_starting_record, failed_dois)
+            logger.info(f"Stored {len(papers)} new papers for '{query}' from record {starts[0]}, {len(failed_dois)} failed.")
+
+        logger.info(f"Request stats: {client.stats.summary()}")
+
+    if failed_units:
+        logger.error(
+            f"{len(failed_units)} of {len(work_units)} work units failed, run the ingestion again to collect "
+            f"their papers: {failed_units}"
+        )
+    logger.info(
+        f"Sharded ingestion completed, {len(manifest.dois)} unique papers stored in {len(manifest.batches)} parts, "
+        f"{len(manifest.failed_dois)} papers failed."
+    )
+    return manifest.batches
+
+
 if __name__ == "__main__":
-    QUERY = input("Enter the query (default: 'vegan OR plant-based nutrition'): ") or "vegan OR plant based nutrition"
+    QUERIES = input("Enter the query, or several separated by ';' (default: 'vegan OR plant-based nutrition'): ") or "vegan OR plant based nutrition"
+    QUERIES = [query.strip() for query in QUERIES.split(";") if query.strip()]
+    QUERY = QUERIES[0]
     API_KEY = os.environ.get("SPRINGER_NATURE_API")
     BUCKET_NAME = os.environ.get('AWS_BUCKET_NAME')
-    TOTAL_RECORDS = input("Enter the total number of records (default: 250): ") or 250
+    TOTAL_RECORDS = input("Enter the total number of records, per query if there are several (default: 250): ") or 250
     TOTAL_RECORDS = int(TOTAL_RECORDS)
     MAX_RECORDS = 25
     
     default_file_name = re.sub(r'\s+', '_', QUERY).lower() + "_data.json"
+    if len(QUERIES) > 1:
+        default_file_name = "multi_query_data.jsonl.gz"
     FILE_NAME = input(f"Enter the file name for storing the data (default: {default_file_name}): ") or default_file_name
+    INCREMENTAL = len(QUERIES) == 1 and (input("Store papers in checkpointed batches and skip stored ones? (default: n): ") or "n").lower() == "y"
 
 
     # Call the main ingestion function with the provided values
-    ingest_data(
-        query=QUERY, 
-        api_key=API_KEY, 
-        bucket_name=BUCKET_NAME, 
-        total_records=TOTAL_RECORDS, 
-        max_records=MAX_RECORDS, 
-        file_name=FILE_NAME
-    )
\ No newline at end of file
+    if len(QUERIES) > 1:
+        ingest_queries_sharded(
+            queries=QUERIES,
+            api_key=API_KEY,
+            bucket_name=BUCKET_NAME,
+            records_per_query=TOTAL_RECORDS,
+            max_records=MAX_RECORDS,
+            file_name=FILE_NAME
+        )
+    elif INCREMENTAL:
+        ingest_data_incrementally(
+            query=QUERY, 
+            api_key=API_KEY, 
+            bucket_name=BUCKET_NAME, 
+            total_records=TOTAL_RECORDS, 
+            max_records=MAX_RECORDS, 
+            file_name=FILE_NAME
+        )
+    else:
+        ingest_data(
+            query=QUERY, 
+            api_key=API_KEY, 
+            bucket_name=BUCKET_NAME, 
+            total_records=TOTAL_RECORDS, 
+            max_records=MAX_RECORDS, 
+            file_name=FILE_NAME
+        )
\ No newline at end of file
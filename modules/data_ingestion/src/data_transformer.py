@@ -1,11 +1,37 @@
-from .springer_api_client import fetch_paper_meta_data, fetch_full_text
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Container, Iterable, List, Dict, Optional, Set
+from .springer_api_client import SpringerClient
 from ...utils.logger import setup_logger
 
 logger = setup_logger("data_transformer", "data_ingestion.log")
 
+def extract_meta_data(record: dict) -> dict:
+    """
+    Picks the meta data we keep for a paper out of a record returned by the Springer Nature API.
+
+    Args:
+        record (dict): One record from the "records" list of the API response.
+
+    Returns:
+        dict: The meta data of the paper.
+    """
+    return {
+        "content_type": record.get("contentType"),
+        "url": record.get("url"),
+        "title": record.get("title"),
+        "publication_name": record.get("publicationName"),
+        "doi": record.get("doi"),
+        "publication_date": record.get("publicationDate"),
+        "starting_page": record.get("startingPage"),
+        "ending_page": record.get("endingPage"),
+        "open_access": record.get("openAccess"),
+        "abstract": record.get("abstract"),
+    }
+
+
 def transform_paper_data(
+    client: SpringerClient,
     query: str, 
-    api_key: str, 
     base_url: str = "http://api.springernature.com/openaccess/json", 
     starting_record: int = 1, 
     max_records: int = 25
@@ -14,8 +40,8 @@ def transform_paper_data(
     Retrieves the meta data and full text content of papers that match the query from the Springer Nature API.
 
     Args:
+        client (SpringerClient): The client used to send requests to the API.
         query (str): Description of what kind of papers you want to collect.
-        api_key (str): Springer Nature API Key. Note: there is a free version and a premium version.
         base_url (str, optional): The endpoint of the Springer Nature API to get meta data. 
             Defaults to "http://api.springernature.com/openaccess/json".
         starting_record (int, optional): The starting record number. Defaults to 1. 
@@ -28,25 +54,14 @@ def transform_paper_data(
     """
     
     papers_data = []
-    results = fetch_paper_meta_data(query, api_key, base_url, starting_record, max_records)
+    results = client.fetch_paper_meta_data(query, base_url, starting_record, max_records)
     
     logger.info("Retrieved meta data for papers, now saving them alongside the full pdf text.")
     for record in results.get("records", []):
         if record.get("openAccess"):
-            meta_data = {
-                "content_type": record.get("contentType"),
-                "url": record.get("url"),
-                "title": record.get("title"),
-                "publication_name": record.get("publicationName"),
-                "doi": record.get("doi"),
-                "publication_date": record.get("publicationDate"),
-                "starting_page": record.get("startingPage"),
-                "ending_page": record.get("endingPage"),
-                "open_access": record.get("openAccess"),
-                "abstract": record.get("abstract"),
-            }
+            meta_data = extract_meta_data(record)
             
-            full_text = fetch_full_text(record.get("doi"), api_key)
+            full_text = client.fetch_full_text(record.get("doi"))
             record_data = {
                 "meta_data": meta_data,
                 "content": full_text
@@ -54,3 +69,81 @@ def transform_paper_data(
             papers_data.append(record_data)
     
     return papers_data
+
+
+def transform_paper_data_concurrently(
+    client: SpringerClient,
+    query: str,
+    starting_records: Iterable[int],
+    base_url: str = "http://api.springernature.com/openaccess/json",
+    max_records: int = 25,
+    max_workers: int = 8,
+    skip_dois: Container[str] = (),
+    claim_doi: Optional[Callable[[str], bool]] = None,
+    failed_dois: Optional[Set[str]] = None
+) -> List[Dict]:
+    """
+    Concurrent version of transform_paper_data that retrieves several pages of results at once.
+    Meta data pages and full texts are fetched from a thread pool, and every request goes through the
+    client's shared rate limiter, so throughput is bound by the API quota rather than by round-trip times.
+    A paper whose full text can not be retrieved or parsed, even after the client's retries, is logged and
+    left out, so it does not cost the other papers of the pages.
+
+    Args:
+        client (SpringerClient): The client used to send requests to the API, shared by all threads.
+        query (str): Description of what kind of papers you want to collect.
+        starting_records (Iterable[int]): The starting record number of every page to retrieve.
+        base_url (str, optional): The endpoint of the Springer Nature API to get meta data.
+            Defaults to "http://api.springernature.com/openaccess/json".
+        max_records (int, optional): The number of records per page. Defaults to 25.
+        max_workers (int, optional): The number of requests that can be in flight at once. Defaults to 8.
+        skip_dois (Container[str], optional): DOIs of papers that are already stored, their full text
+            is not requested again. Defaults to ().
+        claim_doi (Callable[[str], bool], optional): Called with each new DOI before its full text is requested,
+            the paper is skipped if it returns False. Lets concurrent calls share one set of seen DOIs. Defaults to None.
+        failed_dois (Set[str], optional): The DOIs of the papers left out because their full text failed are added
+            to it. Defaults to None.
+
+    Returns:
+        list: The same records as transform_paper_data, for all pages, in page order.
+    """
+    starting_records = list(starting_records)
+    pages: List[Optional[list]] = [None] * len(starting_records)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        page_futures = {
+            executor.submit(
+                client.fetch_paper_meta_data, query, base_url, starting_record, max_records
+            ): page_index
+            for page_index, starting_record in enumerate(starting_records)
+        }
+
+        # Full texts of a page are queued as soon as its meta data arrives, instead of waiting for every page.
+        for page_future in as_completed(page_futures):
+            page_index = page_futures[page_future]
+            results = page_future.result()
+            logger.info(f"Retrieved meta data for page starting at record {starting_records[page_index]}.")
+
+            pages[page_index] = [
+                (
+                    extract_meta_data(record),
+                    executor.submit(client.fetch_full_text, record.get("doi"))
+                )
+                for record in results.get("records", [])
+                if record.get("openAccess") and record.get("doi") not in skip_dois
+                and (claim_doi is None or claim_doi(record.get("doi")))
+            ]
+
+        papers_data = []
+        for page in pages:
+            for meta_data, text_future in page:
+                try:
+                    content = text_future.result()
+                except Exception as e:
+                    logger.error(f"Skipping paper {meta_data['doi']}, its full text could not be retrieved: {e!r}")
+                    if failed_dois is not None:
+                        failed_dois.add(meta_data["doi"])
+                    continue
+                papers_data.append({"meta_data": meta_data, "content": content})
+
+    return papers_data
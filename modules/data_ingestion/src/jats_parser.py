@@ -0,0 +1,118 @@
+import io
+import xml.etree.ElementTree as ET
+from typing import BinaryIO, Dict, Iterator, List, Optional, Union
+from ...utils.logger import setup_logger
+
+logger = setup_logger("jats_parser", "data_ingestion.log")
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+class _Section:
+    __slots__ = ("title", "paragraphs", "emitted")
+
+    def __init__(self, title: str = ""):
+        self.title = title
+        self.paragraphs: List[str] = []
+        self.emitted = False
+
+    def flush(self, force: bool = False) -> Optional[Dict[str, str]]:
+        if not self.paragraphs and not force:
+            return None
+        record = {"section": self.title, "body": "\n\n".join(self.paragraphs)}
+        self.paragraphs = []
+        self.emitted = True
+        return record
+
+
+def iter_jats_sections(source: Union[str, BinaryIO]) -> Iterator[Dict[str, str]]:
+    """
+    Streams the sections of an article's body out of a JATS XML document, in a single pass.
+    Paragraph text includes the text inside and after inline tags like <italic> or <xref>, and every element
+    is released as soon as it has been read, so memory stays bounded on large review articles.
+
+    Each <sec> gives one record with its title and its own paragraphs, joined by blank lines. Paragraphs of
+    nested sections belong to the nested section only, and if a section has paragraphs after a nested section,
+    they are emitted as a second record with the same title, so records stay in document order.
+    Paragraphs directly under <body>, outside any <sec>, are emitted with an empty section title.
+
+    Args:
+        source (Union[str, BinaryIO]): The path of the XML file, or a binary file object with its content.
+
+    Yields:
+        Dict[str, str]: A dictionary with the section title and body text of one section.
+    """
+    sections: List[_Section] = []
+    body_level = _Section()
+    open_elements: List[ET.Element] = []
+    body_depth = 0
+    paragraph_depth = 0
+    title_depth = 0
+
+    for event, elem in ET.iterparse(source, events=("start", "end")):
+        tag = _local_name(elem.tag)
+
+        if event == "start":
+            parent_tag = _local_name(open_elements[-1].tag) if open_elements else None
+            open_elements.append(elem)
+
+            if tag == "body":
+                body_depth += 1
+            elif body_depth and tag == "sec" and not paragraph_depth:
+                record = body_level.flush() if not sections else sections[-1].flush()
+                if record is not None:
+                    yield record
+                sections.append(_Section())
+            elif tag == "p":
+                paragraph_depth += 1
+            elif tag == "title" and parent_tag == "sec":
+                title_depth += 1
+            continue
+
+        open_elements.pop()
+
+        if body_depth and tag == "p":
+            paragraph_depth -= 1
+            if not paragraph_depth:
+                text = "".join(elem.itertext()).strip()
+                if text:
+                    (sections[-1] if sections else body_level).paragraphs.append(text)
+        elif tag == "title" and title_depth and _local_name(open_elements[-1].tag) == "sec":
+            title_depth -= 1
+            if body_depth and sections:
+                sections[-1].title = "".join(elem.itertext()).strip()
+        elif body_depth and tag == "sec" and not paragraph_depth:
+            section = sections.pop()
+            record = section.flush(force=not section.emitted)
+            if record is not None:
+                yield record
+        elif tag == "body":
+            body_depth -= 1
+            record = body_level.flush()
+            if record is not None:
+                yield record
+        elif tag == "p":
+            paragraph_depth -= 1
+
+        # Paragraphs and titles are read when they end, so anything outside of them is no longer
+        # needed once it ends. Earlier siblings are already gone, which keeps each removal cheap.
+        if not paragraph_depth and not title_depth:
+            elem.clear()
+            if open_elements:
+                open_elements[-1].remove(elem)
+
+
+def parse_jats_sections(xml_content: bytes) -> List[Dict[str, str]]:
+    """
+    Extracts all the sections of an article from the JATS XML returned by the Springer Nature API.
+
+    Args:
+        xml_content (bytes): The raw XML of the article.
+
+    Returns:
+        list: A list of dictionaries, where each dictionary contains the section title and body text of the article.
+    """
+    full_text = list(iter_jats_sections(io.BytesIO(xml_content)))
+    logger.info(f"Extracted {len(full_text)} sections from the full text.")
+    return full_text
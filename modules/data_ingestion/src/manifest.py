@@ -0,0 +1,134 @@
+import os
+import json
+import boto3
+from typing import Iterable, List, Optional, Set
+from botocore.exceptions import ClientError
+from ...utils.logger import setup_logger
+
+logger = setup_logger("manifest", "data_ingestion.log")
+
+class IngestionManifest:
+    """
+    Keeps track of what a checkpointed ingestion run has already stored, so that a crashed run can resume
+    where it stopped and a refresh of the corpus only fetches papers we do not have yet.
+    The manifest can be saved to a local file, or to an S3 object when the location starts with "s3://".
+
+    Args:
+        location (str): The local path, or "s3://bucket/key", of the manifest.
+        dois (Set[str], optional): The DOIs of the papers already stored. Defaults to an empty set.
+        next_starting_record (int, optional): The starting record of the next page to request. Defaults to 1.
+        batches (List[str], optional): The names of the batch objects already stored, in order. Defaults to [].
+        failed_dois (Set[str], optional): The DOIs of the papers whose full text could not be retrieved, which
+            are not stored, and retried by a refresh of the corpus. Defaults to an empty set.
+    """
+    def __init__(
+        self,
+        location: str,
+        dois: Optional[Set[str]] = None,
+        next_starting_record: int = 1,
+        batches: Optional[List[str]] = None,
+        failed_dois: Optional[Set[str]] = None
+    ):
+        self.location = location
+        self.dois = set(dois or [])
+        self.next_starting_record = next_starting_record
+        self.batches = list(batches or [])
+        self.failed_dois = set(failed_dois or [])
+
+    def __contains__(self, doi: str) -> bool:
+        return doi in self.dois
+
+    @staticmethod
+    def _split_s3_location(location: str):
+        bucket_name, _, key = location[len("s3://"):].partition("/")
+        return bucket_name, key
+
+    @classmethod
+    def load(cls, location: str) -> "IngestionManifest":
+        """
+        Loads the manifest at the given location, or creates an empty one if it does not exist yet.
+
+        Args:
+            location (str): The local path, or "s3://bucket/key", of the manifest.
+
+        Returns:
+            IngestionManifest: The manifest.
+        """
+        if location.startswith("s3://"):
+            bucket_name, key = cls._split_s3_location(location)
+            try:
+                response = boto3.client('s3').get_object(Bucket=bucket_name, Key=key)
+            except ClientError as e:
+                if e.response["Error"]["Code"] not in ("NoSuchKey", "404"):
+                    raise
+                logger.info(f"No manifest found at {location}, starting a new one.")
+                return cls(location)
+            content = json.loads(response['Body'].read())
+        else:
+            if not os.path.exists(location):
+                logger.info(f"No manifest found at {location}, starting a new one.")
+                return cls(location)
+            with open(location) as f:
+                content = json.load(f)
+
+        manifest = cls(
+            location,
+            dois=set(content["dois"]),
+            next_starting_record=content["next_starting_record"],
+            batches=content["batches"],
+            failed_dois=set(content.get("failed_dois", []))
+        )
+        logger.info(
+            f"Loaded manifest from {location} with {len(manifest.dois)} DOIs in {len(manifest.batches)} batches, "
+            f"{len(manifest.failed_dois)} failed DOIs, next starting record is {manifest.next_starting_record}."
+        )
+        return manifest
+
+    def save(self) -> None:
+        """
+        Writes the manifest to its location. The local file is replaced atomically so a crash
+        while saving never leaves a truncated manifest behind.
+        """
+        content = json.dumps({
+            "next_starting_record": int(self.next_starting_record),
+            "batches": self.batches,
+            "dois": sorted(self.dois),
+            "failed_dois": sorted(self.failed_dois),
+        })
+
+        if self.location.startswith("s3://"):
+            bucket_name, key = self._split_s3_location(self.location)
+            boto3.client('s3').put_object(Body=content, Bucket=bucket_name, Key=key)
+        else:
+            directory = os.path.dirname(self.location)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_location = self.location + ".tmp"
+            with open(tmp_location, "w") as f:
+                f.write(content)
+            os.replace(tmp_location, self.location)
+
+    def add_batch(
+        self,
+        batch_name: Optional[str],
+        dois: List[str],
+        next_starting_record: int,
+        failed_dois: Iterable[str] = ()
+    ) -> None:
+        """
+        Records a batch that was stored successfully and saves the manifest.
+
+        Args:
+            batch_name (str, optional): The name of the stored batch object, or None if the batch had no new paper.
+            dois (List[str]): The DOIs of the papers in the batch.
+            next_starting_record (int): The starting record of the page following the batch.
+            failed_dois (Iterable[str], optional): The DOIs of the papers of the batch whose full text could not be
+                retrieved. Defaults to ().
+        """
+        if batch_name is not None:
+            self.batches.append(batch_name)
+        self.dois.update(dois)
+        self.failed_dois.update(failed_dois)
+        self.failed_dois.difference_update(self.dois)
+        self.next_starting_record = next_starting_record
+        self.save()
@@ -0,0 +1,140 @@
+import os
+import json
+import datetime
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+from ...utils.logger import setup_logger
+
+logger = setup_logger("parquet_storage", "data_ingestion.log")
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("The Parquet layout needs the pyarrow package: pip install pyarrow") from e
+    return pyarrow
+
+
+def get_section_schema():
+    """
+    Returns the Arrow schema of the Parquet corpus: one row per paper section, with the paper's meta data
+    as typed columns and the section's text in its own column, so that meta data only queries never read it.
+    """
+    pa = _import_pyarrow()
+    return pa.schema([
+        ("doi", pa.string()),
+        ("content_type", pa.string()),
+        ("title", pa.string()),
+        ("publication_name", pa.string()),
+        ("publication_date", pa.date32()),
+        ("starting_page", pa.int32()),
+        ("ending_page", pa.int32()),
+        ("open_access", pa.bool_()),
+        ("url", pa.list_(pa.struct([
+            ("format", pa.string()),
+            ("platform", pa.string()),
+            ("value", pa.string()),
+        ]))),
+        # The API returns the abstract either as a string or as a {"h1": ..., "p": ...} dict, so it is kept as JSON.
+        ("abstract", pa.string()),
+        ("section_index", pa.int32()),
+        ("section", pa.string()),
+        ("body", pa.large_string()),
+    ])
+
+
+def _to_int(value: Any) -> Optional[int]:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _to_date(value: Any) -> Optional[datetime.date]:
+    try:
+        return datetime.date.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def paper_to_rows(paper: Dict) -> Iterator[Dict]:
+    """
+    Flattens one paper into Parquet rows, one per section. A paper without sections still gets one row,
+    with null section columns, so its meta data is kept.
+
+    Args:
+        paper (Dict): A paper with "meta_data" and "content" keys, as collected by the ingestion pipeline.
+
+    Yields:
+        Dict: The rows of the paper, matching get_section_schema.
+    """
+    meta_data = paper["meta_data"]
+    paper_columns = {
+        "doi": meta_data.get("doi"),
+        "content_type": meta_data.get("content_type"),
+        "title": meta_data.get("title"),
+        "publication_name": meta_data.get("publication_name"),
+        "publication_date": _to_date(meta_data.get("publication_date")),
+        "starting_page": _to_int(meta_data.get("starting_page")),
+        "ending_page": _to_int(meta_data.get("ending_page")),
+        "open_access": str(meta_data.get("open_access")).lower() == "true",
+        "url": meta_data.get("url") or [],
+        "abstract": json.dumps(meta_data.get("abstract")),
+    }
+
+    sections = paper.get("content") or [None]
+    for section_index, section in enumerate(sections):
+        yield {
+            **paper_columns,
+            "section_index": section_index if section is not None else None,
+            "section": section["section"] if section is not None else None,
+            "body": section["body"] if section is not None else None,
+        }
+
+
+def write_parquet(
+    data: Iterable[Dict],
+    bucket_name: Optional[str],
+    file_name: str,
+    rows_per_group: int = 10000
+) -> int:
+    """
+    Writes papers to a zstd compressed Parquet file, one row group at a time, so memory is bounded
+    by rows_per_group rather than by the size of the corpus.
+
+    Args:
+        data (Iterable[Dict]): The papers to store.
+        bucket_name (str, optional): The name of the S3 bucket. If None or empty, file_name is a local path.
+        file_name (str): The name of the file object in the S3 bucket, or the local path.
+        rows_per_group (int, optional): The number of section rows per Parquet row group. Defaults to 10000.
+
+    Returns:
+        int: The number of rows written.
+    """
+    pa = _import_pyarrow()
+    schema = get_section_schema()
+
+    if bucket_name:
+        from pyarrow import fs
+        filesystem, path = fs.S3FileSystem(), f"{bucket_name}/{file_name}"
+    else:
+        filesystem, path = None, file_name
+        directory = os.path.dirname(file_name)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    total_rows = 0
+    rows: List[Dict] = []
+    with pa.parquet.ParquetWriter(path, schema, filesystem=filesystem, compression="zstd") as writer:
+        for paper in data:
+            rows.extend(paper_to_rows(paper))
+            if len(rows) >= rows_per_group:
+                writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+                total_rows += len(rows)
+                rows = []
+        if rows:
+            writer.write_table(pa.Table.from_pylist(rows, schema=schema))
+            total_rows += len(rows)
+
+    logger.info(f"Wrote {total_rows} section rows to {path}.")
+    return total_rows
@@ -0,0 +1,75 @@
+import threading
+import time
+from ...utils.logger import setup_logger
+
+logger = setup_logger("rate_limiter", "data_ingestion.log")
+
+class TokenBucket:
+    """
+    A thread-safe token bucket that is shared by every worker making requests to the Springer Nature API.
+    Each request takes one token, and tokens are refilled continuously at a fixed rate, so the total request
+    rate stays under the API quota no matter how many threads are fetching at once.
+
+    Args:
+        rate (float): The number of tokens added to the bucket per second.
+        capacity (int): The max number of tokens the bucket can hold, i.e. the largest allowed burst.
+    """
+    def __init__(self, rate: float, capacity: int = 1):
+        if rate <= 0:
+            raise ValueError("rate must be greater than 0.")
+        if capacity < 1:
+            raise ValueError("capacity must be at least 1.")
+
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_quota(cls, requests_per_minute: int = 100, burst: int = 5) -> "TokenBucket":
+        """
+        Creates a bucket sized to a per minute API quota. The refill rate leaves room for the burst,
+        so that no 60 second window can ever contain more than requests_per_minute requests.
+
+        Args:
+            requests_per_minute (int, optional): The API quota. Defaults to 100, the free Springer Nature plan.
+            burst (int, optional): The number of requests that can be sent back to back. Defaults to 5.
+
+        Returns:
+            TokenBucket: The rate limiter.
+        """
+        if not 1 <= burst < requests_per_minute:
+            raise ValueError("burst must be at least 1 and lower than requests_per_minute.")
+        return cls(rate=(requests_per_minute - burst) / 60, capacity=burst)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self, tokens: int = 1) -> float:
+        """
+        Blocks until the requested number of tokens is available, then takes them from the bucket.
+
+        Args:
+            tokens (int, optional): The number of tokens to take. Defaults to 1.
+
+        Returns:
+            float: The total number of seconds spent waiting for the tokens.
+        """
+        if tokens > self.capacity:
+            raise ValueError(f"Cannot acquire {tokens} tokens from a bucket with capacity {self.capacity}.")
+
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    if waited:
+                        logger.debug(f"Waited {waited:.2f} seconds for the rate limiter.")
+                    return waited
+                wait_time = (tokens - self._tokens) / self.rate
+            time.sleep(wait_time)
+            waited += wait_time
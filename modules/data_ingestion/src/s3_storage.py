@@ -1,6 +1,15 @@
+import os
 import json
+import zlib
 import boto3
-from typing import List, Dict
+from typing import Iterable, Iterator, List, Dict, Optional, Tuple
+from .parquet_storage import write_parquet
+from ...utils.logger import setup_logger
+
+logger = setup_logger("s3_storage", "data_ingestion.log")
+
+# S3 needs every part of a multipart upload but the last one to be at least 5 MB.
+MIN_PART_SIZE = 5 * 1024 * 1024
 
 def upload_to_s3(data: List[Dict], bucket_name: str, file_name: str) -> None:
     """
@@ -14,3 +23,194 @@ def upload_to_s3(data: List[Dict], bucket_name: str, file_name: str) -> None:
     data = json.dumps(data)
     s3 = boto3.client('s3')
     s3.put_object(Body=data, Bucket=bucket_name, Key=file_name)
+
+
+def is_jsonl(file_name: str) -> bool:
+    """
+    Whether a file name uses the JSON Lines format, optionally compressed, e.g. "papers.jsonl.gz".
+    """
+    return ".jsonl" in os.path.basename(file_name)
+
+
+def split_extension(file_name: str) -> Tuple[str, str]:
+    """
+    Splits a file name into its stem and its full extension, keeping compound ones together,
+    e.g. "papers.jsonl.gz" gives ("papers", ".jsonl.gz").
+    """
+    if is_jsonl(file_name):
+        index = file_name.rindex(".jsonl")
+        return file_name[:index], file_name[index:]
+    return os.path.splitext(file_name)
+
+
+def infer_compression(file_name: str) -> Optional[str]:
+    """
+    Infers the compression from the extension of a file name: "gzip" for ".gz", "zstd" for ".zst", otherwise None.
+    """
+    if file_name.endswith(".gz"):
+        return "gzip"
+    if file_name.endswith(".zst"):
+        return "zstd"
+    return None
+
+
+def _get_compressor(compression: Optional[str]):
+    if compression is None:
+        return None
+    if compression == "gzip":
+        return zlib.compressobj(wbits=31)  # 31 writes a gzip header and trailer
+    if compression == "zstd":
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError("zstd compression needs the zstandard package: pip install zstandard") from e
+        return zstandard.ZstdCompressor().compressobj()
+    raise ValueError(f"Unsupported compression: {compression}. Use 'gzip', 'zstd' or None.")
+
+
+def iter_jsonl_bytes(records: Iterable[Dict], compression: Optional[str] = None) -> Iterator[bytes]:
+    """
+    Encodes records as JSON Lines, one record per line, and compresses them on the fly.
+    Only one record is encoded at a time, so memory does not grow with the number of records.
+
+    Args:
+        records (Iterable[Dict]): The records to encode.
+        compression (str, optional): "gzip", "zstd" or None. Defaults to None.
+
+    Yields:
+        bytes: Chunks of the encoded output, which may be empty while the compressor buffers.
+    """
+    compressor = _get_compressor(compression)
+
+    for record in records:
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        yield compressor.compress(line) if compressor is not None else line
+
+    if compressor is not None:
+        yield compressor.flush()
+
+
+def upload_jsonl_to_s3(
+    records: Iterable[Dict],
+    bucket_name: str,
+    file_name: str,
+    compression: Optional[str] = "infer",
+    part_size: int = 8 * 1024 * 1024
+) -> int:
+    """
+    Streams records to an S3 object as (compressed) JSON Lines through a multipart upload.
+    At most one part is held in memory at a time, and if the whole output fits in a single part
+    it is sent with one put_object instead. A failed multipart upload is aborted so no parts are left behind.
+
+    Args:
+        records (Iterable[Dict]): The records to upload, e.g. a generator of papers.
+        bucket_name (str): The name of the S3 bucket.
+        file_name (str): The name of the file object in the S3 bucket, e.g. "papers.jsonl.gz".
+        compression (str, optional): "gzip", "zstd", None, or "infer" to pick it from the file name. Defaults to "infer".
+        part_size (int, optional): The size in bytes of each uploaded part, at least 5 MB. Defaults to 8 MB.
+
+    Returns:
+        int: The number of bytes uploaded.
+    """
+    if part_size < MIN_PART_SIZE:
+        raise ValueError(f"part_size must be at least {MIN_PART_SIZE} bytes.")
+    if compression == "infer":
+        compression = infer_compression(file_name)
+
+    s3 = boto3.client('s3')
+    buffer = bytearray()
+    upload_id = None
+    parts = []
+    total_bytes = 0
+
+    def upload_part(body: bytes) -> None:
+        response = s3.upload_part(
+            Body=body, Bucket=bucket_name, Key=file_name, UploadId=upload_id, PartNumber=len(parts) + 1
+        )
+        parts.append({"ETag": response["ETag"], "PartNumber": len(parts) + 1})
+
+    try:
+        for chunk in iter_jsonl_bytes(records, compression):
+            buffer += chunk
+            if len(buffer) >= part_size:
+                if upload_id is None:
+                    upload_id = s3.create_multipart_upload(Bucket=bucket_name, Key=file_name)["UploadId"]
+                upload_part(bytes(buffer))
+                total_bytes += len(buffer)
+                buffer.clear()
+
+        if upload_id is None:
+            s3.put_object(Body=bytes(buffer), Bucket=bucket_name, Key=file_name)
+        else:
+            if buffer:
+                upload_part(bytes(buffer))
+            s3.complete_multipart_upload(
+                Bucket=bucket_name, Key=file_name, UploadId=upload_id, MultipartUpload={"Parts": parts}
+            )
+        total_bytes += len(buffer)
+    except Exception:
+        if upload_id is not None:
+            logger.error(f"Aborting multipart upload of {file_name} after {len(parts)} parts.")
+            s3.abort_multipart_upload(Bucket=bucket_name, Key=file_name, UploadId=upload_id)
+        raise
+
+    logger.info(f"Uploaded {total_bytes} bytes to {file_name} in {max(len(parts), 1)} parts.")
+    return total_bytes
+
+
+def write_jsonl_to_file(records: Iterable[Dict], path: str, compression: Optional[str] = "infer") -> int:
+    """
+    Local file system version of upload_jsonl_to_s3, for offline runs.
+
+    Args:
+        records (Iterable[Dict]): The records to write.
+        path (str): The path of the output file, e.g. "papers.jsonl.gz".
+        compression (str, optional): "gzip", "zstd", None, or "infer" to pick it from the file name. Defaults to "infer".
+
+    Returns:
+        int: The number of bytes written.
+    """
+    if compression == "infer":
+        compression = infer_compression(path)
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    total_bytes = 0
+    with open(path, "wb") as f:
+        for chunk in iter_jsonl_bytes(records, compression):
+            f.write(chunk)
+            total_bytes += len(chunk)
+
+    logger.info(f"Wrote {total_bytes} bytes to {path}.")
+    return total_bytes
+
+
+def store_data(data: Iterable[Dict], bucket_name: Optional[str], file_name: str) -> None:
+    """
+    Stores papers in the format given by the file name: a JSON array for ".json",
+    streamed (compressed) JSON Lines for ".jsonl", ".jsonl.gz" and ".jsonl.zst",
+    or one row per section in a zstd compressed Parquet file for ".parquet".
+
+    Args:
+        data (Iterable[Dict]): The papers to store.
+        bucket_name (str, optional): The name of the S3 bucket. If None or empty, the data is written
+            to the local file system instead, with file_name as the path.
+        file_name (str): The name of the file object in the S3 bucket, or the local path.
+    """
+    if file_name.endswith(".parquet"):
+        write_parquet(data, bucket_name, file_name)
+    elif is_jsonl(file_name):
+        if bucket_name:
+            upload_jsonl_to_s3(data, bucket_name, file_name)
+        else:
+            write_jsonl_to_file(data, file_name)
+    elif bucket_name:
+        upload_to_s3(data=list(data), bucket_name=bucket_name, file_name=file_name)
+    else:
+        directory = os.path.dirname(file_name)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(file_name, "w") as f:
+            json.dump(list(data), f)
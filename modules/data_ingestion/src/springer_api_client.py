@@ -1,61 +1,367 @@
+import os
+import json
+import time
+import zlib
+import random
+import hashlib
+import threading
 import requests
-import xml.etree.ElementTree as ET
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
+from typing import Optional, Tuple
+from requests.adapters import HTTPAdapter
+from .jats_parser import parse_jats_sections
+from .rate_limiter import TokenBucket
 from ...utils.logger import setup_logger
 
 logger = setup_logger("springer_api_client", "data_ingestion.log")
 
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+@dataclass
+class RequestStats:
+    """
+    Thread-safe counters for the requests sent by a SpringerClient.
+    """
+    requests: int = 0
+    retries: int = 0
+    failures: int = 0
+    cache_hits: int = 0
+    total_latency: float = 0.0
+    max_latency: float = 0.0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def record(self, latency: float, retries: int, failed: bool = False) -> None:
+        with self._lock:
+            self.requests += 1
+            self.retries += retries
+            self.failures += int(failed)
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def record_cache_hit(self) -> None:
+        with self._lock:
+            self.cache_hits += 1
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "retries": self.retries,
+                "failures": self.failures,
+                "cache_hits": self.cache_hits,
+                "mean_latency": self.total_latency / self.requests if self.requests else 0.0,
+                "max_latency": self.max_latency,
+            }
+
+
+class ResponseCache:
+    """
+    Content-addressed on-disk cache for API responses, so that re-runs with the same queries are served
+    from local disk without spending API quota. Each entry is a zlib compressed file named after the
+    hash of its key. Entries expire after ttl seconds, and once the cache grows over max_size bytes
+    the least recently used entries are evicted.
+
+    Args:
+        cache_dir (str): The directory the entries are stored in.
+        ttl (float, optional): The number of seconds an entry stays valid. Defaults to 7 days.
+        max_size (int, optional): The max total size of the entries in bytes. Defaults to 1 GB.
+    """
+    def __init__(self, cache_dir: str, ttl: float = 7 * 24 * 3600, max_size: int = 1024 ** 3):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.is_file())
+
+    def _path(self, key: tuple) -> str:
+        digest = hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, digest + ".z")
+
+    def get(self, key: tuple) -> Optional[bytes]:
+        """
+        Returns the cached content for the key, or None if it is missing or expired.
+        The write time of an entry is kept as its modification time and its last use as its access time.
+        """
+        path = self._path(key)
+        try:
+            stat = os.stat(path)
+            if time.time() - stat.st_mtime > self.ttl:
+                self._remove(path)
+                return None
+            with open(path, "rb") as f:
+                content = zlib.decompress(f.read())
+            os.utime(path, (time.time(), stat.st_mtime))
+        except (FileNotFoundError, zlib.error):
+            return None
+        return content
+
+    def put(self, key: tuple, content: bytes) -> None:
+        """
+        Stores the content for the key, then evicts the least recently used entries if the cache is too big.
+        """
+        path = self._path(key)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(zlib.compress(content))
+
+        with self._lock:
+            if os.path.exists(path):
+                self._size -= os.path.getsize(path)
+            os.replace(tmp_path, path)
+            self._size += os.path.getsize(path)
+            if self._size > self.max_size:
+                self._evict()
+
+    def _remove(self, path: str) -> None:
+        with self._lock:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                self._size -= size
+            except FileNotFoundError:
+                pass
+
+    def _evict(self) -> None:
+        # Called with the lock held, evicts down to 90% of max_size so we do not scan on every put.
+        entries = sorted(
+            (entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".z")),
+            key=lambda entry: entry.stat().st_atime
+        )
+        for entry in entries:
+            if self._size <= 0.9 * self.max_size:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            self._size -= size
+        logger.info(f"Evicted cache entries, cache size is now {self._size} bytes.")
+
+
+class SpringerClient:
+    """
+    Client for the Springer Nature open access API. It keeps one pooled keep-alive session for all requests,
+    so connections are reused across threads, and retries rate limited (429) or failed (5xx) requests
+    with jittered exponential backoff, honoring the Retry-After header when the API sends one.
+
+    Args:
+        api_key (str): Springer Nature API Key. Note: there is a free version and a premium version.
+        rate_limiter (TokenBucket, optional): A rate limiter shared by all requests, retries included. Defaults to None.
+        max_retries (int, optional): The max number of retries per request. Defaults to 5.
+        backoff_factor (float, optional): The base delay in seconds of the exponential backoff. Defaults to 1.
+        max_backoff (float, optional): The max delay in seconds between two attempts. Defaults to 60.
+        timeout (Tuple[float, float], optional): The connect and read timeouts in seconds. Defaults to (5, 30).
+        pool_size (int, optional): The max number of pooled connections, should be at least the number of
+            threads using the client. Defaults to 10.
+        cache (ResponseCache, optional): An on-disk cache for the responses. Meta data pages are cached by
+            (endpoint, query, starting record, max records) and full texts by DOI. Defaults to None.
+    """
+    def __init__(
+        self,
+        api_key: str,
+        rate_limiter: Optional[TokenBucket] = None,
+        max_retries: int = 5,
+        backoff_factor: float = 1.0,
+        max_backoff: float = 60.0,
+        timeout: Tuple[float, float] = (5, 30),
+        pool_size: int = 10,
+        cache: Optional[ResponseCache] = None
+    ):
+        self.api_key = api_key
+        self.rate_limiter = rate_limiter
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.cache = cache
+        self.stats = RequestStats()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        self.session.close()
+
+    def _retry_delay(self, attempt: int, response: Optional[requests.Response]) -> float:
+        if response is not None:
+            retry_after = response.headers.get("Retry-After")
+            if retry_after:
+                try:
+                    return min(float(retry_after), self.max_backoff)
+                except ValueError:
+                    try:
+                        delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                        return min(max(delay, 0.0), self.max_backoff)
+                    except (TypeError, ValueError):
+                        pass
+
+        # Full jitter, so that workers that failed together do not retry together.
+        return random.uniform(0, min(self.max_backoff, self.backoff_factor * 2 ** attempt))
+
+    def _get(self, url: str, params: dict) -> requests.Response:
+        """
+        Sends a GET request, retrying on connection errors, timeouts and retryable status codes.
+
+        Args:
+            url (str): The endpoint to request.
+            params (dict): The query parameters, without the API key.
+
+        Returns:
+            requests.Response: The successful response.
+        """
+        params = {**params, "api_key": self.api_key}
+        start = time.perf_counter()
+
+        for attempt in range(self.max_retries + 1):
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+
+            response, error = None, None
+            try:
+                response = self.session.get(url, params=params, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+
+            retryable = error is not None or response.status_code in RETRY_STATUS_CODES
+            if not retryable or attempt == self.max_retries:
+                latency = time.perf_counter() - start
+                failed = retryable or not response.ok
+                self.stats.record(latency, retries=attempt, failed=failed)
+                logger.info(f"GET {url} took {latency:.2f} seconds with {attempt} retries.")
+
+                if error is not None:
+                    raise error
+                response.raise_for_status()
+                return response
+
+            delay = self._retry_delay(attempt, response)
+            reason = error if error is not None else f"status code {response.status_code}"
+            logger.warning(f"Request to {url} failed with {reason}, retrying in {delay:.2f} seconds.")
+            time.sleep(delay)
+
+    def _get_content(self, cache_key: tuple, url: str, params: dict) -> bytes:
+        """
+        Returns the content of a response from the cache if possible, otherwise sends the request and caches it.
+        """
+        if self.cache is not None:
+            content = self.cache.get(cache_key)
+            if content is not None:
+                self.stats.record_cache_hit()
+                return content
+
+        content = self._get(url, params).content
+        if self.cache is not None:
+            self.cache.put(cache_key, content)
+        return content
+
+    def fetch_paper_meta_data(
+        self,
+        query: str,
+        base_url: str = "http://api.springernature.com/openaccess/json",
+        starting_record: int = 1,
+        max_records: int = 25
+    ) -> dict:
+        """
+        Retrieves the meta data for papers that match the query from the Springer Nature API.
+
+        Args:
+            query (str): Description of what kind of papers you want to collect.
+            base_url (str, optional): The endpoint of the Springer Nature API to get meta data.
+                Defaults to "http://api.springernature.com/openaccess/json".
+            starting_record (int, optional): The starting record number. Defaults to 1.
+                Will be set to 1 if input is lower.
+            max_records (int, optional): The max number of records you can query at a time.
+                Defaults to 25, and will be set to 25 if input is higher (or lower than 1).
+
+        Returns:
+            dict: The response from the API given as a JSON object.
+        """
+        if starting_record < 1:
+            starting_record = 1
+            logger.info("Recieved a value less than 1 for starting_record, setting it to 1.")
+        if not 1 <= max_records <= 25:
+            max_records = 25
+            logger.info("Recieved a value not between 1 and 25 for max_records, setting it to 25.")
+
+        params = {
+            "q": query,
+            "s": int(starting_record),
+            "p": int(max_records),
+        }
+
+        logger.info(f"Requesting paper meta data.")
+        content = self._get_content(("meta", base_url, query, params["s"], params["p"]), base_url, params)
+
+        return json.loads(content)
+
+    def fetch_full_text(
+        self,
+        doi: str,
+        base_url: str = "http://api.springernature.com/openaccess/jats"
+    ) -> list:
+        """
+        Retrieves the full text content of a journal article given its DOI.
+
+        Args:
+            doi (str): The DOI of the article.
+            base_url (str, optional): The base URL for the API. Defaults to "http://api.springernature.com/openaccess/jats".
+
+        Returns:
+            list: A list of dictionaries, where each dictionary contains the section title and body text of the article.
+        """
+        logger.info(f"Fetching full text for DOI: {doi}.")
+
+        content = self._get_content(("jats", doi), base_url, {"q": doi})
+
+        logger.info("Successfully retrieved the full text.")
+
+        return parse_jats_sections(content)
+
+
 def fetch_paper_meta_data(
-    query: str, 
-    api_key: str, 
-    base_url: str = "http://api.springernature.com/openaccess/json", 
-    starting_record: int = 1, 
+    query: str,
+    api_key: str,
+    base_url: str = "http://api.springernature.com/openaccess/json",
+    starting_record: int = 1,
     max_records: int = 25
-): 
-
+) -> dict:
     """
-    Retrieves the meta data for papers that match the query from the Springer Nature API.
+    One-off version of SpringerClient.fetch_paper_meta_data, prefer a shared client for more than a few requests.
 
     Args:
         query (str): Description of what kind of papers you want to collect.
-        api_key (str): Springer Nature API Key. Note: there is a free version and a premium version.
-        base_url (str, optional): The endpoint of the Springer Nature API to get meta data. 
+        api_key (str): Springer Nature API Key.
+        base_url (str, optional): The endpoint of the Springer Nature API to get meta data.
             Defaults to "http://api.springernature.com/openaccess/json".
-        starting_record (int, optional): The starting record number. Defaults to 1. 
-            Will be set to 1 if input is lower.
-        max_records (int, optional): The max number of records you can query at a time. 
-            Defaults to 25, and will be set to 25 if input is higher (or lower than 1).
+        starting_record (int, optional): The starting record number. Defaults to 1.
+        max_records (int, optional): The max number of records you can query at a time. Defaults to 25.
 
     Returns:
         dict: The response from the API given as a JSON object.
     """
-    if starting_record < 1:
-        starting_record = 1
-        logger.info("Recieved a value less than 1 for starting_record, setting it to 1.")
-    if not 1 <= max_records <= 25:
-        max_records = 25
-        logger.info("Recieved a value not between 1 and 25 for max_records, setting it to 25.")
-    
-    params = {
-        "q": query,
-        "api_key": api_key,
-        "s": starting_record,
-        "p": max_records,
-    }
-    
-    logger.info(f"Requesting paper meta data.")
-    response = requests.get(base_url, params=params)
-    response.raise_for_status()
-    
-    return response.json()
+    with SpringerClient(api_key) as client:
+        return client.fetch_paper_meta_data(query, base_url, starting_record, max_records)
 
 
 def fetch_full_text(
-    doi: str, 
-    api_key: str, 
-    base_url: str ="http://api.springernature.com/openaccess/jats"
-):
+    doi: str,
+    api_key: str,
+    base_url: str = "http://api.springernature.com/openaccess/jats"
+) -> list:
     """
-    Retrieves the full text content of a journal article given its DOI and API key.
+    One-off version of SpringerClient.fetch_full_text, prefer a shared client for more than a few requests.
 
     Args:
         doi (str): The DOI of the article.
@@ -64,46 +370,6 @@ def fetch_full_text(
 
     Returns:
         list: A list of dictionaries, where each dictionary contains the section title and body text of the article.
-        If the request fails, returns an error message.
     """
-    
-    logger.info(f"Fetching full text for DOI: {doi}.")
-    
-    params = {
-        "q": doi,
-        "api_key": api_key
-    }
-    
-    response = requests.get(base_url, params=params)
-    response.raise_for_status()
-    
-    logger.info("Successfully retrieved the full text.")
-    
-    xml_content = response.content
-    root = ET.fromstring(xml_content)
-
-    full_text = []
-    body_section = root.find(".//body")
-    
-    if body_section is not None:
-        logger.info("Found a body section in the XML, now extracting content.")
-        for section in body_section.findall(".//sec"):
-            section_title = section.find("title")
-            section_title_text = section_title.text if section_title is not None else ""
-            
-            paragraph_text = ""
-            for paragraph in section.findall(".//p"):
-                if paragraph.text:
-                    paragraph_text += paragraph.text
-            
-            full_text.append(
-                {
-                    "section": section_title_text, 
-                    "body": paragraph_text
-                    }
-            )
-    
-    logger.info("Returning the full text.")
-    
-    return full_text
-
+    with SpringerClient(api_key) as client:
+        return client.fetch_full_text(doi, base_url)
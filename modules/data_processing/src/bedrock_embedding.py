@@ -1,10 +1,21 @@
+import json
+import time
+import random
+import threading
 import boto3
-from langchain_aws import BedrockEmbeddings
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from .embeddings import document_to_record
+from .embedding_cache import EmbeddingCache
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+THROTTLING_ERROR_CODES = {"ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException"}
+
 def get_bedrock_embeddings(model_id: str = "amazon.titan-embed-text-v1"):
     """
     Get a BedrockEmbeddings object which is a client that can interact with the
@@ -18,6 +29,11 @@ def get_bedrock_embeddings(model_id: str = "amazon.titan-embed-text-v1"):
         BedrockEmbeddings: A client that can interact with the Bedrock embeddings
             service.
     """
+    try:
+        from langchain_aws import BedrockEmbeddings
+    except ImportError as e:
+        raise ImportError("BedrockEmbeddings needs the langchain-aws package: pip install langchain-aws") from e
+
     logger.info(f"Initializing BedrockEmbeddings with model_id: {model_id}")
     bedrock = boto3.client(service_name="bedrock-runtime")
     
@@ -29,14 +45,176 @@ def get_bedrock_embeddings(model_id: str = "amazon.titan-embed-text-v1"):
     return bedrock_embeddings
 
 
-def generate_bedrock_embeddings(documents, bedrock_embeddings):
+class AdaptiveConcurrency:
+    """
+    A concurrency limit that adapts to the service with AIMD (additive increase, multiplicative decrease),
+    as TCP does: every successful call raises the limit by 1 / limit, about one more call in flight per round
+    of calls, and a throttled call halves it, at most once per cooldown so a burst of throttles counts once.
+
+    Args:
+        initial (int): The initial number of calls in flight.
+        maximum (int): The max number of calls in flight.
+        minimum (int, optional): The min number of calls in flight. Defaults to 1.
+        cooldown (float, optional): The min number of seconds between two decreases. Defaults to 1.0.
+    """
+    def __init__(self, initial: int, maximum: int, minimum: int = 1, cooldown: float = 1.0):
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.maximum = maximum
+        self.minimum = minimum
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self._last_decrease = float("-inf")
+        self._condition = threading.Condition()
+
+    def acquire(self) -> None:
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled: bool = False) -> None:
+        with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._last_decrease = now
+                    logger.info(f"Throttled by Bedrock, concurrency lowered to {int(self.limit)}.")
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class BedrockEmbeddingExecutor:
+    """
+    Embeds texts with a Bedrock embedding model, many calls at a time. Bedrock embeds one text per call,
+    so the calls fan out over a pool of threads, and the number of calls in flight adapts to the account's
+    throughput with AIMD: throttled calls halve the concurrency and are retried after a jittered backoff.
+    The client is injected, so a local stub with an invoke_model method can stand in for bedrock-runtime.
+    Partial results are checkpointed by passing the executor's embed_documents to an EmbeddingCache,
+    see generate_bedrock_embeddings.
+
+    Args:
+        client: The bedrock-runtime client.
+        model_id (str, optional): The identifier of the model to use. Defaults to "amazon.titan-embed-text-v1".
+        max_concurrency (int, optional): The max number of calls in flight. Defaults to 16.
+        initial_concurrency (int, optional): The number of calls in flight to start with. Defaults to 4.
+        max_retries (int, optional): The max number of retries of a throttled call. Defaults to 8.
+        backoff_factor (float, optional): The base of the exponential backoff, in seconds. Defaults to 0.5.
+        max_backoff (float, optional): The max backoff, in seconds. Defaults to 20.0.
+    """
+    def __init__(
+        self,
+        client,
+        model_id: str = "amazon.titan-embed-text-v1",
+        max_concurrency: int = 16,
+        initial_concurrency: int = 4,
+        max_retries: int = 8,
+        backoff_factor: float = 0.5,
+        max_backoff: float = 20.0
+    ):
+        self.client = client
+        self.model_id = model_id
+        self.max_concurrency = max_concurrency
+        self.concurrency = AdaptiveConcurrency(initial_concurrency, max_concurrency)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_backoff = max_backoff
+        self._dimension: Optional[int] = None
+
+    @property
+    def dimension(self) -> int:
+        """
+        The dimension of the model's embeddings, from one call the first time it is needed.
+        """
+        if self._dimension is None:
+            self._dimension = len(self.embed_text("dimension"))
+        return self._dimension
+
+    def embed_text(self, text: str) -> List[float]:
+        """
+        Embeds one text, retrying throttled calls.
+
+        Args:
+            text (str): The text to embed.
+
+        Returns:
+            List[float]: The embedding.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.concurrency.acquire()
+            try:
+                response = self.client.invoke_model(
+                    modelId=self.model_id,
+                    body=json.dumps({"inputText": text}),
+                    accept="application/json",
+                    contentType="application/json"
+                )
+            except ClientError as e:
+                throttled = e.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+                self.concurrency.release(throttled=throttled)
+                if not throttled or attempt == self.max_retries:
+                    raise
+                delay = min(self.max_backoff, self.backoff_factor * 2 ** attempt)
+                time.sleep(random.uniform(delay / 2, delay))
+                continue
+            except BaseException:
+                self.concurrency.release()
+                raise
+            self.concurrency.release()
+            return json.loads(response["body"].read())["embedding"]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embeds the texts concurrently.
+
+        Args:
+            texts (List[str]): The texts to embed.
+
+        Returns:
+            List[List[float]]: The embeddings, in input order.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            return list(executor.map(self.embed_text, texts))
+
+
+def get_bedrock_embedding_executor(
+    model_id: str = "amazon.titan-embed-text-v1",
+    max_concurrency: int = 16
+) -> BedrockEmbeddingExecutor:
+    """
+    Returns a BedrockEmbeddingExecutor with a bedrock-runtime client sized for max_concurrency connections.
+    botocore does not retry calls itself, so that the executor sees the throttling and adapts to it.
+
+    Args:
+        model_id (str, optional): The identifier of the model to use. Defaults to "amazon.titan-embed-text-v1".
+        max_concurrency (int, optional): The max number of calls in flight. Defaults to 16.
+
+    Returns:
+        BedrockEmbeddingExecutor: The executor.
+    """
+    logger.info(f"Initializing BedrockEmbeddingExecutor with model_id: {model_id}")
+    client = boto3.client(
+        service_name="bedrock-runtime",
+        config=Config(max_pool_connections=max_concurrency, retries={"max_attempts": 1, "mode": "standard"})
+    )
+    return BedrockEmbeddingExecutor(client, model_id, max_concurrency)
+
+
+def generate_bedrock_embeddings(documents, bedrock_embeddings, cache: Optional[EmbeddingCache] = None, batch_size: int = 256):
     """
     Generate embeddings for a list of documents and return a new list of documents 
     with their respective embeddings, computed using the Bedrock embeddings service and titan model.
 
     Args:
         documents (list[Document]): The list of documents to generate embeddings for.
-        bedrock_embeddings (BedrockEmbeddings): The client that can interact with the Bedrock embeddings service.
+        bedrock_embeddings (BedrockEmbeddings): The client that can interact with the Bedrock embeddings service,
+            or a BedrockEmbeddingExecutor to embed the documents concurrently.
+        cache (EmbeddingCache, optional): The cache of already computed embeddings, opened with the Bedrock
+            model id. Only the documents missing from it are sent to the service, and new embeddings are stored
+            every batch_size documents, so an interrupted run resumes from its last checkpoint. Defaults to None.
+        batch_size (int, optional): The number of documents embedded between two checkpoints. Defaults to 256.
 
     Returns:
         list[dict]: A list of documents where each document has the embedding included as a key.
@@ -44,17 +222,15 @@ def generate_bedrock_embeddings(documents, bedrock_embeddings):
     logger.info("Generating embeddings for documents...")
     texts = [doc.page_content for doc in documents]
     
-    embeddings = bedrock_embeddings.embed_documents(texts)
+    if cache is not None:
+        embeddings = cache.embed(texts, bedrock_embeddings.embed_documents, batch_size).tolist()
+    else:
+        embeddings = bedrock_embeddings.embed_documents(texts)
     
     documents_with_embeddings = []
     
     for doc, embedding in zip(documents, embeddings):
-        doc_with_embedding = {
-            "embedding": embedding,
-            "text": doc.page_content,
-            "metadata": doc.metadata
-        }
-        documents_with_embeddings.append(doc_with_embedding)
+        documents_with_embeddings.append(document_to_record(doc, embedding))
     
     logger.info("Embeddings generated successfully.")
     return documents_with_embeddings
\ No newline at end of file
@@ -1,8 +1,89 @@
 TOKENIZER_MODEL_NAME = "tiiuae/falcon-7b-instruct"
 EMBEDDING_MODEL_ID = "sentence-transformers/all-MiniLM-L6-v2"
+# The model of the "bedrock" embedding backend, which embeds the chunks with Bedrock instead of EMBEDDING_MODEL_ID.
+# Titan reads up to 8k tokens, so its chunks are not bound by EMBEDDING_MODEL_ID's max_seq_length but sized to
+# BEDROCK_EMBEDDING_CHUNK_SIZE tokens of its tokenizer (Titan's own is not public), small enough for the search
+# to stay precise and well within a parent chunk.
+BEDROCK_EMBEDDING_MODEL_ID = "amazon.titan-embed-text-v1"
+BEDROCK_EMBEDDING_CHUNK_SIZE = 512
+
+# The papers to process: a single stored object, the manifest of an incremental or sharded ingestion run
+# (a key ending in "manifest.json"), or every object under a prefix (a key ending in "/").
+INPUT_KEY = 'vegan_or_plant_based_nutrition_data.json'
+
+# Papers are cut into parent chunks of PARENT_CHUNK_SIZE tokens of the LLM's tokenizer, used as prompt context,
+# and each parent into child chunks that fit the embedding model's max_seq_length, used for the search.
+PARENT_CHUNK_SIZE = 2048
+PARENT_CHUNK_OVERLAP = 200
+EMBEDDING_CHUNK_OVERLAP = 32
+
+# Chunks that are exact duplicates, or near duplicates with an estimated Jaccard similarity of their word
+# shingles of at least DEDUP_THRESHOLD, e.g. boilerplate funding or conflict of interest sections, are dropped
+# before embedding. What was dropped is reported in DEDUP_REPORT_PATH.
+DEDUP_THRESHOLD = 0.85
+DEDUP_NUM_PERM = 128
+DEDUP_SHINGLE_SIZE = 5
+DEDUP_REPORT_PATH = 'logs/dedup_report.json'
+
+# Embeddings can be projected to REDUCED_EMBEDDING_DIMENSION dimensions with a PCA fitted on the corpus embeddings,
+# which shrinks the index and speeds up the search, see dimensionality_reduction.dimension_benchmark for the recall
+# lost. The projection of a run is saved to EMBEDDING_PROJECTION_PATH, and goes live with the index it was built for:
+# copied to the INDEX_PROJECTION_PATH of its version of the OpenSearch index, or into the local index. Later runs
+# reuse the projection of the live index, and the queries are projected with it.
+REDUCED_EMBEDDING_DIMENSION = None
+EMBEDDING_PROJECTION_PATH = 'models/embedding_projection.npz'
+INDEX_PROJECTION_PATH = 'models/projections/{index_name}.npz'
 
 INDEX_NAME = 'vegan_papers_index'
 
+# INDEX_NAME is an alias to the live version of the index, "vegan_papers_index_v{N}".
+# A rebuild creates the next version and swaps the alias; this many previous versions are kept for a rollback.
+INDEX_VERSIONS_TO_KEEP = 2
+
+# Documents that could not be indexed, even after retries, are appended to this JSONL file.
+DEAD_LETTER_PATH = 'logs/failed_documents.jsonl'
+
+# Shards, replicas, refresh interval and HNSW parameters of the index, per deployment.
+# Vectors are stored L2-normalized, so the inner product space ranks like cosine similarity, but faster.
+# m is the number of links per node of the graph, ef_construction and ef_search the size of the candidate
+# lists when building and searching it: higher values give better recall at the cost of speed and memory.
+# compression stores the vectors of the graph as 'fp16' (faiss) or 'int8' (lucene) instead of float32; the
+# search can then rescore its candidates exactly, see OpenSearchBackend. Product quantization ('pq') needs a
+# trained model in OpenSearch, so it is only available to the local index, see LOCAL_INDEX_COMPRESSION.
+INDEX_PROFILES = {
+    # the single node domain of infra/data_processing, where replicas could never be assigned
+    'single_node': {
+        'number_of_shards': 1,
+        'number_of_replicas': 0,
+        'refresh_interval': '30s',
+        'engine': 'faiss',
+        'space_type': 'innerproduct',
+        'm': 16,
+        'ef_construction': 256,
+        'ef_search': 128,
+        'compression': None
+    },
+    'cluster': {
+        'number_of_shards': 2,
+        'number_of_replicas': 1,
+        'refresh_interval': '30s',
+        'engine': 'faiss',
+        'space_type': 'innerproduct',
+        'm': 24,
+        'ef_construction': 256,
+        'ef_search': 128,
+        'compression': None
+    }
+}
+
+INDEX_PROFILE = 'single_node'
+
+# The pipeline can write a local index instead, to search in process with LocalVectorBackend,
+# e.g. offline or in tests. Its optional HNSW graph uses the m and ef parameters of the index profile.
+LOCAL_INDEX_DIR = 'local_index'
+# 'fp16', 'int8' or 'pq' to search compressed codes of the local vectors, rescored exactly, or None.
+LOCAL_INDEX_COMPRESSION = None
+
 INDEX_BODY = {
     'settings': {
         'index': {
@@ -13,11 +94,18 @@ INDEX_BODY = {
         'properties': {
             'embedding': {
                 'type': 'knn_vector',
-                'dimension': None # Will be set later dynamically
+                'dimension': None, # Will be set later dynamically
+                'method': None # Will be set from the index profile
             },
             'text': {
                 'type': 'text'
             },
+            'parent_text': {
+                'type': 'text',
+                'index': False  # Only returned as the context of the matching chunks
+            },
+            'doc_type': {'type': 'keyword'},  # chunk, parent or paper
+            'parent_id': {'type': 'keyword'},  # Id of the parent record of a chunk
             'metadata': {
                 'properties': {
                     'content_type': {'type': 'keyword'},
@@ -1,26 +1,65 @@
 import json
+import gzip
+import zlib
+import codecs
 import boto3
 import logging
-from typing import List, Dict
+from itertools import chain, groupby
+from typing import Any, Iterable, Iterator, List, Dict, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
-def load_data_from_s3(
-    bucket_name: str, 
-    file_name: str = 'vegan_or_plant_based_nutrition_data.json'
-) -> List[Dict]:
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+def decompress(raw: bytes) -> bytes:
+    """
+    Decompresses gzip or zstd data, detected from its magic number. Other data is returned as is.
+
+    Args:
+        raw (bytes): The possibly compressed data.
+
+    Returns:
+        bytes: The uncompressed data.
+    """
+    if raw.startswith(GZIP_MAGIC):
+        return gzip.decompress(raw)
+    if raw.startswith(ZSTD_MAGIC):
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError("Reading zstd data needs the zstandard package: pip install zstandard") from e
+        return zstandard.ZstdDecompressor().stream_reader(raw).read()
+    return raw
+
+
+def parse_papers(raw: bytes) -> List[Dict]:
     """
-    Loads JSON data from an S3 bucket.
+    Parses stored papers, accepting both the legacy JSON array and (gzip or zstd compressed) JSON Lines.
+
+    Args:
+        raw (bytes): The content of the stored file.
+
+    Returns:
+        List[Dict]: The papers.
+    """
+    content = decompress(raw)
+    if content.lstrip()[:1] == b"[":
+        return json.loads(content)
+    return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+
+def read_s3_object(bucket_name: str, file_name: str) -> bytes:
+    """
+    Reads the full content of an S3 object.
 
     Args:
         bucket_name (str): The name of the S3 bucket.
-        file_name (str, optional): The name of the file object in the S3 bucket. Defaults to 'vegan_research_papers.json'.
+        file_name (str): The name of the file object in the S3 bucket.
 
     Returns:
-        List[Dict]: The loaded JSON data.
+        bytes: The content of the object.
     """
-    logger.info(f"Loading data from S3 bucket: {bucket_name}, file: {file_name}")
-    
     s3 = boto3.client('s3')
     response = s3.get_object(Bucket=bucket_name, Key=file_name)
 
@@ -29,12 +68,462 @@ def load_data_from_s3(
         raise RuntimeError(
             f"Failed to load data from S3, status code: {status_code}"
         )
+    return response['Body'].read()
+
+
+def load_data_from_s3(
+    bucket_name: str, 
+    file_name: str = 'vegan_or_plant_based_nutrition_data.json'
+) -> List[Dict]:
+    """
+    Loads JSON data from an S3 bucket. Both the legacy JSON array and (gzip or zstd compressed)
+    JSON Lines written by the data ingestion pipeline are accepted.
+
+    Args:
+        bucket_name (str): The name of the S3 bucket.
+        file_name (str, optional): The name of the file object in the S3 bucket. Defaults to 'vegan_research_papers.json'.
+
+    Returns:
+        List[Dict]: The loaded JSON data.
+    """
+    logger.info(f"Loading data from S3 bucket: {bucket_name}, file: {file_name}")
     
-    data = json.loads(response['Body'].read())
+    if file_name.endswith(".parquet"):
+        return load_data_from_parquet(file_name, bucket_name)
+    
+    data = parse_papers(read_s3_object(bucket_name, file_name))
     logger.info("Data loaded successfully from S3.")
     return data
 
 
+def load_data_from_file(path: str) -> List[Dict]:
+    """
+    Local file system version of load_data_from_s3, for offline runs.
+
+    Args:
+        path (str): The path of the stored papers.
+
+    Returns:
+        List[Dict]: The loaded JSON data.
+    """
+    logger.info(f"Loading data from file: {path}")
+    if path.endswith(".parquet"):
+        return load_data_from_parquet(path)
+    with open(path, "rb") as f:
+        return parse_papers(f.read())
+
+
+def load_sections_from_parquet(
+    file_name: str,
+    bucket_name: Optional[str] = None,
+    columns: Optional[List[str]] = None,
+    filters: Optional[List[Tuple[str, str, Any]]] = None
+) -> List[Dict]:
+    """
+    Loads section rows from the Parquet layout of the corpus. Only the requested columns are read, and the
+    filters are pushed down to the row groups, so e.g. a meta data query never decodes the section bodies.
+
+    Args:
+        file_name (str): The name of the file object in the S3 bucket, or the local path.
+        bucket_name (str, optional): The name of the S3 bucket. Defaults to None, for a local file.
+        columns (List[str], optional): The columns to read, e.g. ["doi", "title"]. Defaults to None, all columns.
+        filters (List[Tuple[str, str, Any]], optional): Predicates on the columns, e.g.
+            [("publication_date", ">=", datetime.date(2020, 1, 1)), ("content_type", "=", "Article")].
+            Defaults to None.
+
+    Returns:
+        List[Dict]: One dictionary per section row, with the requested columns.
+    """
+    try:
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("Reading the Parquet layout needs the pyarrow package: pip install pyarrow") from e
+
+    if bucket_name:
+        from pyarrow import fs
+        filesystem, path = fs.S3FileSystem(), f"{bucket_name}/{file_name}"
+    else:
+        filesystem, path = None, file_name
+
+    logger.info(f"Loading columns {columns or 'all'} from {path} with filters {filters}")
+    table = pq.read_table(path, columns=columns, filters=filters, filesystem=filesystem)
+    return table.to_pylist()
+
+
+def group_rows_into_papers(rows: Iterable[Dict]) -> Iterator[Dict]:
+    """
+    Rebuilds papers from the section rows of the Parquet layout, in the same format as load_data_from_s3.
+
+    Args:
+        rows (Iterable[Dict]): Section rows with all the columns of the layout.
+
+    Yields:
+        Dict: The papers, each with its "meta_data" and "content".
+    """
+    # The sections of a paper are written next to each other, so grouping consecutive rows rebuilds the papers.
+    for _, paper_rows in groupby(rows, key=lambda row: row["doi"]):
+        paper_rows = list(paper_rows)
+        first_row = paper_rows[0]
+        publication_date = first_row["publication_date"]
+        meta_data = {
+            "content_type": first_row["content_type"],
+            "url": first_row["url"],
+            "title": first_row["title"],
+            "publication_name": first_row["publication_name"],
+            "doi": first_row["doi"],
+            "publication_date": publication_date.isoformat() if publication_date else None,
+            "starting_page": first_row["starting_page"],
+            "ending_page": first_row["ending_page"],
+            "open_access": first_row["open_access"],
+            "abstract": json.loads(first_row["abstract"]),
+        }
+        content = [
+            {"section": row["section"], "body": row["body"]}
+            for row in paper_rows
+            if row["section_index"] is not None
+        ]
+        yield {"meta_data": meta_data, "content": content}
+
+
+def load_data_from_parquet(
+    file_name: str,
+    bucket_name: Optional[str] = None,
+    filters: Optional[List[Tuple[str, str, Any]]] = None
+) -> List[Dict]:
+    """
+    Loads papers from the Parquet layout of the corpus, in the same format as load_data_from_s3,
+    e.g. to reprocess only the papers published after a given date.
+
+    Args:
+        file_name (str): The name of the file object in the S3 bucket, or the local path.
+        bucket_name (str, optional): The name of the S3 bucket. Defaults to None, for a local file.
+        filters (List[Tuple[str, str, Any]], optional): Predicates pushed down to the Parquet reader,
+            see load_sections_from_parquet. Defaults to None.
+
+    Returns:
+        List[Dict]: The papers, each with its "meta_data" and "content".
+    """
+    rows = load_sections_from_parquet(file_name, bucket_name, filters=filters)
+    data = list(group_rows_into_papers(rows))
+
+    logger.info(f"Loaded {len(data)} papers from {file_name}.")
+    return data
+
+
+def iter_decompressed_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Streaming version of decompress, for data that arrives in chunks.
+
+    Args:
+        chunks (Iterable[bytes]): The possibly compressed data, in chunks.
+
+    Yields:
+        bytes: The uncompressed data, in chunks.
+    """
+    chunks = iter(chunks)
+    head = b""
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= len(ZSTD_MAGIC):
+            break
+
+    if head.startswith(GZIP_MAGIC):
+        decompressor = zlib.decompressobj(wbits=47)  # 47 detects the gzip header
+    elif head.startswith(ZSTD_MAGIC):
+        try:
+            import zstandard
+        except ImportError as e:
+            raise ImportError("Reading zstd data needs the zstandard package: pip install zstandard") from e
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+    else:
+        yield head
+        yield from chunks
+        return
+
+    for chunk in chain([head], chunks):
+        yield decompressor.decompress(chunk)
+    yield decompressor.flush()
+
+
+def iter_json_records(chunks: Iterable[bytes]) -> Iterator[Dict]:
+    """
+    Incrementally parses stored papers from chunks of bytes, yielding each paper as soon as it is complete.
+    Accepts both the legacy JSON array and (gzip or zstd compressed) JSON Lines, like parse_papers,
+    but only ever holds one chunk and one unfinished paper in memory.
+
+    Args:
+        chunks (Iterable[bytes]): The content of the stored file, in chunks.
+
+    Yields:
+        Dict: The papers, one at a time.
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    is_array = None
+
+    for chunk in chain(iter_decompressed_chunks(chunks), [None]):
+        final = chunk is None
+        buffer += text_decoder.decode(chunk or b"", final=final)
+
+        if is_array is None:
+            buffer = buffer.lstrip()
+            if not buffer:
+                continue
+            is_array = buffer[0] == "["
+            if is_array:
+                buffer = buffer[1:]
+
+        if not is_array:
+            *lines, buffer = buffer.split("\n")
+            if final:
+                lines.append(buffer)
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line)
+            continue
+
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position == len(buffer) or buffer[position] == "]":
+                break
+            try:
+                record, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if final:
+                    raise
+                break  # the next paper is not complete yet, wait for more data
+            yield record
+        buffer = buffer[position:]
+
+
+def iter_jsonl_range(chunks: Iterable[bytes], start: int, end: int) -> Iterator[Dict]:
+    """
+    Parses the lines of an uncompressed JSON Lines file that start within a byte range, so a file can be split
+    into ranges read independently. The chunks must begin at byte max(start - 1, 0) of the file and may go past end.
+    A line belongs to the range its first byte is in, so each line is read by exactly one range.
+
+    Args:
+        chunks (Iterable[bytes]): The content of the file from byte max(start - 1, 0), in chunks.
+        start (int): The first byte of the range.
+        end (int): The last byte of the range, inclusive.
+
+    Yields:
+        Dict: The papers whose line starts within the range.
+    """
+    offset = max(start - 1, 0)
+    # Starting one byte early means a line that starts exactly at start is preceded by a newline we skip.
+    skip_first_line = start > 0
+    buffer = b""
+
+    for chunk in chain(chunks, [None]):
+        if chunk is not None:
+            buffer += chunk
+            lines = buffer.split(b"\n")
+            buffer = lines.pop()
+        else:
+            lines, buffer = [buffer], b""
+
+        for line in lines:
+            line_start = offset
+            offset += len(line) + 1
+            if skip_first_line:
+                skip_first_line = False
+                continue
+            if line_start > end:
+                return
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_data_from_s3(
+    bucket_name: str,
+    file_name: str = 'vegan_or_plant_based_nutrition_data.json',
+    chunk_size: int = 1024 * 1024,
+    byte_range: Optional[Tuple[int, int]] = None
+) -> Iterator[Dict]:
+    """
+    Streaming version of load_data_from_s3, which yields the papers one at a time as the S3 body is read,
+    so downstream stages can start right away and memory does not grow with the corpus.
+
+    Args:
+        bucket_name (str): The name of the S3 bucket.
+        file_name (str, optional): The name of the file object in the S3 bucket.
+            Defaults to 'vegan_or_plant_based_nutrition_data.json'.
+        chunk_size (int, optional): The number of bytes read from the body at a time. Defaults to 1 MB.
+        byte_range (Tuple[int, int], optional): The first and last byte of the part of the file to read,
+            only supported for uncompressed JSON Lines. See get_byte_ranges. Defaults to None, the whole file.
+
+    Yields:
+        Dict: The papers, one at a time.
+    """
+    logger.info(f"Streaming data from S3 bucket: {bucket_name}, file: {file_name}, range: {byte_range}")
+
+    if file_name.endswith(".parquet"):
+        yield from iter_data_from_parquet(file_name, bucket_name)
+        return
+
+    s3 = boto3.client('s3')
+    if byte_range is None:
+        response = s3.get_object(Bucket=bucket_name, Key=file_name)
+    else:
+        if not file_name.endswith(".jsonl"):
+            raise ValueError("byte_range is only supported for uncompressed JSON Lines files.")
+        response = s3.get_object(Bucket=bucket_name, Key=file_name, Range=f"bytes={max(byte_range[0] - 1, 0)}-")
+
+    body = response['Body']
+    try:
+        if byte_range is None:
+            yield from iter_json_records(body.iter_chunks(chunk_size))
+        else:
+            yield from iter_jsonl_range(body.iter_chunks(chunk_size), *byte_range)
+    finally:
+        body.close()
+
+
+def iter_batches_from_s3(
+    bucket_name: str,
+    manifest_key: str = 'vegan_or_plant_based_nutrition_data/manifest.json'
+) -> Iterator[Dict]:
+    """
+    Streams every batch, or shard, listed in the manifest written by a checkpointed or sharded ingestion run,
+    one paper at a time.
+
+    Args:
+        bucket_name (str): The name of the S3 bucket.
+        manifest_key (str, optional): The key of the manifest in the S3 bucket.
+            Defaults to 'vegan_or_plant_based_nutrition_data/manifest.json'.
+
+    Yields:
+        Dict: The papers of all batches, in the order they were ingested.
+    """
+    manifest = json.loads(read_s3_object(bucket_name, manifest_key))
+    logger.info(f"Streaming {len(manifest['batches'])} batches listed in {manifest_key}")
+    for batch_name in manifest['batches']:
+        yield from iter_data_from_s3(bucket_name, batch_name)
+
+
+def list_s3_objects(bucket_name: str, prefix: str) -> List[str]:
+    """
+    Returns the keys of the stored papers under a prefix, in order, leaving out manifests.
+
+    Args:
+        bucket_name (str): The name of the S3 bucket.
+        prefix (str): The prefix of the keys.
+
+    Returns:
+        List[str]: The keys.
+    """
+    paginator = boto3.client('s3').get_paginator('list_objects_v2')
+    keys = [
+        content['Key']
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix)
+        for content in page.get('Contents', [])
+    ]
+    return sorted(key for key in keys if not key.endswith("/") and not key.endswith("manifest.json"))
+
+
+def iter_input_from_s3(
+    bucket_name: str,
+    input_key: str = 'vegan_or_plant_based_nutrition_data.json'
+) -> Iterator[Dict]:
+    """
+    Streams the papers of the input of the data processing pipeline, one at a time, which is either a single
+    object, in any format iter_data_from_s3 reads, a manifest of batches or shards (a key ending in
+    "manifest.json"), or every object under a prefix (a key ending in "/").
+
+    Args:
+        bucket_name (str): The name of the S3 bucket.
+        input_key (str, optional): The key of the object, manifest or prefix.
+            Defaults to 'vegan_or_plant_based_nutrition_data.json'.
+
+    Yields:
+        Dict: The papers, one at a time.
+    """
+    if input_key.endswith("manifest.json"):
+        yield from iter_batches_from_s3(bucket_name, input_key)
+    elif input_key.endswith("/"):
+        keys = list_s3_objects(bucket_name, input_key)
+        logger.info(f"Streaming {len(keys)} objects under {input_key}")
+        for key in keys:
+            yield from iter_data_from_s3(bucket_name, key)
+    else:
+        yield from iter_data_from_s3(bucket_name, input_key)
+
+
+def iter_data_from_file(path: str, chunk_size: int = 1024 * 1024) -> Iterator[Dict]:
+    """
+    Local file system version of iter_data_from_s3, for offline runs.
+
+    Args:
+        path (str): The path of the stored papers.
+        chunk_size (int, optional): The number of bytes read at a time. Defaults to 1 MB.
+
+    Yields:
+        Dict: The papers, one at a time.
+    """
+    if path.endswith(".parquet"):
+        yield from iter_data_from_parquet(path)
+        return
+
+    with open(path, "rb") as f:
+        yield from iter_json_records(iter(lambda: f.read(chunk_size), b""))
+
+
+def iter_data_from_parquet(
+    file_name: str,
+    bucket_name: Optional[str] = None,
+    filters: Optional[List[Tuple[str, str, Any]]] = None
+) -> Iterator[Dict]:
+    """
+    Streaming version of load_data_from_parquet, which reads one record batch at a time.
+
+    Args:
+        file_name (str): The name of the file object in the S3 bucket, or the local path.
+        bucket_name (str, optional): The name of the S3 bucket. Defaults to None, for a local file.
+        filters (List[Tuple[str, str, Any]], optional): Predicates pushed down to the Parquet reader,
+            see load_sections_from_parquet. Defaults to None.
+
+    Yields:
+        Dict: The papers, one at a time.
+    """
+    try:
+        import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise ImportError("Reading the Parquet layout needs the pyarrow package: pip install pyarrow") from e
+
+    if bucket_name:
+        from pyarrow import fs
+        filesystem, path = fs.S3FileSystem(), f"{bucket_name}/{file_name}"
+    else:
+        filesystem, path = None, file_name
+
+    dataset = ds.dataset(path, format="parquet", filesystem=filesystem)
+    expression = pq.filters_to_expression(filters) if filters else None
+    rows = (row for batch in dataset.to_batches(filter=expression) for row in batch.to_pylist())
+    yield from group_rows_into_papers(rows)
+
+
+def get_byte_ranges(bucket_name: str, file_name: str, num_ranges: int) -> List[Tuple[int, int]]:
+    """
+    Splits an S3 object into byte ranges of about the same size, to be read by iter_data_from_s3 in parallel.
+
+    Args:
+        bucket_name (str): The name of the S3 bucket.
+        file_name (str): The name of the file object in the S3 bucket.
+        num_ranges (int): The number of ranges.
+
+    Returns:
+        List[Tuple[int, int]]: The first and last byte of each range.
+    """
+    size = boto3.client('s3').head_object(Bucket=bucket_name, Key=file_name)['ContentLength']
+    range_size = -(-size // num_ranges)
+    return [(start, min(start + range_size, size) - 1) for start in range(0, size, range_size)]
+
+
 if __name__ == "__main__":
     import os
     from dotenv import load_dotenv, find_dotenv
@@ -1,13 +1,234 @@
 import os
 import logging
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Union
 from dotenv import load_dotenv, find_dotenv
-from .config import INDEX_NAME, TOKENIZER_MODEL_NAME, EMBEDDING_MODEL_ID
-from .data_loading import load_data_from_s3
-from .data_transformer import get_full_data, convert_to_doc_format, chunk_doc, chunk_documents_by_tokens
-from .embeddings import get_embedding_model, generate_embeddings
-from .vector_storage import opensearch_client, create_index, index_documents
+from transformers import AutoTokenizer
+from .config import INPUT_KEY, INDEX_NAME, TOKENIZER_MODEL_NAME, EMBEDDING_MODEL_ID, BEDROCK_EMBEDDING_MODEL_ID, BEDROCK_EMBEDDING_CHUNK_SIZE, PARENT_CHUNK_SIZE, PARENT_CHUNK_OVERLAP, EMBEDDING_CHUNK_OVERLAP, DEDUP_THRESHOLD, DEDUP_REPORT_PATH, LOCAL_INDEX_DIR, LOCAL_INDEX_COMPRESSION, REDUCED_EMBEDDING_DIMENSION, EMBEDDING_PROJECTION_PATH
+from .data_loading import iter_input_from_s3
+from .data_transformer import Chunk, chunk_papers_compact, chunk_papers_in_parallel
+from .embeddings import get_embedding_model, get_embedding_chunk_size, generate_embeddings, get_paper_and_parent_records
+from .embedding_cache import get_embedding_cache, get_cache_namespace
+from .embedding_engine import get_embedding_engine
+from .bedrock_embedding import get_bedrock_embedding_executor, generate_bedrock_embeddings
+from .deduplication import get_deduplicator
+from .dimensionality_reduction import load_projection, project_records
+from .streaming import batched, threaded_map
+from .vector_storage import opensearch_client, load_index_projection, index_is_up_to_date, build_index_version, get_indexed_chunk_ids, delete_documents, index_documents
+from .retrieval_backends import PROJECTION_FILE, export_local_index
 from ...utils.logger import setup_logger
 
+logger = logging.getLogger(__name__)
+
+
+def get_encoder(embedding_backend: str, embedding_batch_size: int, embedding_threads: Optional[int]):
+    """
+    Returns the encoder of the embedding backend, the size of the chunks it embeds whole, in tokens of
+    EMBEDDING_MODEL_ID's tokenizer, the model id its vectors are cached under, and the function that embeds
+    chunks into records with it. The sentence transformer is only loaded if it is the one that embeds.
+    """
+    if embedding_backend == "bedrock":
+        # Bedrock embeds one text per call, the executor fans the calls out and adapts to throttling
+        executor = get_bedrock_embedding_executor(BEDROCK_EMBEDDING_MODEL_ID)
+        return (
+            executor,
+            BEDROCK_EMBEDDING_CHUNK_SIZE,
+            get_cache_namespace(BEDROCK_EMBEDDING_MODEL_ID, embedding_backend),
+            generate_bedrock_embeddings
+        )
+    # the chunks are sized to fit the input of the sentence transformer
+    embedding_model = get_embedding_model(EMBEDDING_MODEL_ID)
+    embedding_engine = get_embedding_engine(
+        embedding_model, EMBEDDING_MODEL_ID, embedding_backend, embedding_batch_size, embedding_threads
+    )
+    return (
+        embedding_engine,
+        get_embedding_chunk_size(embedding_model),
+        get_cache_namespace(EMBEDDING_MODEL_ID, embedding_backend),
+        generate_embeddings
+    )
+
+
+def chunk_paper_batches(
+    data: Iterable[dict],
+    embedding_chunk_size: int,
+    num_workers: int = 1,
+    papers_per_batch: int = 16,
+    max_prefetch: int = 2
+) -> Iterator[List[Chunk]]:
+    """
+    Transforms and cuts the papers into compact parent and child chunks, papers_per_batch papers at a time,
+    in num_workers worker processes, or in a thread of this process if num_workers is 1.
+
+    Args:
+        data (Iterable[dict]): The papers.
+        embedding_chunk_size (int): The size of each embedded chunk, in tokens of EMBEDDING_MODEL_ID's tokenizer,
+            see get_encoder.
+        num_workers (int, optional): The number of processes chunking papers. Defaults to 1.
+        papers_per_batch (int, optional): The number of papers chunked together. Defaults to 16.
+        max_prefetch (int, optional): The max number of chunked batches waiting to be consumed. Defaults to 2.
+
+    Returns:
+        Iterator[List[Chunk]]: The chunks of each batch, in the order of the papers.
+    """
+    if num_workers > 1:
+        return chunk_papers_in_parallel(
+            data,
+            TOKENIZER_MODEL_NAME,
+            num_workers,
+            papers_per_batch,
+            chunk_size=PARENT_CHUNK_SIZE,
+            chunk_overlap=PARENT_CHUNK_OVERLAP,
+            embedding_model_name=EMBEDDING_MODEL_ID,
+            embedding_chunk_size=embedding_chunk_size,
+            embedding_chunk_overlap=EMBEDDING_CHUNK_OVERLAP
+        )
+    tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_MODEL_NAME)
+    # a tokenizer of its own, the embedding thread uses the model's one at the same time
+    embedding_tokenizer = AutoTokenizer.from_pretrained(EMBEDDING_MODEL_ID)
+
+    def chunk_papers(papers):
+        # compact chunks share the meta data of their paper and the text of their parent instead of copying them
+        return chunk_papers_compact(
+            papers,
+            embedding_tokenizer,
+            embedding_chunk_size,
+            EMBEDDING_CHUNK_OVERLAP,
+            parent_tokenizer=tokenizer,
+            parent_chunk_size=PARENT_CHUNK_SIZE,
+            parent_chunk_overlap=PARENT_CHUNK_OVERLAP
+        )
+
+    return threaded_map(chunk_papers, batched(data, papers_per_batch), max_prefetch)
+
+
+def get_index_target(
+    INDEX_NAME: str,
+    OPENSEARCH_ENDPOINT: str,
+    AWS_ACCESS_KEY: str,
+    AWS_SECRET_KEY: str,
+    AWS_REGION: str,
+    retrieval_backend: str,
+    embedding_dimension: int,
+    incremental: bool,
+    reduced_embedding_dimension: Optional[int],
+    local_index_dir: str
+):
+    """
+    Returns the OpenSearch client to index into, None for a local index, the projection the embeddings are
+    reduced with, None to fit one on them or to keep them whole, and whether the live index is updated in
+    place instead of rebuilt. The projection of the run is saved to EMBEDDING_PROJECTION_PATH, from which
+    write_index puts it live with the index.
+    """
+    if retrieval_backend == "local":
+        client = None
+        projection = load_projection(os.path.join(local_index_dir, PROJECTION_FILE))
+    else:
+        client = opensearch_client(
+            OPENSEARCH_ENDPOINT, 
+            AWS_ACCESS_KEY, 
+            AWS_SECRET_KEY, 
+            AWS_REGION
+        )
+        projection = load_index_projection(client, INDEX_NAME)
+    # the projection of the live index is reused, as its vectors were projected with it, unless it reduces
+    # the embeddings of another model or to another dimension
+    if not reduced_embedding_dimension or projection is None or (
+        projection.input_dimension, projection.dimension) != (embedding_dimension, reduced_embedding_dimension):
+        projection = None
+    if projection is not None:
+        projection.save(EMBEDDING_PROJECTION_PATH)
+    if client is None:
+        # the local index is always rewritten whole, the embedding cache keeps that cheap
+        return None, projection, False
+    # a new projection changes every vector, so the index is rebuilt
+    incremental = incremental and (projection is not None or not reduced_embedding_dimension)
+    # an incremental run updates the live index in place, unless it has to be rebuilt for a new mapping
+    index_dimension = reduced_embedding_dimension or embedding_dimension
+    return client, projection, incremental and index_is_up_to_date(client, INDEX_NAME, index_dimension)
+
+
+def iter_new_records(
+    chunk_batches: Iterable[List[Chunk]],
+    deduplicator,
+    indexed_ids: Dict[str, str],
+    current_ids: Set[str]
+) -> Iterator[Union[dict, Chunk]]:
+    """
+    Yields the records of the papers and parent chunks of each batch first, then its chunks to embed, skipping
+    duplicate chunks and the parents and chunks already in the index. Papers are always updated, their meta data
+    may have changed while their text did not. The ids of the current records are added to current_ids, so the
+    stale ones can be deleted at the end, see delete_stale_records.
+    """
+    for chunk_batch in chunk_batches:
+        if deduplicator is not None:
+            # duplicates are looked for in the previous batches too
+            chunk_batch = deduplicator.deduplicate(chunk_batch)
+        for record in get_paper_and_parent_records(chunk_batch, current_ids):
+            if record['doc_type'] == 'paper' or record['id'] not in indexed_ids:
+                yield record
+        for chunk in chunk_batch:
+            current_ids.add(chunk.chunk_id)
+            if chunk.chunk_id not in indexed_ids:
+                yield chunk
+
+
+def embed_records(batch: List[Union[dict, Chunk]], embed, embedding_engine, embedding_cache) -> List[dict]:
+    """
+    Embeds the chunks of a batch of iter_new_records, and returns the paper and parent records, which have no
+    embedding, followed by the records of the embedded chunks.
+    """
+    chunks = [item for item in batch if isinstance(item, Chunk)]
+    side_records = [item for item in batch if not isinstance(item, Chunk)]
+    # chunks embedded by a previous run are read from the cache instead of encoded again
+    return side_records + embed(chunks, embedding_engine, embedding_cache)
+
+
+def write_index(
+    embedded_docs: Iterable[dict],
+    client,
+    INDEX_NAME: str,
+    index_dimension: int,
+    incremental: bool,
+    indexing_threads: int,
+    local_index_dir: str,
+    local_index_hnsw: bool,
+    local_index_compression: Optional[str],
+    projection_path: Optional[str]
+) -> int:
+    """
+    Writes the embedded documents to the local index if client is None, into the live OpenSearch index if
+    incremental, or else into a new version of the index, which the INDEX_NAME alias is swapped to once it is
+    validated. The documents are pulled as fast as they are written, so they can be a generator. The projection
+    artifact at projection_path, if the embeddings were reduced, goes live with the index it was built for.
+
+    Returns:
+        int: The number of documents indexed.
+    """
+    if client is None:
+        return export_local_index(
+            local_index_dir,
+            embedded_docs,
+            local_index_hnsw,
+            compression=local_index_compression,
+            projection_path=projection_path
+        )
+    if incremental:
+        return index_documents(client, INDEX_NAME, embedded_docs, thread_count=indexing_threads)
+    return build_index_version(
+        client, INDEX_NAME, index_dimension, embedded_docs, indexing_threads, projection_path=projection_path
+    )
+
+
+def delete_stale_records(client, INDEX_NAME: str, indexed_ids: Dict[str, str], current_ids: Set[str]) -> None:
+    """
+    Deletes the records of the index that are no longer current, e.g. the chunks of changed or removed papers,
+    once the new ones are in, so the index stays searchable throughout an incremental run.
+    """
+    stale_ids = [chunk_id for chunk_id in indexed_ids if chunk_id not in current_ids]
+    logger.info(f"{len(stale_ids)} stale records to delete from index '{INDEX_NAME}'.")
+    if stale_ids:
+        delete_documents(client, INDEX_NAME, stale_ids)
+
 
 def data_processing(
     INDEX_NAME: str,
@@ -15,50 +236,197 @@ def data_processing(
     OPENSEARCH_ENDPOINT: str,
     AWS_ACCESS_KEY: str,
     AWS_SECRET_KEY: str,
-    AWS_REGION: str
+    AWS_REGION: str,
+    num_workers: int = 1,
+    embedding_cache_path: Optional[str] = None,
+    embedding_backend: str = "torch",
+    embedding_batch_size: int = 64,
+    embedding_threads: Optional[int] = None,
+    incremental: bool = False,
+    indexing_threads: int = 4,
+    dedup_threshold: Optional[float] = DEDUP_THRESHOLD,
+    retrieval_backend: str = "opensearch",
+    local_index_dir: str = LOCAL_INDEX_DIR,
+    local_index_hnsw: bool = False,
+    local_index_compression: Optional[str] = LOCAL_INDEX_COMPRESSION,
+    reduced_embedding_dimension: Optional[int] = REDUCED_EMBEDDING_DIMENSION,
+    input_key: str = INPUT_KEY
 ):
+    """
+    Runs the pipeline one stage at a time, each stage on all the papers, see streaming_data_processing for the
+    arguments. It shares its stages with the streaming pipeline, and holds all the chunks and embeddings in memory.
+    """
     logger = setup_logger("data_processing", "data_processing.log")
     logger.info("Starting main data processing function.")
     
-    data = load_data_from_s3(AWS_BUCKET_NAME)
-    logger.info("Data loaded successfully from S3.")
+    # papers are streamed from S3 one at a time, so transforming starts before the whole file is read
+    data = iter_input_from_s3(AWS_BUCKET_NAME, input_key)
     
     # only load first 50 papers
     # if you use bedrock embeddings from a previous version this will prevent too many token errors
-    #data = data[0:50]
-    
-    full_data = get_full_data(data)
-    logger.info("Full data aggregation complete.")
-    
-    documents = convert_to_doc_format(full_data)
-    logger.info("Conversion to Langchain Document format complete.")
-        
-    chunked_docs = chunk_documents_by_tokens(documents, TOKENIZER_MODEL_NAME)
-    logger.info("Chunking documents complete.")
+    #data = itertools.islice(data, 50)
     
+    # the embedding model is loaded first, the chunks are sized to fit its input
     logger.info("Initializing embedding model...")
-    embedding_model = get_embedding_model(EMBEDDING_MODEL_ID)
+    embedding_engine, embedding_chunk_size, cache_namespace, embed = get_encoder(
+        embedding_backend, embedding_batch_size, embedding_threads
+    )
     
-    logger.info("Generating embeddings...")
-    embedded_docs = generate_embeddings(chunked_docs, embedding_model)
+    chunked_docs = [
+        doc
+        for chunk_batch in chunk_paper_batches(data, embedding_chunk_size, num_workers)
+        for doc in chunk_batch
+    ]
+    logger.info(f"Chunking documents complete, chunks of at most {embedding_chunk_size} embedding tokens.")
     
-    client = opensearch_client(
-        OPENSEARCH_ENDPOINT, 
-        AWS_ACCESS_KEY, 
-        AWS_SECRET_KEY, 
-        AWS_REGION
+    index_dimension = reduced_embedding_dimension or embedding_engine.dimension
+    client, projection, incremental = get_index_target(
+        INDEX_NAME, OPENSEARCH_ENDPOINT, AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_REGION,
+        retrieval_backend, embedding_engine.dimension, incremental, reduced_embedding_dimension, local_index_dir
     )
     
-    embedding_dimension = len(embedded_docs[0]['embedding'])
+    # exact and near duplicate chunks, e.g. boilerplate sections, are neither embedded nor indexed, and on an
+    # incremental run only the chunks missing from the index are
+    deduplicator = get_deduplicator(dedup_threshold)
+    indexed_ids = get_indexed_chunk_ids(client, INDEX_NAME) if incremental else {}
+    current_ids = set()
+    new_records = list(iter_new_records([chunked_docs], deduplicator, indexed_ids, current_ids))
+    if deduplicator is not None:
+        deduplicator.write_report(DEDUP_REPORT_PATH)
     
-    create_index(client, INDEX_NAME, embedding_dimension)
-    logger.info(f"Index '{INDEX_NAME}' created successfully.")
+    logger.info("Generating embeddings...")
+    embedding_cache = get_embedding_cache(embedding_cache_path, cache_namespace)
+    embedded_docs = embed_records(new_records, embed, embedding_engine, embedding_cache)
+    if embedding_cache is not None:
+        embedding_cache.close()
+    if reduced_embedding_dimension:
+        # the cache keeps the full embeddings, so a new projection does not need them encoded again
+        embedded_docs = list(project_records(
+            embedded_docs, reduced_embedding_dimension, projection, EMBEDDING_PROJECTION_PATH
+        ))
     
-    number_of_documents_indexed = index_documents(client, INDEX_NAME, embedded_docs)
+    number_of_documents_indexed = write_index(
+        embedded_docs, client, INDEX_NAME, index_dimension, incremental, indexing_threads,
+        local_index_dir, local_index_hnsw, local_index_compression,
+        EMBEDDING_PROJECTION_PATH if reduced_embedding_dimension else None
+    )
+    if incremental:
+        delete_stale_records(client, INDEX_NAME, indexed_ids, current_ids)
     logger.info(f"Indexed {number_of_documents_indexed} documents into index '{INDEX_NAME}'.")
 
     logger.info("Finished data processing pipeline.")
 
+
+def streaming_data_processing(
+    INDEX_NAME: str,
+    AWS_BUCKET_NAME: str,
+    OPENSEARCH_ENDPOINT: str,
+    AWS_ACCESS_KEY: str,
+    AWS_SECRET_KEY: str,
+    AWS_REGION: str,
+    papers_per_batch: int = 16,
+    chunks_per_batch: int = 256,
+    max_prefetch: int = 2,
+    num_workers: int = 1,
+    embedding_cache_path: Optional[str] = None,
+    embedding_backend: str = "torch",
+    embedding_batch_size: int = 64,
+    embedding_threads: Optional[int] = None,
+    incremental: bool = False,
+    indexing_threads: int = 4,
+    dedup_threshold: Optional[float] = DEDUP_THRESHOLD,
+    retrieval_backend: str = "opensearch",
+    local_index_dir: str = LOCAL_INDEX_DIR,
+    local_index_hnsw: bool = False,
+    local_index_compression: Optional[str] = LOCAL_INDEX_COMPRESSION,
+    reduced_embedding_dimension: Optional[int] = REDUCED_EMBEDDING_DIMENSION,
+    input_key: str = INPUT_KEY
+):
+    """
+    Streaming version of data_processing. Papers are loaded, transformed, chunked, embedded and indexed
+    in bounded micro-batches, and each stage runs in its own thread, so e.g. batch N is embedded while
+    batch N-1 is indexed. Bounded queues between stages give backpressure, so memory stays constant
+    however large the corpus is, and indexing starts as soon as the first batch is embedded.
+
+    Args:
+        papers_per_batch (int, optional): The number of papers transformed and chunked together. Defaults to 16.
+        chunks_per_batch (int, optional): The number of chunks embedded and indexed together. Defaults to 256.
+        max_prefetch (int, optional): The max number of finished batches waiting for the next stage. Defaults to 2.
+        num_workers (int, optional): The number of processes transforming and chunking papers.
+            Defaults to 1, which runs the stage in a thread of this process.
+        embedding_cache_path (str, optional): The path of the SQLite embedding cache, so only chunks
+            that changed since the last run are encoded. Defaults to None, no cache.
+        embedding_backend (str, optional): "torch", "onnx" for the int8 quantized ONNX Runtime model, or "bedrock"
+            for BEDROCK_EMBEDDING_MODEL_ID, called concurrently. Defaults to "torch".
+        embedding_batch_size (int, optional): The number of chunks encoded together. Defaults to 64.
+        embedding_threads (int, optional): The number of CPU threads of the embedding backend. Defaults to None.
+        incremental (bool, optional): Whether to update the existing index instead of rebuilding it: only chunks
+            missing from it are embedded and indexed, and stale chunks are deleted at the end. Defaults to False.
+        indexing_threads (int, optional): The number of bulk requests in flight. Defaults to 4.
+        dedup_threshold (float, optional): The estimated Jaccard similarity from which a chunk is dropped as a near
+            duplicate of an earlier one, exact duplicates are always dropped. Defaults to DEDUP_THRESHOLD,
+            None disables deduplication.
+        retrieval_backend (str, optional): "opensearch", or "local" to write a local index for LocalVectorBackend
+            instead, always rebuilt. Defaults to "opensearch".
+        local_index_dir (str, optional): The directory of the local index. Defaults to LOCAL_INDEX_DIR.
+        local_index_hnsw (bool, optional): Whether to build an HNSW graph in the local index. Defaults to False.
+        local_index_compression (str, optional): "fp16", "int8" or "pq" to compress the vectors of the local index.
+            Defaults to LOCAL_INDEX_COMPRESSION.
+        reduced_embedding_dimension (int, optional): The dimension the embeddings are projected to, with the projection
+            of the live index, fitted on the first embeddings if it has none. Defaults to
+            REDUCED_EMBEDDING_DIMENSION, None keeps the dimension of the embedding model.
+        input_key (str, optional): The object, manifest or prefix of the papers in the bucket, see
+            iter_input_from_s3. Defaults to INPUT_KEY.
+    """
+    logger = setup_logger("data_processing", "data_processing.log")
+    logger.info("Starting streaming data processing function.")
+
+    logger.info("Initializing embedding model...")
+    embedding_engine, embedding_chunk_size, cache_namespace, embed = get_encoder(
+        embedding_backend, embedding_batch_size, embedding_threads
+    )
+    embedding_cache = get_embedding_cache(embedding_cache_path, cache_namespace)
+    index_dimension = reduced_embedding_dimension or embedding_engine.dimension
+    client, projection, incremental = get_index_target(
+        INDEX_NAME, OPENSEARCH_ENDPOINT, AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_REGION,
+        retrieval_backend, embedding_engine.dimension, incremental, reduced_embedding_dimension, local_index_dir
+    )
+    indexed_ids = get_indexed_chunk_ids(client, INDEX_NAME) if incremental else {}
+    current_ids = set()
+    deduplicator = get_deduplicator(dedup_threshold)
+
+    # load -> transform -> chunk in one thread (or a process pool), embed in another, index from a pool of bulk threads
+    data = iter_input_from_s3(AWS_BUCKET_NAME, input_key)
+    chunk_batches = chunk_paper_batches(data, embedding_chunk_size, num_workers, papers_per_batch, max_prefetch)
+    embedded_batches = threaded_map(
+        lambda batch: embed_records(batch, embed, embedding_engine, embedding_cache),
+        batched(iter_new_records(chunk_batches, deduplicator, indexed_ids, current_ids), chunks_per_batch),
+        max_prefetch
+    )
+
+    # the indexer pulls embedded documents as fast as its bulk requests complete
+    embedded_docs = (doc for embedded_docs in embedded_batches for doc in embedded_docs)
+    if reduced_embedding_dimension:
+        # without a saved projection, the first embeddings are held back to fit one
+        embedded_docs = project_records(embedded_docs, reduced_embedding_dimension, projection, EMBEDDING_PROJECTION_PATH)
+    number_of_documents_indexed = write_index(
+        embedded_docs, client, INDEX_NAME, index_dimension, incremental, indexing_threads,
+        local_index_dir, local_index_hnsw, local_index_compression,
+        EMBEDDING_PROJECTION_PATH if reduced_embedding_dimension else None
+    )
+
+    if embedding_cache is not None:
+        embedding_cache.close()
+    if deduplicator is not None:
+        deduplicator.write_report(DEDUP_REPORT_PATH)
+
+    if incremental:
+        # the new chunks are all in, the ones of changed or removed papers can go
+        delete_stale_records(client, INDEX_NAME, indexed_ids, current_ids)
+
+    logger.info(f"Indexed {number_of_documents_indexed} documents into index '{INDEX_NAME}'.")
+    logger.info("Finished streaming data processing pipeline.")
+
     
 def main():
     # Load environment variables from .env file
@@ -66,7 +434,18 @@ def main():
     Main entry point of the data processing pipeline.
 
     Loads environment variables from .env file and validates that all required variables are set.
-    Then starts the data processing pipeline by calling data_processing function.
+    Then starts the data processing pipeline by calling data_processing function,
+    or streaming_data_processing if the STREAMING_PIPELINE variable is set to true.
+    The CHUNKING_WORKERS variable sets the number of processes used to chunk papers, and
+    EMBEDDING_CACHE_PATH the SQLite file in which embeddings are cached across runs.
+    EMBEDDING_BACKEND (torch, onnx or bedrock), EMBEDDING_BATCH_SIZE and EMBEDDING_THREADS configure the encoder.
+    With INCREMENTAL_INDEXING set to true, the existing index is updated instead of rebuilt,
+    and INDEXING_THREADS sets the number of bulk requests in flight.
+    DEDUP_THRESHOLD sets the similarity from which chunks are dropped as near duplicates, 0 disables deduplication.
+    With RETRIEVAL_BACKEND set to local, the index is written to LOCAL_INDEX_DIR instead of OpenSearch,
+    with an HNSW graph if LOCAL_INDEX_HNSW is set to true, or with vectors compressed as set by LOCAL_INDEX_COMPRESSION.
+    REDUCED_EMBEDDING_DIMENSION sets the dimension the embeddings are projected to, unset keeps the model's.
+    INPUT_KEY sets the object, ingestion manifest or prefix of the papers to process in AWS_BUCKET_NAME.
 
     Raises ValueError if any of the required environment variables are not set.
     """
@@ -78,12 +457,27 @@ def main():
     AWS_ACCESS_KEY = os.environ.get('AWS_ACCESS_KEY_ID')
     AWS_SECRET_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY')
     AWS_REGION = os.environ.get('AWS_REGION')
+    STREAMING = os.environ.get('STREAMING_PIPELINE', 'false').lower() == 'true'
+    NUM_WORKERS = int(os.environ.get('CHUNKING_WORKERS', 1))
+    EMBEDDING_CACHE_PATH = os.environ.get('EMBEDDING_CACHE_PATH')
+    EMBEDDING_BACKEND = os.environ.get('EMBEDDING_BACKEND', 'torch')
+    EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', 64))
+    EMBEDDING_THREADS = int(os.environ.get('EMBEDDING_THREADS', 0)) or None
+    INCREMENTAL = os.environ.get('INCREMENTAL_INDEXING', 'false').lower() == 'true'
+    INDEXING_THREADS = int(os.environ.get('INDEXING_THREADS', 4))
+    DEDUP = float(os.environ.get('DEDUP_THRESHOLD', DEDUP_THRESHOLD)) or None
+    RETRIEVAL_BACKEND = os.environ.get('RETRIEVAL_BACKEND', 'opensearch')
+    LOCAL_INDEX = os.environ.get('LOCAL_INDEX_DIR', LOCAL_INDEX_DIR)
+    LOCAL_INDEX_HNSW = os.environ.get('LOCAL_INDEX_HNSW', 'false').lower() == 'true'
+    LOCAL_INDEX_COMPRESSION = os.environ.get('LOCAL_INDEX_COMPRESSION') or None
+    REDUCED_DIMENSION = int(os.environ.get('REDUCED_EMBEDDING_DIMENSION', 0)) or None
+    INPUT = os.environ.get('INPUT_KEY', INPUT_KEY)
 
     # Validate environment variables
     missing_vars = []
     if not AWS_BUCKET_NAME:
         missing_vars.append('AWS_BUCKET_NAME')
-    if not OPENSEARCH_ENDPOINT:
+    if not OPENSEARCH_ENDPOINT and RETRIEVAL_BACKEND == 'opensearch':
         missing_vars.append('OPENSEARCH_ENDPOINT')
     if not AWS_ACCESS_KEY:
         missing_vars.append('AWS_ACCESS_KEY')
@@ -96,13 +490,28 @@ def main():
         raise ValueError(f"The following environment variables are not set: {', '.join(missing_vars)}")
 
     # Start the data processing pipeline
-    data_processing(
+    pipeline = streaming_data_processing if STREAMING else data_processing
+    pipeline(
         INDEX_NAME,
         AWS_BUCKET_NAME,
         OPENSEARCH_ENDPOINT,
         AWS_ACCESS_KEY,
         AWS_SECRET_KEY,
-        AWS_REGION
+        AWS_REGION,
+        num_workers=NUM_WORKERS,
+        embedding_cache_path=EMBEDDING_CACHE_PATH,
+        embedding_backend=EMBEDDING_BACKEND,
+        embedding_batch_size=EMBEDDING_BATCH_SIZE,
+        embedding_threads=EMBEDDING_THREADS,
+        incremental=INCREMENTAL,
+        indexing_threads=INDEXING_THREADS,
+        dedup_threshold=DEDUP,
+        retrieval_backend=RETRIEVAL_BACKEND,
+        local_index_dir=LOCAL_INDEX,
+        local_index_hnsw=LOCAL_INDEX_HNSW,
+        local_index_compression=LOCAL_INDEX_COMPRESSION,
+        reduced_embedding_dimension=REDUCED_DIMENSION,
+        input_key=INPUT
     )
 
 if __name__ == '__main__':
@@ -1,140 +1,340 @@
-from typing import List, Callable
-from transformers import AutoTokenizer
-from langchain.docstore.document import Document
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+import os
+import hashlib
+import multiprocessing
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Tuple, Union
+from transformers import AutoTokenizer, PreTrainedTokenizerBase
 import logging
 
 logger = logging.getLogger(__name__)
 
-def transform_paper_data(pdf_data: dict) -> list:
+# How good a place to cut is, from mid-word (0) up to the end of a paragraph.
+WORD_BOUNDARY, SENTENCE_BOUNDARY, LINE_BOUNDARY, PARAGRAPH_BOUNDARY = 1, 2, 3, 4
+
+
+def _boundary_score(text: str, offsets: List[Tuple[int, int]], index: int) -> int:
+    """
+    Scores the place right before the token at index as a chunk boundary, looking only at the few
+    characters around it so that scoring every candidate of a document stays linear.
+    """
+    start, end = offsets[index]
+    token_text = text[start:end]
+    # Depending on the tokenizer, whitespace before a word is either in the gap or at the start of the token.
+    context = text[max(0, start - 8):start] + token_text[:len(token_text) - len(token_text.lstrip())]
+
+    stripped = context.rstrip(" \t")
+    if stripped.endswith("\n\n"):
+        return PARAGRAPH_BOUNDARY
+    if stripped.endswith("\n"):
+        return LINE_BOUNDARY
+    if context[-1:].isspace():
+        return SENTENCE_BOUNDARY if context.rstrip().endswith((".", "!", "?")) else WORD_BOUNDARY
+    return 0
+
+
+def split_offsets_into_windows(
+    text: str,
+    offsets: List[Tuple[int, int]],
+    chunk_size: int,
+    chunk_overlap: int
+) -> List[Tuple[int, int]]:
     """
-    Transforms the data from one pdf file into the format we want to store it in the database. 
-    In this case, the section of the paper is added to the meta data.
+    Cuts a tokenized text into windows of at most chunk_size tokens that overlap by about chunk_overlap tokens.
+    Each window ends at the best boundary in the second half of its span (paragraph, then line, then sentence,
+    then word), and the overlap starts on a word boundary when there is one nearby.
 
     Args:
-        pdf_data (dict): The data of one pdf file. It contains the content of the pdf file and the original meta data.
+        text (str): The tokenized text.
+        offsets (List[Tuple[int, int]]): The character span of every token, from the tokenizer's offset mapping.
+        chunk_size (int): The max number of tokens per window.
+        chunk_overlap (int): The number of tokens shared by two consecutive windows.
 
     Returns:
-        list: A list of dictionaries, where each dictionary contains the text of one section of the paper and the meta data of the paper with the section added to it.
+        List[Tuple[int, int]]: The first and last token index (exclusive) of every window.
     """
-    logger.info("Transforming pdf data, moving section to meta data.")
-    pdf_content, original_meta_data = pdf_data['content'], pdf_data['meta_data']
-    
-    updated_data = []
-
-    for text_section in pdf_content:
-        meta_data = original_meta_data.copy()
-        
-        meta_data['section'] = text_section['section']
-        
-        body = text_section['body']
-        
-        updated_data.append({'body': body, 'meta_data': meta_data})
-        
-    logger.info("Data transformed successfully.")
-    return updated_data
-
-def get_full_data(data):
-    logger.info("Aggregating full data from all PDFs...")
-    full_pdf_data = []
-
-    for pdf_data in data:
-        full_pdf_data += transform_paper_data(pdf_data)
-    
-    logger.info("Full data aggregation complete.")
-    return full_pdf_data
-
-
-def convert_to_doc_format(transformed_data):
-    logger.info("Converting transformed data into Langchain Document format.")
-    documents = []
-    for content in transformed_data:
-        doc = Document(page_content=content['body'], metadata=content['meta_data'])
-        documents.append(doc)
-    
-    logger.info("Conversion to Document format complete.")
-    return documents
-
-def chunk_text(document, chunk_size=5000, chunk_overlap=500):
+    if chunk_overlap >= chunk_size:
+        raise ValueError("chunk_overlap must be lower than chunk_size.")
+
+    num_tokens = len(offsets)
+    windows = []
+    start = 0
+    while start < num_tokens:
+        end = min(start + chunk_size, num_tokens)
+        if end < num_tokens:
+            best_score = -1
+            for candidate in range(end, start + chunk_size // 2, -1):
+                score = _boundary_score(text, offsets, candidate)
+                if score > best_score:
+                    best_score, end = score, candidate
+                    if score == PARAGRAPH_BOUNDARY:
+                        break
+        windows.append((start, end))
+        if end == num_tokens:
+            break
+
+        next_start = max(end - chunk_overlap, start + 1)
+        for candidate in range(next_start, min(next_start + 16, end)):
+            if _boundary_score(text, offsets, candidate):
+                next_start = candidate
+                break
+        start = next_start
+
+    return windows
+
+
+def iter_chunk_spans(
+    texts: List[str],
+    tokenizer: Union[str, PreTrainedTokenizerBase],
+    chunk_size: int,
+    chunk_overlap: int,
+    batch_size: int = 64
+) -> Iterator[Tuple[int, int, int]]:
     """
-    Chunk text into smaller pieces based on a given chunk size and overlap.
-    Chunks by text/string, not tokens.
+    Cuts texts into chunks of at most chunk_size tokens, tokenizing each text only once, in batches with the
+    fast (Rust) tokenizer. The chunk boundaries are found on the tokenizer's offset mapping, see split_offsets_into_windows.
 
     Args:
-        document (Document): The document to be chunked.
-        chunk_size (int): The size of each chunk in characters. Defaults to 5000.
-        chunk_overlap (int): The overlap between each chunk in characters. Defaults to 500.
+        texts (List[str]): The texts to be chunked.
+        tokenizer (Union[str, PreTrainedTokenizerBase]): A fast tokenizer, or the name of the model to load it from.
+        chunk_size (int): The size of each chunk in tokens.
+        chunk_overlap (int): The overlap between each chunk in tokens.
+        batch_size (int): The number of texts tokenized together. Defaults to 64.
 
-    Returns:
-        List[Document]: The list of documents created by chunking the input document.
+    Yields:
+        Tuple[int, int, int]: The index of the text, and the first and last (exclusive) character of each chunk,
+            without surrounding whitespace. Empty chunks are skipped.
     """
+    if isinstance(tokenizer, str):
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer)
+    if not tokenizer.is_fast:
+        raise ValueError("Chunking by token offsets needs a fast tokenizer to get offset mappings.")
 
-    raw_text = document.page_content
-    meta_data = document.metadata
-    
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap
-    )
-    
-    texts = text_splitter.split_text(raw_text)
-    docs = [Document(page_content=t, metadata=meta_data) for t in texts]
-    
-    return docs
+    for i in range(0, len(texts), batch_size):
+        batch = texts[i:i + batch_size]
+        encodings = tokenizer(
+            batch,
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+            return_attention_mask=False
+        )
+
+        for j, (text, offsets) in enumerate(zip(batch, encodings["offset_mapping"])):
+            for start, end in split_offsets_into_windows(text, offsets, chunk_size, chunk_overlap):
+                start, end = offsets[start][0], offsets[end - 1][1]
+                while start < end and text[start].isspace():
+                    start += 1
+                while end > start and text[end - 1].isspace():
+                    end -= 1
+                if start < end:
+                    yield i + j, start, end
 
 
-def chunk_doc(documents: List[Document], chunk_size: int = 10000, chunk_overlap: int = 1000) -> List[Document]:
+def _chunk_id(doi: str, section: str, ordinal: int, text: str, parent_text: str) -> str:
     """
-    Chunk a list of documents into smaller documents based on a given chunk size and overlap.
-    Uses the chunk_text funtion, meant to chunk the full dataset.
+    Returns the deterministic id of a chunk, derived from the DOI and section of its paper, its ordinal within
+    the section, and a hash of its text and parent text. Rebuilding the same corpus gives the same ids, so an
+    index can be updated incrementally: an unchanged chunk keeps its id, and a changed chunk gets a new one.
+    """
+    content_hash = hashlib.sha1(f"{text}\x1f{parent_text}".encode("utf-8")).hexdigest()
+    return hashlib.sha1(f"{doi}\x1f{section}\x1f{ordinal}\x1f{content_hash}".encode("utf-8")).hexdigest()
 
-    Args:
-        documents (List[Document]): The list of documents to be chunked.
-        chunk_size (int): The size of each chunk in characters. Defaults to 10000.
-        chunk_overlap (int): The overlap between each chunk in characters. Defaults to 1000.
 
-    Returns:
-        List[Document]: The chunked documents.
+class Chunk:
+    """
+    A compact chunk of a paper section, used instead of a Document with its own copy of the paper's meta data.
+    The chunks of a paper share its meta data dict, from the paper table, and the chunks cut from the same parent
+    share its text, of which each chunk only keeps its offsets. Like a Document, a chunk has page_content and
+    metadata, where metadata holds only what is needed to join the chunk with its paper.
+
+    Args:
+        paper (dict): The meta data of the paper, shared with the other chunks of the paper.
+        section (str): The name of the section.
+        parent_id (str, optional): The id of the parent chunk, or None if the chunk was cut from the section itself.
+        parent_text (str): The text of the parent chunk, or of the section.
+        start (int): The first character of the chunk in parent_text.
+        end (int): The last character (exclusive) of the chunk in parent_text.
+        chunk_id (str): The deterministic id of the chunk, see _chunk_id.
     """
-    
-    logger.info("Chunking documents...")
-    chunked_docs: List[Document] = []
-    
-    for doc in documents:
-        chunked_docs += chunk_text(doc, chunk_size, chunk_overlap)
-    
-    return chunked_docs
-
-
-
-def chunk_documents_by_tokens(
-    documents: List[Document], 
-    model_name: str, 
-    chunk_size: int = 2048, 
-    chunk_overlap: int = 200
-) -> List[Document]:
+    __slots__ = ("paper", "section", "parent_id", "parent_text", "start", "end", "chunk_id")
+
+    def __init__(
+        self,
+        paper: dict,
+        section: str,
+        parent_id: Optional[str],
+        parent_text: str,
+        start: int,
+        end: int,
+        chunk_id: str
+    ):
+        self.paper = paper
+        self.section = section
+        self.parent_id = parent_id
+        self.parent_text = parent_text
+        self.start = start
+        self.end = end
+        self.chunk_id = chunk_id
+
+    @property
+    def page_content(self) -> str:
+        return self.parent_text[self.start:self.end]
+
+    @property
+    def metadata(self) -> dict:
+        return {"doi": self.paper.get("doi"), "section": self.section}
+
+
+def chunk_papers_compact(
+    papers: Iterable[dict],
+    embedding_tokenizer: Union[str, PreTrainedTokenizerBase],
+    embedding_chunk_size: int,
+    embedding_chunk_overlap: int = 32,
+    parent_tokenizer: Optional[Union[str, PreTrainedTokenizerBase]] = None,
+    parent_chunk_size: int = 2048,
+    parent_chunk_overlap: int = 200,
+    batch_size: int = 64
+) -> List[Chunk]:
     """
-    Chunk a list of documents by their token count using a given model's tokenizer.
+    Cuts papers into compact chunks that fit whole in the input of the embedding model, which silently truncates
+    longer texts. With a parent_tokenizer, the sections are first cut into large parent chunks, sized for the LLM
+    prompt, and each parent is then cut into child chunks that fit the embedding model. Only the children are
+    embedded, and each of them refers to its parent, so the search matches small, precise chunks while the prompt
+    gets the wider context. The paper's meta data is not copied into every chunk, nor the parent's text into
+    every child.
 
     Args:
-        documents (List[Document]): The list of documents to be chunked.
-        model_name (str): The name of the model to use for tokenization.
-        chunk_size (int): The size of each chunk in tokens. Defaults to 2048.
-        chunk_overlap (int): The overlap between each chunk in tokens. Defaults to 200.
+        papers (Iterable[dict]): The papers, as loaded from S3.
+        embedding_tokenizer (Union[str, PreTrainedTokenizerBase]): The fast tokenizer of the embedding model, or its name.
+        embedding_chunk_size (int): The size of each embedded chunk in tokens, see get_embedding_chunk_size.
+        embedding_chunk_overlap (int): The overlap between each embedded chunk in tokens. Defaults to 32.
+        parent_tokenizer (Union[str, PreTrainedTokenizerBase], optional): The fast tokenizer of the LLM, or its name.
+            Defaults to None, which cuts the chunks from the sections directly.
+        parent_chunk_size (int): The size of each parent chunk in tokens of the parent_tokenizer. Defaults to 2048.
+        parent_chunk_overlap (int): The overlap between each parent chunk in tokens. Defaults to 200.
+        batch_size (int): The number of texts tokenized together. Defaults to 64.
 
     Returns:
-        List[Document]: The chunked documents.
+        List[Chunk]: The chunks to embed, in the order of the papers.
     """
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    sections = [
+        (paper["meta_data"], section["section"], section["body"])
+        for paper in papers
+        for section in paper["content"]
+    ]
+
+    # (paper, section, parent id, parent text) of every text the chunks are cut from
+    if parent_tokenizer is None:
+        parents = [(paper, name, None, body) for paper, name, body in sections]
+    else:
+        parents = []
+        ordinals = Counter()
+        bodies = [body for _, _, body in sections]
+        for i, start, end in iter_chunk_spans(bodies, parent_tokenizer, parent_chunk_size, parent_chunk_overlap, batch_size):
+            paper, name, body = sections[i]
+            key = (paper.get("doi"), name)
+            text = body[start:end]
+            parents.append((paper, name, "parent-" + _chunk_id(key[0], key[1], ordinals[key], text, ""), text))
+            ordinals[key] += 1
+
+    chunks = []
+    ordinals = Counter()
+    parent_texts = [text for _, _, _, text in parents]
+    for i, start, end in iter_chunk_spans(parent_texts, embedding_tokenizer, embedding_chunk_size, embedding_chunk_overlap, batch_size):
+        paper, name, parent_id, parent_text = parents[i]
+        key = (paper.get("doi"), name)
+        chunk_id = _chunk_id(
+            key[0], key[1], ordinals[key], parent_text[start:end], parent_text if parent_id is not None else ""
+        )
+        chunks.append(Chunk(paper, name, parent_id, parent_text, start, end, chunk_id))
+        ordinals[key] += 1
+    return chunks
+
+
+# Tokenizers of a chunking worker process, loaded once by its initializer.
+_worker_tokenizer: Optional[PreTrainedTokenizerBase] = None
+_worker_embedding_tokenizer: Optional[PreTrainedTokenizerBase] = None
 
-    def tiktoken_len(text: str) -> int:
-        tokens = tokenizer.encode(text, add_special_tokens=False)
-        return len(tokens)
 
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=chunk_size,
-        chunk_overlap=chunk_overlap,
-        length_function=tiktoken_len,
-        separators=["\n\n", "\n", " ", ""]
+def _init_chunking_worker(model_name: str, embedding_model_name: str) -> None:
+    global _worker_tokenizer, _worker_embedding_tokenizer
+    # Each process already is one unit of parallelism, so the Rust tokenizer should not spawn threads as well.
+    os.environ["TOKENIZERS_PARALLELISM"] = "false"
+    _worker_tokenizer = AutoTokenizer.from_pretrained(model_name)
+    _worker_embedding_tokenizer = AutoTokenizer.from_pretrained(embedding_model_name)
+
+
+def _chunk_papers(
+    papers: List[dict],
+    chunk_size: int,
+    chunk_overlap: int,
+    embedding_chunk_size: int,
+    embedding_chunk_overlap: int
+) -> List[Chunk]:
+    return chunk_papers_compact(
+        papers,
+        _worker_embedding_tokenizer,
+        embedding_chunk_size,
+        embedding_chunk_overlap,
+        parent_tokenizer=_worker_tokenizer,
+        parent_chunk_size=chunk_size,
+        parent_chunk_overlap=chunk_overlap
     )
-    return text_splitter.split_documents(documents)
+
+
+def chunk_papers_in_parallel(
+    papers: Iterable[dict],
+    model_name: str,
+    num_workers: Optional[int] = None,
+    papers_per_task: int = 8,
+    chunk_size: int = 2048,
+    chunk_overlap: int = 200,
+    embedding_model_name: Optional[str] = None,
+    embedding_chunk_size: Optional[int] = None,
+    embedding_chunk_overlap: int = 32
+) -> Iterator[List[Chunk]]:
+    """
+    Transform and chunk papers in a pool of worker processes, a few papers per task, so chunking scales
+    with the number of cores. Every worker loads the tokenizers once when it starts. At most two tasks per
+    worker are pending at a time, so papers are read from the input only as fast as the workers chunk them.
+    The papers are cut into compact parent and child chunks, see chunk_papers_compact.
+
+    Args:
+        papers (Iterable[dict]): The papers, as loaded from S3. Can be a generator.
+        model_name (str): The name of the model to use for tokenization of the parent chunks.
+        num_workers (int, optional): The number of worker processes. Defaults to None, the number of CPUs.
+        papers_per_task (int, optional): The number of papers sent to a worker at a time. Defaults to 8.
+        chunk_size (int): The size of each parent chunk in tokens. Defaults to 2048.
+        chunk_overlap (int): The overlap between each parent chunk in tokens. Defaults to 200.
+        embedding_model_name (str): The name of the embedding model, to load its tokenizer from. Required.
+        embedding_chunk_size (int): The size of each embedded chunk in tokens. Required.
+        embedding_chunk_overlap (int): The overlap between each embedded chunk in tokens. Defaults to 32.
+
+    Yields:
+        List[Chunk]: The chunks of each task, in the order of the input papers.
+    """
+    if not embedding_model_name or not embedding_chunk_size:
+        raise ValueError("embedding_model_name and embedding_chunk_size are required.")
+    num_workers = num_workers or os.cpu_count() or 1
+    papers = iter(papers)
+    pending = deque()
+
+    logger.info(f"Chunking papers with {num_workers} worker processes.")
+    # Spawned workers do not inherit the threads of the parent, e.g. from torch or an already used tokenizer.
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_chunking_worker,
+        initargs=(model_name, embedding_model_name)
+    ) as executor:
+        while True:
+            while len(pending) < 2 * num_workers:
+                task = [paper for _, paper in zip(range(papers_per_task), papers)]
+                if not task:
+                    break
+                pending.append(executor.submit(
+                    _chunk_papers, task, chunk_size, chunk_overlap, embedding_chunk_size, embedding_chunk_overlap
+                ))
+            if not pending:
+                return
+            yield pending.popleft().result()
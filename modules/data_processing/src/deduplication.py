@@ -0,0 +1,215 @@
+import os
+import re
+import json
+import zlib
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple, TypeVar
+import numpy as np
+from .config import DEDUP_NUM_PERM, DEDUP_SHINGLE_SIZE
+from .embedding_cache import normalize_text, text_hash
+import logging
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Hashes of the shingles are 32 bits, permuted with a * x + b modulo a Mersenne prime, as in datasketch.
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def get_shingles(text: str, shingle_size: int = DEDUP_SHINGLE_SIZE) -> set:
+    """
+    Returns the set of shingles of a text: every sequence of shingle_size consecutive words, lowercased.
+    A text shorter than shingle_size words is a single shingle.
+    """
+    words = re.findall(r"\w+", normalize_text(text).lower())
+    if len(words) <= shingle_size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + shingle_size]) for i in range(len(words) - shingle_size + 1)}
+
+
+def get_lsh_bands(threshold: float, num_perm: int) -> Tuple[int, int]:
+    """
+    Returns the number of bands and rows per band of the LSH index that minimize the sum of the probabilities
+    of a false positive and a false negative for the given Jaccard similarity threshold.
+
+    Args:
+        threshold (float): The Jaccard similarity from which two texts are near duplicates.
+        num_perm (int): The number of permutations of the MinHash signatures.
+
+    Returns:
+        Tuple[int, int]: The number of bands and of rows per band.
+    """
+    best, best_error = (1, num_perm), float("inf")
+    below = np.linspace(0, threshold, 100)
+    above = np.linspace(threshold, 1, 100)
+    for bands in range(1, num_perm + 1):
+        rows = num_perm // bands
+        # the probability that two texts of similarity s share at least one band is 1 - (1 - s^rows)^bands
+        false_positive = np.mean(1 - (1 - below ** rows) ** bands) * threshold
+        false_negative = np.mean((1 - above ** rows) ** bands) * (1 - threshold)
+        if false_positive + false_negative < best_error:
+            best, best_error = (bands, rows), false_positive + false_negative
+    return best
+
+
+class ChunkDeduplicator:
+    """
+    Drops the chunks whose text was already seen: exact duplicates by the hash of their normalized text,
+    and near duplicates by MinHash signatures of their word shingles, looked up in an LSH index. The first
+    occurrence of a text is kept. The deduplicator keeps its state between calls, so the batches of the
+    streaming pipeline are deduplicated against each other, and records what it dropped for the report.
+
+    Args:
+        threshold (float): The estimated Jaccard similarity from which a chunk is a near duplicate of one already kept.
+        num_perm (int, optional): The number of permutations of the MinHash signatures. Defaults to DEDUP_NUM_PERM.
+        shingle_size (int, optional): The number of words per shingle. Defaults to DEDUP_SHINGLE_SIZE.
+        seed (int, optional): The seed of the permutations, so that runs agree. Defaults to 1.
+    """
+    def __init__(
+        self,
+        threshold: float,
+        num_perm: int = DEDUP_NUM_PERM,
+        shingle_size: int = DEDUP_SHINGLE_SIZE,
+        seed: int = 1
+    ):
+        if not 0 < threshold <= 1:
+            raise ValueError("threshold must be in (0, 1].")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.bands, self.rows = get_lsh_bands(threshold, num_perm)
+
+        generator = np.random.RandomState(seed)
+        self._a = generator.randint(1, 1 << 31, size=num_perm).astype(np.uint64)
+        self._b = generator.randint(0, 1 << 31, size=num_perm).astype(np.uint64)
+
+        self._hashes: Dict[bytes, int] = {}
+        self._buckets: List[Dict[bytes, List[int]]] = [defaultdict(list) for _ in range(self.bands)]
+        self._signatures: List[np.ndarray] = []
+        self._ids: List[Optional[str]] = []
+        self.num_chunks = 0
+        self.removed: List[dict] = []
+
+    def signature(self, text: str) -> np.ndarray:
+        """
+        Returns the MinHash signature of a text, num_perm 32 bit values.
+        """
+        hashes = np.fromiter(
+            (zlib.crc32(shingle.encode("utf-8")) for shingle in get_shingles(text, self.shingle_size)),
+            dtype=np.uint64
+        )
+        permuted = (self._a[:, None] * hashes[None, :] + self._b[:, None]) % _MERSENNE_PRIME & _MAX_HASH
+        return permuted.min(axis=1).astype(np.uint32)
+
+    def _find_near_duplicate(self, signature: np.ndarray) -> Tuple[Optional[int], float]:
+        candidates = set()
+        for band, buckets in enumerate(self._buckets):
+            candidates.update(buckets.get(signature[band * self.rows:(band + 1) * self.rows].tobytes(), ()))
+        best, best_similarity = None, 0.0
+        for candidate in sorted(candidates):
+            # the fraction of equal values of two signatures estimates the Jaccard similarity of the texts
+            similarity = float(np.mean(self._signatures[candidate] == signature))
+            if similarity >= self.threshold and similarity > best_similarity:
+                best, best_similarity = candidate, similarity
+        return best, best_similarity
+
+    def _add(self, signature: np.ndarray, chunk_id: Optional[str]) -> int:
+        index = len(self._signatures)
+        self._signatures.append(signature)
+        self._ids.append(chunk_id)
+        for band, buckets in enumerate(self._buckets):
+            buckets[signature[band * self.rows:(band + 1) * self.rows].tobytes()].append(index)
+        return index
+
+    def deduplicate(self, chunks: List[T]) -> List[T]:
+        """
+        Returns the chunks that are neither exact nor near duplicates of a chunk kept before, in order.
+
+        Args:
+            chunks (List[T]): The chunks, Chunks or Documents.
+
+        Returns:
+            List[T]: The chunks to keep.
+        """
+        kept = []
+        for chunk in chunks:
+            self.num_chunks += 1
+            text = chunk.page_content
+            chunk_id = _get_chunk_id(chunk)
+            key = text_hash(text)
+
+            duplicate_of, similarity, kind = self._hashes.get(key), 1.0, "exact"
+            if duplicate_of is None:
+                signature = self.signature(text)
+                duplicate_of, similarity = self._find_near_duplicate(signature)
+                kind = "near"
+                if duplicate_of is None:
+                    self._hashes[key] = self._add(signature, chunk_id)
+                    kept.append(chunk)
+                    continue
+
+            self.removed.append({
+                "chunk_id": chunk_id,
+                "doi": chunk.metadata.get("doi"),
+                "section": chunk.metadata.get("section"),
+                "kind": kind,
+                "duplicate_of": self._ids[duplicate_of],
+                "similarity": round(similarity, 3),
+                "text": text[:200]
+            })
+        return kept
+
+    def report(self) -> dict:
+        """
+        Returns the report of the chunks dropped so far: how many, of which kind, the sections they
+        came from the most, and every dropped chunk with the id of the chunk it duplicates.
+        """
+        kinds = Counter(removed["kind"] for removed in self.removed)
+        sections = Counter(removed["section"] for removed in self.removed)
+        return {
+            "threshold": self.threshold,
+            "chunks": self.num_chunks,
+            "kept": self.num_chunks - len(self.removed),
+            "exact_duplicates": kinds["exact"],
+            "near_duplicates": kinds["near"],
+            "top_sections": sections.most_common(20),
+            "removed": self.removed
+        }
+
+    def write_report(self, path: str) -> dict:
+        """
+        Logs a summary of the report and writes it to a JSON file.
+
+        Returns:
+            dict: The report.
+        """
+        report = self.report()
+        logger.info(
+            f"Deduplication kept {report['kept']} of {report['chunks']} chunks, dropped "
+            f"{report['exact_duplicates']} exact and {report['near_duplicates']} near duplicates. "
+            f"Top sections: {report['top_sections'][:5]}."
+        )
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+        logger.info(f"Deduplication report written to {path}.")
+        return report
+
+
+def _get_chunk_id(chunk) -> Optional[str]:
+    chunk_id = getattr(chunk, "chunk_id", None)
+    return chunk_id if chunk_id is not None else chunk.metadata.get("chunk_id")
+
+
+def get_deduplicator(threshold: Optional[float]) -> Optional[ChunkDeduplicator]:
+    """
+    Returns a ChunkDeduplicator with the given threshold, or None if deduplication is disabled.
+    """
+    if not threshold:
+        return None
+    logger.info(f"Deduplicating chunks with a near duplicate threshold of {threshold}.")
+    return ChunkDeduplicator(threshold)
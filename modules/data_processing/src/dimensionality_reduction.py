@@ -0,0 +1,232 @@
+import os
+import json
+import time
+from typing import Iterable, Iterator, List, Optional
+import numpy as np
+import logging
+
+from .vector_quantization import exact_top_k, fit_sample, recall_at_k, sample_queries
+
+logger = logging.getLogger(__name__)
+
+
+class PCAProjection:
+    """
+    Projects embeddings onto their top principal directions, fitted on a sample of the corpus embeddings, and
+    L2-normalizes the result so the inner product space of the index still ranks by cosine similarity. The same
+    projection has to be applied to the documents and to the queries, so it is saved as an artifact next to
+    the index. The directions are those of the uncentered second moment of the embeddings: inner products of
+    the vectors are preserved, not their distances to the mean, which ranks closer to the full vectors.
+
+    Args:
+        components (np.ndarray): The projection, (embedding dimension, reduced dimension).
+        explained_variance_ratio (np.ndarray, optional): The fraction of the energy of the embeddings
+            along each of the directions. Defaults to None.
+    """
+    def __init__(self, components: np.ndarray, explained_variance_ratio: Optional[np.ndarray] = None):
+        self.components = np.asarray(components, dtype=np.float32)
+        self.explained_variance_ratio = explained_variance_ratio
+
+    @property
+    def input_dimension(self) -> int:
+        return self.components.shape[0]
+
+    @property
+    def dimension(self) -> int:
+        return self.components.shape[1]
+
+    @classmethod
+    def fit(cls, vectors: np.ndarray, dimension: int) -> "PCAProjection":
+        """
+        Fits the projection to dimension dimensions on the given vectors, e.g. a sample of the corpus embeddings.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not 0 < dimension <= vectors.shape[1]:
+            raise ValueError(f"The reduced dimension must be in [1, {vectors.shape[1]}], got {dimension}.")
+        second_moment = vectors.T.astype(np.float64) @ vectors / len(vectors)
+        eigenvalues, eigenvectors = np.linalg.eigh(second_moment)
+        # eigh sorts the eigenvalues in ascending order
+        order = np.argsort(eigenvalues)[::-1][:dimension]
+        explained_variance_ratio = np.clip(eigenvalues[order], 0, None) / max(eigenvalues.clip(0).sum(), 1e-12)
+        return cls(eigenvectors[:, order], explained_variance_ratio.astype(np.float32))
+
+    def transform(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        Returns the projected and L2-normalized vectors, for a matrix of vectors or a single one. Vectors of
+        another dimension than the projection was fitted on, i.e. of another embedding model, are refused.
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if vectors.shape[-1] != self.input_dimension:
+            raise ValueError(
+                f"The projection reduces embeddings of {self.input_dimension} dimensions, got {vectors.shape[-1]}: "
+                "the vectors have to be embedded with the model the projection was fitted on."
+            )
+        projected = vectors @ self.components
+        norms = np.linalg.norm(projected, axis=-1, keepdims=True)
+        return projected / np.where(norms > 0, norms, 1)
+
+    def save(self, path: str) -> None:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        params = {"components": self.components}
+        if self.explained_variance_ratio is not None:
+            params["explained_variance_ratio"] = self.explained_variance_ratio
+        # np.savez appends .npz to other file names
+        with open(path, "wb") as f:
+            np.savez(f, **params)
+
+    @classmethod
+    def load(cls, path: str) -> "PCAProjection":
+        with np.load(path) as data:
+            return cls(
+                data["components"],
+                data["explained_variance_ratio"] if "explained_variance_ratio" in data.files else None
+            )
+
+
+def load_projection(path: Optional[str], dimension: Optional[int] = None) -> Optional[PCAProjection]:
+    """
+    Loads the projection artifact at path, if there is one and it reduces to the given dimension.
+
+    Args:
+        path (str, optional): The path of the artifact.
+        dimension (int, optional): The expected reduced dimension, any if None.
+
+    Returns:
+        Optional[PCAProjection]: The projection, or None if there is none to use.
+    """
+    if not path or not os.path.exists(path):
+        return None
+    projection = PCAProjection.load(path)
+    if dimension is not None and projection.dimension != dimension:
+        logger.info(f"The projection {path} reduces to {projection.dimension} dimensions, not {dimension}.")
+        return None
+    return projection
+
+
+def project_records(
+    records: Iterable[dict],
+    dimension: int,
+    projection: Optional[PCAProjection] = None,
+    path: Optional[str] = None,
+    fit_size: int = 32768
+) -> Iterator[dict]:
+    """
+    Projects the embeddings of embedded records, in place, as they stream through. Without a projection, the
+    first fit_size embeddings are held back to fit one, which is saved to path, and then the records flow again.
+    Records without an embedding, e.g. papers and parent chunks, are passed through.
+
+    Args:
+        records (Iterable[dict]): The records, see document_to_record.
+        dimension (int): The reduced dimension, to fit the projection to.
+        projection (PCAProjection, optional): The projection to apply. Defaults to None, fitted on the records.
+        path (str, optional): The path to save a fitted projection to. Defaults to None.
+        fit_size (int, optional): The number of embeddings the projection is fitted on. Defaults to 32768.
+
+    Yields:
+        dict: The records, with their embeddings projected.
+    """
+    held_back: List[dict] = []
+    number_of_embeddings = 0
+    for record in records:
+        if projection is not None:
+            yield from _project([record], projection)
+            continue
+        held_back.append(record)
+        number_of_embeddings += record.get("embedding") is not None
+        if number_of_embeddings >= fit_size:
+            projection = _fit_on_records(held_back, dimension, path)
+            yield from _project(held_back, projection)
+            held_back = []
+    if held_back:
+        projection = projection or _fit_on_records(held_back, dimension, path)
+        yield from _project(held_back, projection)
+
+
+def _fit_on_records(records: List[dict], dimension: int, path: Optional[str]) -> PCAProjection:
+    vectors = np.array([record["embedding"] for record in records if record.get("embedding") is not None], dtype=np.float32)
+    projection = PCAProjection.fit(vectors, dimension)
+    logger.info(
+        f"Fitted a projection of {projection.input_dimension} dimensions to {dimension} on {len(vectors)} embeddings, "
+        f"keeping {projection.explained_variance_ratio.sum():.1%} of their energy."
+    )
+    if path:
+        projection.save(path)
+        logger.info(f"Projection saved to {path}.")
+    return projection
+
+
+def _project(records: List[dict], projection: PCAProjection) -> Iterator[dict]:
+    for record in records:
+        if record.get("embedding") is not None:
+            record["embedding"] = projection.transform(record["embedding"])
+        yield record
+
+
+def dimension_benchmark(
+    vectors: np.ndarray,
+    dimensions: List[int] = (64, 128, 256),
+    num_queries: int = 100,
+    k: int = 10,
+    sample_size: int = 32768,
+    path: Optional[str] = None
+) -> List[dict]:
+    """
+    Benchmarks reduced dimensions on the given vectors: a projection to each dimension is fitted on a sample
+    of them, and the exact search of the projected vectors is compared to the exact search of the full ones
+    on queries sampled near them. The full dimension comes first, as the baseline of the latency.
+
+    Args:
+        vectors (np.ndarray): The L2-normalized float32 embeddings, e.g. the memory map of a local index.
+        dimensions (List[int], optional): The reduced dimensions. Defaults to 64, 128 and 256.
+        num_queries (int, optional): The number of queries. Defaults to 100.
+        k (int, optional): The k of recall@k. Defaults to 10.
+        sample_size (int, optional): The max number of vectors the projections are fitted on. Defaults to 32768.
+        path (str, optional): The JSON file to write the report to. Defaults to None.
+
+    Returns:
+        List[dict]: Per dimension, the recall@k, milliseconds per query, bytes per vector and kept energy.
+    """
+    queries = sample_queries(vectors, num_queries)
+    sample = fit_sample(vectors, sample_size)
+    full_dimension = vectors.shape[1]
+    vectors = np.asarray(vectors, dtype=np.float32)
+    exact = exact_top_k(vectors, queries, k)
+    report = [_benchmark_search(full_dimension, vectors, queries, exact, k, 1.0)]
+    for dimension in dimensions:
+        if dimension >= full_dimension:
+            logger.info(f"Skipping dimension {dimension}, the embeddings have {full_dimension}.")
+            continue
+        projection = PCAProjection.fit(sample, dimension)
+        report.append(_benchmark_search(
+            dimension,
+            projection.transform(vectors),
+            projection.transform(queries),
+            exact,
+            k,
+            float(projection.explained_variance_ratio.sum())
+        ))
+    for result in report:
+        logger.info(f"Embedding dimension: {result}")
+    if path:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def _benchmark_search(dimension: int, vectors: np.ndarray, queries: np.ndarray, exact: np.ndarray, k: int, energy: float) -> dict:
+    # one query at a time, as they are served
+    start_time = time.perf_counter()
+    found = [exact_top_k(vectors, query[None, :], k)[0] for query in queries]
+    elapsed = time.perf_counter() - start_time
+    return {
+        "dimension": dimension,
+        "bytes_per_vector": 4 * dimension,
+        f"recall@{k}": round(recall_at_k(exact.tolist(), [rows.tolist() for rows in found]), 4),
+        "ms_per_query": round(1000 * elapsed / max(len(queries), 1), 3),
+        "explained_variance_ratio": round(energy, 4)
+    }
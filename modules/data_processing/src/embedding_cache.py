@@ -0,0 +1,162 @@
+import os
+import re
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from typing import Callable, Dict, List, Optional, Sequence
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+def normalize_text(text: str) -> str:
+    """
+    Normalizes a chunk of text before hashing it, so that chunks which only differ in unicode form
+    or whitespace share the same cached embedding.
+    """
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFC", text)).strip()
+
+
+def text_hash(text: str) -> bytes:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    """
+    Persistent cache of embeddings in a SQLite file, keyed by the embedding model id and the hash of the
+    normalized chunk text. Re-embedding a corpus then only costs the chunks that changed since the last run.
+    The cache can be shared by threads, e.g. the stages of the streaming pipeline.
+
+    Args:
+        path (str): The path of the SQLite file, created if it does not exist.
+        model_id (str): The id of the embedding model, so that vectors of different models never mix.
+        dtype (str, optional): The type vectors are stored as, "float32" or "float16" to halve the size.
+            Vectors are always returned as float32. Defaults to "float32".
+    """
+    def __init__(self, path: str, model_id: str, dtype: str = "float32"):
+        if dtype not in ("float32", "float16"):
+            raise ValueError("dtype must be float32 or float16.")
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self.path = path
+        self.model_id = model_id
+        self.dtype = np.dtype(dtype)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model_id TEXT NOT NULL, text_hash BLOB NOT NULL, dtype TEXT NOT NULL, vector BLOB NOT NULL, "
+            "PRIMARY KEY (model_id, text_hash)) WITHOUT ROWID"
+        )
+        self._connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def get_many(self, hashes: Sequence[bytes]) -> Dict[bytes, np.ndarray]:
+        """
+        Looks up the embeddings of the given text hashes.
+
+        Args:
+            hashes (Sequence[bytes]): The hashes of the texts, see text_hash.
+
+        Returns:
+            Dict[bytes, np.ndarray]: The float32 embedding of every hash found in the cache.
+        """
+        found = {}
+        with self._lock:
+            # SQLite limits the number of parameters of a query.
+            for i in range(0, len(hashes), 500):
+                batch = list(hashes[i:i + 500])
+                rows = self._connection.execute(
+                    f"SELECT text_hash, dtype, vector FROM embeddings "
+                    f"WHERE model_id = ? AND text_hash IN ({','.join('?' * len(batch))})",
+                    [self.model_id, *batch]
+                )
+                for key, dtype, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=dtype).astype(np.float32)
+        return found
+
+    def put_many(self, hashes: Sequence[bytes], vectors: np.ndarray) -> None:
+        """
+        Stores the embeddings of the given text hashes.
+
+        Args:
+            hashes (Sequence[bytes]): The hashes of the texts, see text_hash.
+            vectors (np.ndarray): The embeddings, one row per hash.
+        """
+        vectors = np.asarray(vectors, dtype=self.dtype)
+        with self._lock:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (model_id, text_hash, dtype, vector) VALUES (?, ?, ?, ?)",
+                [(self.model_id, key, self.dtype.name, vector.tobytes()) for key, vector in zip(hashes, vectors)]
+            )
+            self._connection.commit()
+
+    def embed(
+        self,
+        texts: List[str],
+        embed_fn: Callable[[List[str]], Sequence[Sequence[float]]],
+        batch_size: int = 256
+    ) -> np.ndarray:
+        """
+        Returns the embeddings of the texts, computing only the ones missing from the cache, in batches,
+        and storing them. A text repeated in the input is embedded once.
+
+        Args:
+            texts (List[str]): The texts to embed.
+            embed_fn (Callable): Embeds a list of texts, e.g. SentenceTransformer.encode.
+            batch_size (int, optional): The number of missing texts embedded and stored together. Defaults to 256.
+
+        Returns:
+            np.ndarray: The float32 embeddings, one row per text, in input order.
+        """
+        hashes = [text_hash(text) for text in texts]
+        found = self.get_many(list(set(hashes)))
+
+        missing: Dict[bytes, str] = {}
+        for key, text in zip(hashes, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+        logger.info(f"Embedding cache: {len(texts) - len(missing)} hits, {len(missing)} texts to embed.")
+
+        missing_items = list(missing.items())
+        for i in range(0, len(missing_items), batch_size):
+            batch_hashes, batch_texts = zip(*missing_items[i:i + batch_size])
+            vectors = np.asarray(embed_fn(list(batch_texts)), dtype=np.float32)
+            self.put_many(batch_hashes, vectors)
+            # Keep the vectors as they will be read back from the cache, so a run and a re-run agree.
+            found.update(zip(batch_hashes, vectors.astype(self.dtype).astype(np.float32)))
+
+        if not texts:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack([found[key] for key in hashes])
+
+
+def get_cache_namespace(model_id: str, backend: str) -> str:
+    """
+    Returns the model id the cache stores the vectors of an embedding backend under. The int8 ONNX model
+    encodes different vectors than the torch one, so the two never serve each other's entries.
+    """
+    return f"{model_id}:{backend}"
+
+
+def get_embedding_cache(path: Optional[str], model_id: str, dtype: str = "float32") -> Optional[EmbeddingCache]:
+    """
+    Opens the embedding cache at the given path, or returns None if no path is given.
+    """
+    if not path:
+        return None
+    logger.info(f"Using embedding cache {path} for model {model_id}.")
+    return EmbeddingCache(path, model_id, dtype)
@@ -0,0 +1,215 @@
+import os
+import time
+from typing import List, Optional
+import numpy as np
+from sentence_transformers import SentenceTransformer
+import logging
+
+logger = logging.getLogger(__name__)
+
+def _import_onnxruntime():
+    try:
+        import onnxruntime
+    except ImportError as e:
+        raise ImportError("The ONNX embedding backend needs the onnxruntime and onnx packages: pip install onnxruntime onnx") from e
+    return onnxruntime
+
+
+def _uses_mean_pooling(embedding_model: SentenceTransformer) -> bool:
+    return len(embedding_model) > 1 and getattr(embedding_model[1], "pooling_mode_mean_tokens", False)
+
+
+def _normalizes(embedding_model: SentenceTransformer) -> bool:
+    return any(type(module).__name__ == "Normalize" for module in embedding_model)
+
+
+def export_onnx_model(embedding_model: SentenceTransformer, onnx_dir: str, quantize: bool = True) -> str:
+    """
+    Exports the transformer of a sentence transformer model to ONNX, and optionally quantizes its weights
+    to int8 with dynamic quantization, which is several times faster on CPU at a negligible loss of accuracy.
+    An already exported model is reused.
+
+    Args:
+        embedding_model (SentenceTransformer): The model to export, with mean pooling, e.g. all-MiniLM-L6-v2.
+        onnx_dir (str): The directory to store the ONNX model in.
+        quantize (bool, optional): Whether to quantize the model to int8. Defaults to True.
+
+    Returns:
+        str: The path of the ONNX model to run.
+    """
+    model_path = os.path.join(onnx_dir, "model.onnx")
+    quantized_path = os.path.join(onnx_dir, "model.int8.onnx")
+    target_path = quantized_path if quantize else model_path
+    if os.path.exists(target_path):
+        return target_path
+
+    import torch
+    os.makedirs(onnx_dir, exist_ok=True)
+    if not os.path.exists(model_path):
+        logger.info(f"Exporting the embedding model to {model_path}...")
+        transformer = embedding_model[0].auto_model.eval()
+        dummy = embedding_model.tokenizer(["An example sentence."], return_tensors="pt")
+        input_names = list(dummy.keys())
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+        dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+        with torch.no_grad():
+            torch.onnx.export(
+                transformer,
+                (dict(dummy),),
+                model_path,
+                input_names=input_names,
+                output_names=["last_hidden_state"],
+                dynamic_axes=dynamic_axes,
+                opset_version=14
+            )
+
+    if quantize:
+        _import_onnxruntime()
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+        logger.info(f"Quantizing the embedding model to {quantized_path}...")
+        quantize_dynamic(model_path, quantized_path, weight_type=QuantType.QInt8)
+    return target_path
+
+
+class EmbeddingEngine:
+    """
+    Encodes texts in batches of similar token length, so that little compute is spent on padding, and writes
+    the vectors into one contiguous float32 array. Texts are tokenized once, sorted by length, and cut into
+    batches of batch_size texts. The batches run either through the sentence transformer model itself ("torch"),
+    or through an ONNX Runtime export of it ("onnx"), optionally quantized to int8, which is the fastest on CPU.
+
+    Args:
+        embedding_model (SentenceTransformer): The open source sentence transformer model to use.
+        batch_size (int, optional): The number of texts encoded together. Defaults to 64.
+        num_threads (int, optional): The number of CPU threads used by the backend. Defaults to None, the runtime's default.
+        backend (str, optional): "torch" or "onnx". Defaults to "torch".
+        onnx_dir (str, optional): The directory of the ONNX export, required by the "onnx" backend.
+        quantize (bool, optional): Whether the ONNX model is quantized to int8. Defaults to True.
+    """
+    def __init__(
+        self,
+        embedding_model: SentenceTransformer,
+        batch_size: int = 64,
+        num_threads: Optional[int] = None,
+        backend: str = "torch",
+        onnx_dir: Optional[str] = None,
+        quantize: bool = True
+    ):
+        if backend not in ("torch", "onnx"):
+            raise ValueError("backend must be torch or onnx.")
+        self.embedding_model = embedding_model
+        self.tokenizer = embedding_model.tokenizer
+        self.max_seq_length = embedding_model.max_seq_length
+        self.batch_size = batch_size
+        self.backend = backend
+        self.dimension = embedding_model.get_sentence_embedding_dimension()
+
+        if backend == "onnx":
+            if not onnx_dir:
+                raise ValueError("The onnx backend needs an onnx_dir.")
+            if not _uses_mean_pooling(embedding_model):
+                raise ValueError("The onnx backend only supports sentence transformer models with mean pooling.")
+            self.normalize = _normalizes(embedding_model)
+            ort = _import_onnxruntime()
+            options = ort.SessionOptions()
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if num_threads:
+                options.intra_op_num_threads = num_threads
+            self.session = ort.InferenceSession(
+                export_onnx_model(embedding_model, onnx_dir, quantize),
+                options,
+                providers=["CPUExecutionProvider"]
+            )
+            self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+        elif num_threads:
+            import torch
+            torch.set_num_threads(num_threads)
+
+    def _encode_onnx(self, encodings: List[dict]) -> np.ndarray:
+        length = max(len(encoding["input_ids"]) for encoding in encodings)
+        input_ids = np.full((len(encodings), length), self.tokenizer.pad_token_id or 0, dtype=np.int64)
+        attention_mask = np.zeros((len(encodings), length), dtype=np.int64)
+        token_type_ids = np.zeros((len(encodings), length), dtype=np.int64)
+        for i, encoding in enumerate(encodings):
+            num_tokens = len(encoding["input_ids"])
+            input_ids[i, :num_tokens] = encoding["input_ids"]
+            attention_mask[i, :num_tokens] = 1
+            if "token_type_ids" in encoding:
+                token_type_ids[i, :num_tokens] = encoding["token_type_ids"]
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask, "token_type_ids": token_type_ids}
+        inputs = {name: value for name, value in inputs.items() if name in self.input_names}
+
+        hidden_states = self.session.run(["last_hidden_state"], inputs)[0]
+        # Mean pooling over the tokens that are not padding, as the sentence transformer's Pooling module does.
+        mask = attention_mask[:, :, None].astype(np.float32)
+        embeddings = (hidden_states * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if self.normalize:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings
+
+    def encode(self, texts: List[str]) -> np.ndarray:
+        """
+        Encodes the texts, logging the progress and throughput.
+
+        Args:
+            texts (List[str]): The texts to encode.
+
+        Returns:
+            np.ndarray: A C-contiguous float32 array with one row per text, in input order.
+        """
+        embeddings = np.empty((len(texts), self.dimension), dtype=np.float32)
+        if not texts:
+            return embeddings
+
+        encodings = self.tokenizer(
+            list(texts),
+            truncation=True,
+            max_length=self.max_seq_length,
+            return_attention_mask=True
+        )
+        encodings = [
+            {name: encodings[name][i] for name in encodings.keys()}
+            for i in range(len(texts))
+        ]
+        order = np.argsort([len(encoding["input_ids"]) for encoding in encodings], kind="stable")
+
+        start_time = time.perf_counter()
+        next_report = 0.1
+        for start in range(0, len(texts), self.batch_size):
+            indices = order[start:start + self.batch_size]
+            if self.backend == "onnx":
+                batch_embeddings = self._encode_onnx([encodings[i] for i in indices])
+            else:
+                batch_embeddings = self.embedding_model.encode(
+                    [texts[i] for i in indices],
+                    batch_size=len(indices),
+                    convert_to_numpy=True
+                )
+            embeddings[indices] = batch_embeddings
+
+            done = start + len(indices)
+            if done / len(texts) >= next_report or done == len(texts):
+                elapsed = time.perf_counter() - start_time
+                logger.info(f"Embedded {done}/{len(texts)} texts, {done / max(elapsed, 1e-9):.1f} texts/s.")
+                next_report = done / len(texts) + 0.1
+        return embeddings
+
+    __call__ = encode
+
+
+def get_embedding_engine(
+    embedding_model: SentenceTransformer,
+    model_id: str,
+    backend: str = "torch",
+    batch_size: int = 64,
+    num_threads: Optional[int] = None,
+    onnx_dir: Optional[str] = None
+) -> EmbeddingEngine:
+    """
+    Returns an EmbeddingEngine for the given model. The ONNX export is stored in onnx_dir,
+    by default in a directory of onnx_models named after the model id.
+    """
+    if backend == "onnx" and not onnx_dir:
+        onnx_dir = os.path.join("onnx_models", model_id.replace("/", "__"))
+    logger.info(f"Initializing the {backend} embedding engine with batch size {batch_size}.")
+    return EmbeddingEngine(embedding_model, batch_size, num_threads, backend, onnx_dir)
@@ -1,6 +1,9 @@
 from sentence_transformers import SentenceTransformer
-from typing import List, Dict
+from typing import Iterable, List, Dict, Optional, Set, Union
 from langchain.docstore.document import Document
+from .data_transformer import Chunk
+from .embedding_cache import EmbeddingCache
+from .embedding_engine import EmbeddingEngine
 
 import logging
 
@@ -21,14 +24,112 @@ def get_embedding_model(model_id: str) -> SentenceTransformer:
     return SentenceTransformer(model_id)
 
 
-def generate_embeddings(documents: List[Document], embedding_model: SentenceTransformer):
+def get_embedding_chunk_size(embedding_model: SentenceTransformer) -> int:
+    """
+    Returns the max number of tokens of a chunk that the embedding model reads whole. The model truncates
+    its input at max_seq_length tokens, special tokens included, so longer chunks are never fully embedded.
+
+    Args:
+        embedding_model (SentenceTransformer): The open source sentence transformer model to use.
+
+    Returns:
+        int: The max chunk size, in tokens of the model's tokenizer.
+    """
+    return embedding_model.max_seq_length - embedding_model.tokenizer.num_special_tokens_to_add()
+
+
+def document_to_record(doc: Union[Document, Chunk], embedding) -> Dict:
+    """
+    Builds the record of an embedded document. The text of the parent chunk, if any, is moved out of the
+    metadata to its own field, which is stored but not searched, and the chunk id, if any, to the "id" key.
+    A compact Chunk only refers to its parent and paper records by id, see get_paper_and_parent_records.
+
+    Args:
+        doc (Union[Document, Chunk]): The embedded document.
+        embedding: The embedding of the document.
+
+    Returns:
+        Dict: The record, with "embedding", "text", "metadata" and possibly "parent_text", "parent_id",
+            "doc_type" and "id" keys.
+    """
+    if isinstance(doc, Chunk):
+        record = {
+            "id": doc.chunk_id,
+            "doc_type": "chunk",
+            "embedding": embedding,
+            "text": doc.page_content,
+            "metadata": doc.metadata
+        }
+        if doc.parent_id is not None:
+            record["parent_id"] = doc.parent_id
+        return record
+
+    metadata = dict(doc.metadata)
+    parent_text = metadata.pop("parent_text", None)
+    chunk_id = metadata.pop("chunk_id", None)
+    record = {
+        "embedding": embedding,
+        "text": doc.page_content,
+        "metadata": metadata
+    }
+    if parent_text is not None:
+        record["parent_text"] = parent_text
+    if chunk_id is not None:
+        record["id"] = chunk_id
+    return record
+
+
+def paper_record_id(doi: str) -> str:
+    return f"paper-{doi}"
+
+
+def get_paper_and_parent_records(chunks: Iterable[Chunk], seen_ids: Optional[Set[str]] = None) -> List[Dict]:
+    """
+    Builds the records shared by compact chunks: one per paper, with its full meta data, and one per parent
+    chunk, with its text. They are indexed next to the chunks, without embedding, and joined with the
+    matching chunks by id at query time, so the meta data and parent text are stored once instead of per chunk.
+
+    Args:
+        chunks (Iterable[Chunk]): The chunks.
+        seen_ids (Set[str], optional): The ids of the records already built, e.g. for previous batches of the
+            same papers, which are skipped. Updated with the new ids. Defaults to None.
+
+    Returns:
+        List[Dict]: The records, with "id", "doc_type", "metadata" and possibly "parent_text" keys.
+    """
+    seen_ids = set() if seen_ids is None else seen_ids
+    records = []
+    for chunk in chunks:
+        paper_id = paper_record_id(chunk.paper.get("doi"))
+        if paper_id not in seen_ids:
+            seen_ids.add(paper_id)
+            records.append({"id": paper_id, "doc_type": "paper", "metadata": chunk.paper})
+        if chunk.parent_id is not None and chunk.parent_id not in seen_ids:
+            seen_ids.add(chunk.parent_id)
+            records.append({
+                "id": chunk.parent_id,
+                "doc_type": "parent",
+                "parent_text": chunk.parent_text,
+                "metadata": chunk.metadata
+            })
+    return records
+
+
+def generate_embeddings(
+    documents: List[Union[Document, Chunk]], 
+    embedding_model: Union[SentenceTransformer, EmbeddingEngine], 
+    cache: Optional[EmbeddingCache] = None
+):
     """
     Generate embeddings for a list of documents and return a new list of documents 
     with their respective embeddings, computed using an open source sentence transformer model.
 
     Args:
-        documents (List[Document]): The list of documents to generate embeddings for.
-        embedding_model (SentenceTransformer): The open source sentence transformer model to use.
+        documents (List[Union[Document, Chunk]]): The list of documents to generate embeddings for.
+        embedding_model (Union[SentenceTransformer, EmbeddingEngine]): The open source sentence transformer model to use,
+            or an EmbeddingEngine running it with length-bucketed batches.
+        cache (EmbeddingCache, optional): The cache of already computed embeddings. Only the documents
+            missing from it are encoded. Defaults to None.
 
     Returns:
         List[Dict[str, Union[List[float], str, Dict[str, str]]]]: A list of documents where each document has the embedding included as a key.
@@ -36,17 +137,15 @@ def generate_embeddings(documents: List[Document], embedding_model: SentenceTran
     logger.info("Generating embeddings for documents...")
     texts = [doc.page_content for doc in documents]
     
-    embeddings = embedding_model.encode(texts)
+    if cache is not None:
+        embeddings = cache.embed(texts, embedding_model.encode)
+    else:
+        embeddings = embedding_model.encode(texts)
     
     documents_with_embeddings = []
     
     for doc, embedding in zip(documents, embeddings):
-        doc_with_embedding = {
-            "embedding": embedding,
-            "text": doc.page_content,
-            "metadata": doc.metadata
-        }
-        documents_with_embeddings.append(doc_with_embedding)
+        documents_with_embeddings.append(document_to_record(doc, embedding))
     
     logger.info("Embeddings generated successfully.")
     return documents_with_embeddings
@@ -0,0 +1,500 @@
+import os
+import json
+import shutil
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, Iterable, List, Optional
+import numpy as np
+from .config import INDEX_PROFILES, INDEX_PROFILE
+from .dimensionality_reduction import PCAProjection
+from .vector_quantization import (
+    VectorQuantizer, get_quantizer, load_quantizer, search_codes, fit_sample, evaluate_quantizer, sample_queries
+)
+import logging
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_FILE = "manifest.json"
+VECTORS_FILE = "vectors.f32"
+RECORDS_FILE = "records.sqlite"
+HNSW_FILE = "hnsw.bin"
+CODES_FILE = "codes.bin"
+QUANTIZER_FILE = "quantizer.npz"
+PROJECTION_FILE = "projection.npz"
+
+
+def _import_hnswlib():
+    try:
+        import hnswlib
+    except ImportError as e:
+        raise ImportError("The HNSW index of the local backend needs the hnswlib package: pip install hnswlib") from e
+    return hnswlib
+
+
+def _paper_id(doi) -> str:
+    return f"paper-{doi}"
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def join_hits(hits: List[dict], fetch: Callable[[List[str]], Dict[str, dict]]) -> List[dict]:
+    """
+    Joins the matching chunks with their parent chunk and paper records, which hold the parent text and
+    the full meta data of the paper once instead of per chunk. Chunks from an index without such records
+    keep their own parent_text and metadata.
+
+    Args:
+        hits (List[dict]): The hits, with "id", "score" and "_source" keys.
+        fetch (Callable[[List[str]], Dict[str, dict]]): Returns the sources of the records with the given ids.
+
+    Returns:
+        List[dict]: The hits, with "id", "score", "text", "parent_text" and "metadata" keys.
+    """
+    ids = set()
+    for hit in hits:
+        source = hit["_source"]
+        if source.get("doc_type") == "chunk":
+            ids.add(_paper_id(source["metadata"].get("doi")))
+            if source.get("parent_id"):
+                ids.add(source["parent_id"])
+    joined = fetch(sorted(ids)) if ids else {}
+
+    results = []
+    for hit in hits:
+        source = hit["_source"]
+        parent = joined.get(source.get("parent_id"), {})
+        paper = joined.get(_paper_id(source["metadata"].get("doi")), {})
+        results.append({
+            "id": hit["id"],
+            "score": hit["score"],
+            "text": source["text"],
+            "parent_text": parent.get("parent_text") or source.get("parent_text"),
+            "metadata": paper.get("metadata", source["metadata"])
+        })
+    return results
+
+
+class RetrievalBackend(ABC):
+    """
+    A store of embedded chunks that can be searched by vector, e.g. the OpenSearch index or a local index.
+    The vectors are compared by inner product, and are L2-normalized, so it ranks by cosine similarity.
+    """
+    @abstractmethod
+    def search(self, query_embedding, k: int = 10) -> List[dict]:
+        """
+        Returns the k chunks most similar to the query, joined with their parent chunk and paper.
+
+        Args:
+            query_embedding: The embedding of the query.
+            k (int, optional): The number of chunks to return. Defaults to 10.
+
+        Returns:
+            List[dict]: The chunks, most similar first, with "id", "score", "text", "parent_text"
+                (None if the chunk has no parent) and "metadata" keys.
+        """
+
+    def close(self) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class OpenSearchBackend(RetrievalBackend):
+    """
+    Searches the k-NN index of an OpenSearch domain. With a compressed index, see the compression of
+    INDEX_PROFILES, the candidates can be rescored exactly with the float32 vectors of their _source.
+
+    Args:
+        client (OpenSearch): The OpenSearch client.
+        index_name (str): The name of the index, or of its alias.
+        rescore_oversample (float, optional): The number of candidates rescored per returned chunk.
+            Defaults to None, no rescoring.
+        projection (PCAProjection, optional): The projection the embeddings of the index were reduced with,
+            applied to the queries. Defaults to None.
+    """
+    def __init__(
+        self,
+        client,
+        index_name: str,
+        rescore_oversample: Optional[float] = None,
+        projection: Optional[PCAProjection] = None
+    ):
+        self.client = client
+        self.index_name = index_name
+        self.rescore_oversample = rescore_oversample
+        self.projection = projection
+
+    def _fetch(self, ids: List[str]) -> Dict[str, dict]:
+        response = self.client.mget(index=self.index_name, body={"ids": ids})
+        return {doc["_id"]: doc["_source"] for doc in response["docs"] if doc.get("found")}
+
+    def search(self, query_embedding, k: int = 10) -> List[dict]:
+        if self.projection is not None:
+            query_embedding = self.projection.transform(query_embedding)
+        num_candidates = max(k, int(k * self.rescore_oversample)) if self.rescore_oversample else k
+        fields = ["text", "parent_text", "parent_id", "doc_type", "metadata"]
+        search_body = {
+            "size": num_candidates,
+            "query": {
+                "knn": {
+                    "embedding": {
+                        "vector": [float(value) for value in query_embedding],
+                        "k": num_candidates
+                    }
+                }
+            },
+            "_source": fields + ["embedding"] if self.rescore_oversample else fields
+        }
+        response = self.client.search(index=self.index_name, body=search_body)
+        hits = [
+            {"id": hit["_id"], "score": hit["_score"], "_source": hit["_source"]}
+            for hit in response["hits"]["hits"]
+        ]
+        if self.rescore_oversample and hits:
+            # the vectors of the _source are the float32 ones, L2-normalized when indexed
+            query = _normalize(np.asarray(query_embedding, dtype=np.float32).reshape(-1))
+            vectors = np.array([hit["_source"].pop("embedding") for hit in hits], dtype=np.float32)
+            for hit, score in zip(hits, vectors @ query):
+                hit["score"] = float(score)
+            hits = sorted(hits, key=lambda hit: -hit["score"])[:k]
+        return join_hits(hits, self._fetch)
+
+
+class LocalVectorBackend(RetrievalBackend):
+    """
+    Searches a local index written by LocalIndexWriter, in process, without any network round trip.
+    The vectors are a memory-mapped float32 matrix, searched exactly with one matrix product, or approximately
+    with the HNSW graph of the index, if it has one and use_hnsw is set. A compressed index is searched by the
+    codes of its vectors, loaded in memory, and the best candidates are rescored with the float32 vectors, which
+    are only read from disk for them. The text and meta data of the chunks, parents and papers are in a SQLite
+    file next to the vectors. The queries of an index of reduced embeddings are projected with its projection.
+
+    Args:
+        directory (str): The directory of the index.
+        use_hnsw (bool, optional): Whether to search the HNSW graph instead of all the vectors, if the index has one.
+            Defaults to True.
+        ef_search (int, optional): The size of the candidate list of the HNSW search. Defaults to the index profile's.
+        rescore_oversample (float, optional): The number of candidates of a compressed index rescored per
+            returned chunk. Defaults to the one of the quantizer, see vector_quantization.
+    """
+    def __init__(
+        self,
+        directory: str,
+        use_hnsw: bool = True,
+        ef_search: Optional[int] = None,
+        rescore_oversample: Optional[float] = None
+    ):
+        with open(os.path.join(directory, MANIFEST_FILE)) as f:
+            self.manifest = json.load(f)
+        self.directory = directory
+        self.dimension = self.manifest["dimension"]
+        self.count = self.manifest["count"]
+        if self.count:
+            self.vectors = np.memmap(
+                os.path.join(directory, VECTORS_FILE), dtype=np.float32, mode="r", shape=(self.count, self.dimension)
+            )
+        else:
+            # an empty file can not be memory-mapped
+            self.vectors = np.empty((0, self.dimension), dtype=np.float32)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(os.path.join(directory, RECORDS_FILE), check_same_thread=False)
+
+        self.rescore_oversample = rescore_oversample
+        self.quantizer: Optional[VectorQuantizer] = None
+        if self.manifest.get("compression") and self.count:
+            self.quantizer = load_quantizer(os.path.join(directory, QUANTIZER_FILE))
+            self.codes = np.fromfile(
+                os.path.join(directory, CODES_FILE), dtype=self.manifest["compression"]["dtype"]
+            ).reshape(self.count, -1)
+
+        self.projection = None
+        if self.manifest.get("projection"):
+            self.projection = PCAProjection.load(os.path.join(directory, PROJECTION_FILE))
+
+        self.hnsw = None
+        if use_hnsw and self.manifest.get("hnsw"):
+            hnswlib = _import_hnswlib()
+            self.hnsw = hnswlib.Index(space="ip", dim=self.dimension)
+            self.hnsw.load_index(os.path.join(directory, HNSW_FILE), max_elements=self.count)
+            self.hnsw.set_ef(ef_search or self.manifest["hnsw"]["ef_search"])
+        logger.info(
+            f"Loaded local index {directory} with {self.count} vectors, "
+            f"{'HNSW' if self.hnsw is not None else self.quantizer.name if self.quantizer is not None else 'exact'} search."
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _select(self, column: str, keys: list) -> Dict:
+        found = {}
+        with self._lock:
+            # SQLite limits the number of parameters of a query.
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                rows = self._connection.execute(
+                    f"SELECT {column}, source FROM records WHERE {column} IN ({','.join('?' * len(batch))})", batch
+                )
+                for key, source in rows:
+                    found[key] = json.loads(source)
+        return found
+
+    def search_vectors(self, query_embedding, k: int = 10):
+        """
+        Returns the rows and scores of the k vectors most similar to the query.
+        """
+        query = np.asarray(query_embedding, dtype=np.float32).reshape(-1)
+        if self.projection is not None:
+            query = self.projection.transform(query)
+        query = _normalize(query)
+        k = min(k, self.count)
+        if k == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        if self.hnsw is not None:
+            labels, distances = self.hnsw.knn_query(query, k=k)
+            # the inner product "distance" of hnswlib is 1 - the inner product
+            return labels[0].astype(np.int64), 1 - distances[0]
+        if self.quantizer is not None:
+            return search_codes(self.codes, self.quantizer, query, k, self.vectors, self.rescore_oversample)
+        scores = self.vectors @ query
+        rows = np.argpartition(-scores, k - 1)[:k]
+        rows = rows[np.argsort(-scores[rows], kind="stable")]
+        return rows, scores[rows]
+
+    def search(self, query_embedding, k: int = 10) -> List[dict]:
+        rows, scores = self.search_vectors(query_embedding, k)
+        sources = self._select("row", [int(row) for row in rows])
+        hits = [
+            {"id": sources[int(row)].pop("id"), "score": float(score), "_source": sources[int(row)]}
+            for row, score in zip(rows, scores)
+            if int(row) in sources
+        ]
+        return join_hits(hits, lambda ids: self._select("id", ids))
+
+
+class LocalIndexWriter:
+    """
+    Writes records, as indexed into OpenSearch, to a local index for LocalVectorBackend. Records with an
+    embedding are appended to the vector file, L2-normalized, and every record to the SQLite file. The index
+    is written to a temporary directory and replaces the previous one at once when the writer is closed.
+
+    Args:
+        directory (str): The directory of the index.
+        build_hnsw (bool, optional): Whether to build an HNSW graph of the vectors on close. Defaults to False.
+        hnsw_parameters (dict, optional): m, ef_construction and ef_search of the graph.
+            Defaults to the ones of the index profile.
+        compression (str, optional): "fp16", "int8" or "pq" to also write compressed codes of the vectors on close,
+            which are searched instead of the vectors, see vector_quantization. Defaults to None.
+        projection_path (str, optional): The artifact of the projection the embeddings were reduced with, copied
+            into the index on close so that LocalVectorBackend projects the queries with it. Defaults to None.
+    """
+    def __init__(
+        self,
+        directory: str,
+        build_hnsw: bool = False,
+        hnsw_parameters: Optional[dict] = None,
+        compression: Optional[str] = None,
+        projection_path: Optional[str] = None
+    ):
+        if build_hnsw and compression:
+            # the graph holds float32 vectors, it would take the memory the compression saves
+            raise ValueError("A local index is either searched with an HNSW graph or compressed, not both.")
+        self.directory = directory
+        self.build_hnsw = build_hnsw
+        self.compression = compression
+        self.projection_path = projection_path
+        if compression:
+            get_quantizer(compression)
+        profile = INDEX_PROFILES[INDEX_PROFILE]
+        self.hnsw_parameters = hnsw_parameters or {
+            "m": profile["m"], "ef_construction": profile["ef_construction"], "ef_search": profile["ef_search"]
+        }
+        if build_hnsw:
+            _import_hnswlib()
+
+        self._tmp_directory = directory.rstrip("/\\") + ".tmp"
+        shutil.rmtree(self._tmp_directory, ignore_errors=True)
+        os.makedirs(self._tmp_directory)
+        self._vectors = open(os.path.join(self._tmp_directory, VECTORS_FILE), "wb")
+        self._connection = sqlite3.connect(os.path.join(self._tmp_directory, RECORDS_FILE))
+        self._connection.execute(
+            "CREATE TABLE records (id TEXT PRIMARY KEY, row INTEGER UNIQUE, source TEXT NOT NULL)"
+        )
+        self.dimension = None
+        self.count = 0
+        self.num_records = 0
+
+    def add(self, records: Iterable[dict]) -> int:
+        """
+        Adds records, e.g. a batch of embedded documents, with "embedding", "text", "metadata" and possibly
+        "id", "doc_type", "parent_id" and "parent_text" keys. A record with an id already added replaces it.
+
+        Returns:
+            int: The number of records added.
+        """
+        rows, vectors = [], []
+        for record in records:
+            source = {key: value for key, value in record.items() if key not in ("id", "embedding")}
+            record_id = str(record.get("id", self.num_records))
+            row = None
+            if record.get("embedding") is not None:
+                row = self.count + len(vectors)
+                vectors.append(np.asarray(record["embedding"], dtype=np.float32))
+            rows.append((record_id, row, json.dumps({"id": record_id, **source}, default=str)))
+            self.num_records += 1
+
+        if vectors:
+            vectors = _normalize(np.stack(vectors))
+            if self.dimension is None:
+                self.dimension = vectors.shape[1]
+            elif vectors.shape[1] != self.dimension:
+                raise ValueError(f"Embeddings of dimension {vectors.shape[1]}, {self.dimension} expected.")
+            self._vectors.write(vectors.astype(np.float32).tobytes())
+            self.count += len(vectors)
+        # a replaced chunk keeps its vector row, which then no record points to
+        self._connection.executemany("INSERT OR REPLACE INTO records (id, row, source) VALUES (?, ?, ?)", rows)
+        self._connection.commit()
+        return len(rows)
+
+    def _write_hnsw(self) -> None:
+        hnswlib = _import_hnswlib()
+        vectors = np.memmap(
+            os.path.join(self._tmp_directory, VECTORS_FILE), dtype=np.float32, mode="r",
+            shape=(self.count, self.dimension)
+        )
+        index = hnswlib.Index(space="ip", dim=self.dimension)
+        index.init_index(
+            max_elements=max(self.count, 1),
+            M=self.hnsw_parameters["m"],
+            ef_construction=self.hnsw_parameters["ef_construction"]
+        )
+        for start in range(0, self.count, 10000):
+            block = np.asarray(vectors[start:start + 10000])
+            index.add_items(block, np.arange(start, start + len(block)))
+        index.save_index(os.path.join(self._tmp_directory, HNSW_FILE))
+        logger.info(f"Built the HNSW graph of {self.count} vectors.")
+
+    def _write_codes(self) -> dict:
+        vectors = np.memmap(
+            os.path.join(self._tmp_directory, VECTORS_FILE), dtype=np.float32, mode="r",
+            shape=(self.count, self.dimension)
+        )
+        quantizer = get_quantizer(self.compression).fit(fit_sample(vectors))
+        codes = quantizer.encode(vectors)
+        codes.tofile(os.path.join(self._tmp_directory, CODES_FILE))
+        quantizer.save(os.path.join(self._tmp_directory, QUANTIZER_FILE))
+
+        # the recall of the compressed search against the exact one, on queries sampled near the vectors
+        report = evaluate_quantizer(vectors, quantizer, codes, sample_queries(vectors))
+        logger.info(f"Compressed {self.count} vectors: {report}")
+        return {"type": self.compression, "dtype": codes.dtype.name, "report": report}
+
+    def close(self) -> None:
+        """
+        Writes the manifest and the HNSW graph, and replaces the previous index with the new one.
+        """
+        self._vectors.close()
+        self._connection.close()
+        if self.build_hnsw and self.count:
+            self._write_hnsw()
+        projection = None
+        if self.projection_path:
+            # the projection may be fitted while the records stream in, so it is only read now
+            projection = PCAProjection.load(self.projection_path)
+            shutil.copyfile(self.projection_path, os.path.join(self._tmp_directory, PROJECTION_FILE))
+        manifest = {
+            "dimension": self.dimension or 0,
+            "count": self.count,
+            "records": self.num_records,
+            "hnsw": self.hnsw_parameters if self.build_hnsw and self.count else None,
+            "compression": self._write_codes() if self.compression and self.count else None,
+            "projection": {
+                "input_dimension": projection.input_dimension, "dimension": projection.dimension
+            } if projection is not None else None
+        }
+        with open(os.path.join(self._tmp_directory, MANIFEST_FILE), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.replace(self._tmp_directory, self.directory)
+        logger.info(f"Wrote local index {self.directory} with {self.count} vectors and {self.num_records} records.")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        if exc_type is None:
+            self.close()
+        else:
+            self._vectors.close()
+            self._connection.close()
+            shutil.rmtree(self._tmp_directory, ignore_errors=True)
+
+
+def export_local_index(
+    directory: str,
+    documents_with_embeddings: Iterable[dict],
+    build_hnsw: bool = False,
+    batch_size: int = 1000,
+    compression: Optional[str] = None,
+    projection_path: Optional[str] = None
+) -> int:
+    """
+    Writes the embedded documents of the pipeline to a local index, instead of OpenSearch.
+
+    Args:
+        directory (str): The directory of the index, replaced if it exists.
+        documents_with_embeddings (Iterable[dict]): The records, as given to index_documents. Can be a generator.
+        build_hnsw (bool, optional): Whether to build an HNSW graph for approximate search. Defaults to False.
+        batch_size (int, optional): The number of records written together. Defaults to 1000.
+        compression (str, optional): "fp16", "int8" or "pq" to compress the vectors. Defaults to None.
+        projection_path (str, optional): The artifact of the projection the embeddings were reduced with,
+            saved with the index. Defaults to None.
+
+    Returns:
+        int: The number of records written.
+    """
+    number_of_records = 0
+    with LocalIndexWriter(directory, build_hnsw, compression=compression, projection_path=projection_path) as writer:
+        batch = []
+        for record in documents_with_embeddings:
+            batch.append(record)
+            if len(batch) == batch_size:
+                number_of_records += writer.add(batch)
+                batch = []
+        number_of_records += writer.add(batch)
+    return number_of_records
+
+
+def get_retrieval_backend(
+    backend: str,
+    index_name: Optional[str] = None,
+    client=None,
+    local_index_dir: Optional[str] = None,
+    use_hnsw: bool = True,
+    rescore_oversample: Optional[float] = None,
+    projection: Optional[PCAProjection] = None
+) -> RetrievalBackend:
+    """
+    Returns the retrieval backend of the given kind, "opensearch" with a client and an index name,
+    or "local" with the directory of a local index. rescore_oversample candidates of a compressed index
+    are rescored per result, by default none for OpenSearch and the quantizer's for a local index.
+    The queries of OpenSearch are projected with projection, a local index has its own.
+    """
+    if backend == "opensearch":
+        if client is None or not index_name:
+            raise ValueError("The opensearch backend needs a client and an index_name.")
+        return OpenSearchBackend(client, index_name, rescore_oversample, projection)
+    if backend == "local":
+        if not local_index_dir:
+            raise ValueError("The local backend needs a local_index_dir.")
+        return LocalVectorBackend(local_index_dir, use_hnsw, rescore_oversample=rescore_oversample)
+    raise ValueError("backend must be opensearch or local.")
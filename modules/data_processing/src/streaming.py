@@ -0,0 +1,88 @@
+import queue
+import threading
+from itertools import islice
+from typing import Callable, Iterable, Iterator, List, TypeVar
+import logging
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+_DONE = object()
+
+def batched(iterable: Iterable[T], batch_size: int) -> Iterator[List[T]]:
+    """
+    Groups the items of an iterable into lists of batch_size items, the last one possibly shorter.
+
+    Args:
+        iterable (Iterable[T]): The items to group.
+        batch_size (int): The number of items per batch.
+
+    Yields:
+        List[T]: The batches.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+class _StageError:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def threaded_map(fn: Callable[[T], R], iterable: Iterable[T], max_prefetch: int = 2) -> Iterator[R]:
+    """
+    Applies fn to every item of the iterable in a background thread and yields the results in order.
+    The thread runs ahead of the consumer by at most max_prefetch results, which gives backpressure:
+    a slow consumer pauses the stage, and a slow stage lets the consumer work on what is already done.
+    Chaining calls makes every stage of a pipeline run at the same time on different batches.
+
+    Args:
+        fn (Callable[[T], R]): The stage to apply to every item.
+        iterable (Iterable[T]): The input of the stage, consumed in the background thread too.
+        max_prefetch (int, optional): The max number of results waiting for the consumer. Defaults to 2.
+
+    Yields:
+        R: The results of fn, in input order. An exception raised by the stage is raised here.
+    """
+    results: queue.Queue = queue.Queue(maxsize=max_prefetch)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        # Time out regularly to notice when the consumer stopped early and nobody will take the item.
+        while not stop.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def worker() -> None:
+        try:
+            for item in iterable:
+                if not put(fn(item)):
+                    return
+        except BaseException as e:
+            put(_StageError(e))
+            return
+        put(_DONE)
+
+    thread = threading.Thread(target=worker, daemon=True)
+    thread.start()
+    try:
+        while True:
+            result = results.get()
+            if result is _DONE:
+                return
+            if isinstance(result, _StageError):
+                raise result.error
+            yield result
+    finally:
+        stop.set()
+        thread.join()
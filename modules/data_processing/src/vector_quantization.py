@@ -0,0 +1,369 @@
+import os
+import json
+import time
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional
+import numpy as np
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Rows scored or encoded at a time, so that temporary float32 copies of the codes stay small.
+_BLOCK_SIZE = 65536
+
+
+class VectorQuantizer(ABC):
+    """
+    Compresses vectors into codes that approximate their inner product with a query. The codes are searched
+    for candidates, which are then rescored exactly with the float32 vectors. The coarser the codes, the more
+    candidates are needed for the same recall: oversample is the default number of candidates per result.
+    """
+    name: str
+    oversample: float = 4.0
+
+    def fit(self, vectors: np.ndarray) -> "VectorQuantizer":
+        """
+        Learns the parameters of the quantizer from a sample of the vectors.
+        """
+        return self
+
+    @abstractmethod
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        Returns the codes of the vectors, one row per vector.
+        """
+
+    @abstractmethod
+    def _scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        pass
+
+    def scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        """
+        Returns the approximate inner products of the query with the vectors of the codes.
+        """
+        query = np.asarray(query, dtype=np.float32)
+        return np.concatenate([
+            self._scores(codes[start:start + _BLOCK_SIZE], query)
+            for start in range(0, len(codes), _BLOCK_SIZE)
+        ]) if len(codes) else np.empty(0, dtype=np.float32)
+
+    def get_params(self) -> Dict[str, np.ndarray]:
+        return {}
+
+    def save(self, path: str) -> None:
+        np.savez(path, name=self.name, **self.get_params())
+
+
+class Float16Quantizer(VectorQuantizer):
+    """
+    Stores vectors as float16, half the size of float32, with almost no loss of accuracy.
+    """
+    name = "fp16"
+    oversample = 2.0
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.asarray(vectors).astype(np.float16)
+
+    def _scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        return codes.astype(np.float32) @ query
+
+
+class Int8Quantizer(VectorQuantizer):
+    """
+    Stores every dimension of the vectors as an int8, scaled by the max absolute value of the dimension,
+    a quarter of the size of float32.
+
+    Args:
+        scales (np.ndarray, optional): The scale of every dimension, learned by fit if not given.
+    """
+    name = "int8"
+
+    def __init__(self, scales: Optional[np.ndarray] = None):
+        self.scales = scales
+
+    def fit(self, vectors: np.ndarray) -> "Int8Quantizer":
+        max_values = np.abs(np.asarray(vectors, dtype=np.float32)).max(axis=0)
+        self.scales = np.where(max_values > 0, max_values / 127, 1).astype(np.float32)
+        return self
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        return np.clip(np.rint(np.asarray(vectors, dtype=np.float32) / self.scales), -127, 127).astype(np.int8)
+
+    def _scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        # the scales are folded into the query, so the codes are only converted, not rescaled
+        return codes.astype(np.float32) @ (query * self.scales)
+
+    def get_params(self) -> Dict[str, np.ndarray]:
+        return {"scales": self.scales}
+
+
+class ProductQuantizer(VectorQuantizer):
+    """
+    Cuts the vectors into num_subvectors sub-vectors, and stores each as the index of its nearest centroid
+    among 256 learned with k-means on the sub-vectors, one byte per sub-vector. The inner product with a query
+    is the sum of the inner products of its sub-vectors with the centroids, looked up in a table per query.
+
+    Args:
+        num_subvectors (int, optional): The number of sub-vectors, which must divide the dimension,
+            and the size of a code in bytes. Defaults to one per 8 dimensions.
+        num_iterations (int, optional): The number of k-means iterations. Defaults to 20.
+        seed (int, optional): The seed of the k-means initialization. Defaults to 1.
+        centroids (np.ndarray, optional): The centroids, (num_subvectors, 256, sub-vector size), learned by fit if not given.
+    """
+    name = "pq"
+    oversample = 10.0
+
+    def __init__(
+        self,
+        num_subvectors: Optional[int] = None,
+        num_iterations: int = 20,
+        seed: int = 1,
+        centroids: Optional[np.ndarray] = None
+    ):
+        self.num_subvectors = num_subvectors
+        self.num_iterations = num_iterations
+        self.seed = seed
+        self.centroids = centroids
+
+    def _split(self, vectors: np.ndarray) -> np.ndarray:
+        # (n, dimension) -> (num_subvectors, n, sub-vector size)
+        return np.asarray(vectors, dtype=np.float32).reshape(len(vectors), self.num_subvectors, -1).transpose(1, 0, 2)
+
+    @staticmethod
+    def _nearest(subvectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        distances = (centroids ** 2).sum(axis=1)[None, :] - 2 * subvectors @ centroids.T
+        return distances.argmin(axis=1)
+
+    def fit(self, vectors: np.ndarray) -> "ProductQuantizer":
+        dimension = vectors.shape[1]
+        if self.num_subvectors is None:
+            self.num_subvectors = next(dimension // size for size in (8, 4, 2, 1) if dimension % size == 0)
+        if dimension % self.num_subvectors:
+            raise ValueError(f"num_subvectors must divide the dimension {dimension}.")
+
+        generator = np.random.RandomState(self.seed)
+        num_centroids = min(256, len(vectors))
+        centroids = []
+        for subvectors in self._split(vectors):
+            subspace_centroids = subvectors[generator.choice(len(subvectors), num_centroids, replace=False)].copy()
+            for _ in range(self.num_iterations):
+                assignments = self._nearest(subvectors, subspace_centroids)
+                counts = np.bincount(assignments, minlength=num_centroids)
+                sums = np.stack([
+                    np.bincount(assignments, weights=subvectors[:, d], minlength=num_centroids)
+                    for d in range(subvectors.shape[1])
+                ], axis=1)
+                # an empty cluster keeps its centroid
+                filled = counts > 0
+                subspace_centroids[filled] = (sums[filled] / counts[filled, None]).astype(np.float32)
+            centroids.append(subspace_centroids)
+        self.centroids = np.stack(centroids)
+        return self
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        codes = np.empty((len(vectors), self.num_subvectors), dtype=np.uint8)
+        for start in range(0, len(vectors), _BLOCK_SIZE):
+            for j, subvectors in enumerate(self._split(vectors[start:start + _BLOCK_SIZE])):
+                codes[start:start + len(subvectors), j] = self._nearest(subvectors, self.centroids[j])
+        return codes
+
+    def _scores(self, codes: np.ndarray, query: np.ndarray) -> np.ndarray:
+        # tables[j, c] is the inner product of the j-th sub-vector of the query with the c-th centroid
+        tables = np.einsum("jcd,jd->jc", self.centroids, query.reshape(self.num_subvectors, -1))
+        offsets = np.arange(self.num_subvectors, dtype=np.intp) * tables.shape[1]
+        return np.take(tables.ravel(), codes + offsets).sum(axis=1)
+
+    def get_params(self) -> Dict[str, np.ndarray]:
+        return {"centroids": self.centroids}
+
+
+QUANTIZERS = {
+    quantizer.name: quantizer
+    for quantizer in (Float16Quantizer, Int8Quantizer, ProductQuantizer)
+}
+
+
+def get_quantizer(name: str) -> VectorQuantizer:
+    """
+    Returns a new quantizer, "fp16", "int8" or "pq".
+    """
+    if name not in QUANTIZERS:
+        raise ValueError(f"Unknown vector compression '{name}', expected one of {', '.join(QUANTIZERS)}.")
+    return QUANTIZERS[name]()
+
+
+def load_quantizer(path: str) -> VectorQuantizer:
+    """
+    Loads a quantizer saved with VectorQuantizer.save.
+    """
+    with np.load(path) as data:
+        params = {key: data[key] for key in data.files if key != "name"}
+        name = str(data["name"])
+    if name == "pq":
+        centroids = params["centroids"]
+        return ProductQuantizer(num_subvectors=len(centroids), centroids=centroids)
+    return QUANTIZERS[name](**params)
+
+
+def search_codes(
+    codes: np.ndarray,
+    quantizer: VectorQuantizer,
+    query: np.ndarray,
+    k: int,
+    vectors: Optional[np.ndarray] = None,
+    oversample: Optional[float] = None
+):
+    """
+    Searches compressed vectors: the k * oversample best candidates by their codes are rescored
+    exactly with their float32 vectors, which are only read for the candidates, e.g. from a memory map.
+
+    Args:
+        codes (np.ndarray): The codes of the vectors.
+        quantizer (VectorQuantizer): The quantizer of the codes.
+        query (np.ndarray): The L2-normalized query.
+        k (int): The number of vectors to return.
+        vectors (np.ndarray, optional): The float32 vectors, to rescore with. Defaults to None, no rescoring.
+        oversample (float, optional): The number of candidates rescored per returned vector.
+            Defaults to the quantizer's.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: The rows and scores of the k best vectors, best first.
+    """
+    scores = quantizer.scores(codes, query)
+    oversample = oversample or quantizer.oversample
+    k = min(k, len(scores))
+    num_candidates = min(len(scores), max(k, int(k * oversample))) if vectors is not None else k
+    if num_candidates == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    rows = np.argpartition(-scores, num_candidates - 1)[:num_candidates]
+    if vectors is not None:
+        # sorted rows read the memory map in order
+        rows = np.sort(rows)
+        scores = np.asarray(vectors[rows], dtype=np.float32) @ np.asarray(query, dtype=np.float32)
+    else:
+        scores = scores[rows]
+    order = np.argsort(-scores, kind="stable")[:k]
+    return rows[order], scores[order]
+
+
+def exact_top_k(vectors: np.ndarray, queries: np.ndarray, k: int) -> np.ndarray:
+    """
+    Returns the rows of the k vectors with the highest inner product with every query, best first.
+    """
+    k = min(k, len(vectors))
+    scores = np.concatenate([
+        np.asarray(vectors[start:start + _BLOCK_SIZE], dtype=np.float32) @ queries.T
+        for start in range(0, len(vectors), _BLOCK_SIZE)
+    ]).T
+    rows = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.argsort(-np.take_along_axis(scores, rows, axis=1), axis=1, kind="stable")
+    return np.take_along_axis(rows, order, axis=1)
+
+
+def recall_at_k(exact: List[List], approximate: List[List]) -> float:
+    """
+    Returns the mean fraction of the exact top k results that the approximate search found, for lists of results per query.
+    """
+    if not exact:
+        return 0.0
+    return float(np.mean([
+        len(set(expected) & set(found)) / max(len(expected), 1)
+        for expected, found in zip(exact, approximate)
+    ]))
+
+
+def sample_queries(vectors: np.ndarray, num_queries: int = 100, noise: float = 0.5, seed: int = 1) -> np.ndarray:
+    """
+    Samples queries near the indexed vectors, as stored vectors plus gaussian noise, L2-normalized.
+    Stored vectors themselves would be trivial queries, as they are their own nearest neighbour.
+    """
+    generator = np.random.RandomState(seed)
+    rows = generator.choice(len(vectors), min(num_queries, len(vectors)), replace=False)
+    queries = np.asarray(vectors[np.sort(rows)], dtype=np.float32)
+    queries += generator.normal(scale=noise / np.sqrt(vectors.shape[1]), size=queries.shape).astype(np.float32)
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def evaluate_quantizer(
+    vectors: np.ndarray,
+    quantizer: VectorQuantizer,
+    codes: np.ndarray,
+    queries: np.ndarray,
+    k: int = 10,
+    oversample: Optional[float] = None
+) -> dict:
+    """
+    Measures the recall@k of the compressed vectors against an exact search of the float32 vectors,
+    with and without the exact rescoring of the candidates, and the time per query with rescoring.
+
+    Returns:
+        dict: The compression, code size in bytes, compression ratio, recalls and milliseconds per query.
+    """
+    exact = exact_top_k(vectors, queries, k)
+    approximate = [search_codes(codes, quantizer, query, k)[0] for query in queries]
+    start_time = time.perf_counter()
+    rescored = [search_codes(codes, quantizer, query, k, vectors, oversample)[0] for query in queries]
+    elapsed = time.perf_counter() - start_time
+    oversample = oversample or quantizer.oversample
+    bytes_per_vector = codes.itemsize * (codes.shape[1] if codes.ndim > 1 else 1)
+    return {
+        "compression": quantizer.name,
+        "bytes_per_vector": int(bytes_per_vector),
+        "compression_ratio": round(4 * vectors.shape[1] / bytes_per_vector, 2),
+        f"recall@{k}": round(recall_at_k(exact.tolist(), [rows.tolist() for rows in approximate]), 4),
+        f"recall@{k}_rescored": round(recall_at_k(exact.tolist(), [rows.tolist() for rows in rescored]), 4),
+        "oversample": oversample,
+        "ms_per_query": round(1000 * elapsed / max(len(queries), 1), 3)
+    }
+
+
+def fit_sample(vectors: np.ndarray, sample_size: int = 32768, seed: int = 1) -> np.ndarray:
+    """
+    Returns a random sample of at most sample_size of the vectors, in float32, to fit a quantizer on.
+    """
+    if len(vectors) <= sample_size:
+        return np.asarray(vectors, dtype=np.float32)
+    rows = np.sort(np.random.RandomState(seed).choice(len(vectors), sample_size, replace=False))
+    return np.asarray(vectors[rows], dtype=np.float32)
+
+
+def quantization_report(
+    vectors: np.ndarray,
+    compressions: List[str] = ("fp16", "int8", "pq"),
+    num_queries: int = 100,
+    k: int = 10,
+    oversample: Optional[float] = None,
+    sample_size: int = 32768,
+    path: Optional[str] = None
+) -> List[dict]:
+    """
+    Compares the vector compressions on the given vectors: each quantizer is fitted on a sample of them,
+    encodes them all, and is evaluated with evaluate_quantizer on queries sampled near them.
+
+    Args:
+        vectors (np.ndarray): The L2-normalized float32 vectors, e.g. the memory map of a local index.
+        compressions (List[str], optional): The compressions to compare. Defaults to fp16, int8 and pq.
+        num_queries (int, optional): The number of queries. Defaults to 100.
+        k (int, optional): The k of recall@k. Defaults to 10.
+        oversample (float, optional): The number of candidates rescored per result. Defaults to the quantizer's.
+        sample_size (int, optional): The max number of vectors the quantizers are fitted on. Defaults to 32768.
+        path (str, optional): The JSON file to write the report to. Defaults to None.
+
+    Returns:
+        List[dict]: The evaluation of every compression.
+    """
+    queries = sample_queries(vectors, num_queries)
+    sample = fit_sample(vectors, sample_size)
+    report = []
+    for name in compressions:
+        quantizer = get_quantizer(name).fit(sample)
+        result = evaluate_quantizer(vectors, quantizer, quantizer.encode(vectors), queries, k, oversample)
+        logger.info(f"Vector compression: {result}")
+        report.append(result)
+    if path:
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
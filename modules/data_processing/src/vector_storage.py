@@ -1,10 +1,21 @@
+import os
+import re
+import copy
+import shutil
+import json
+import hashlib
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional
+import numpy as np
 from opensearchpy import OpenSearch, RequestsHttpConnection
 from requests_aws4auth import AWS4Auth
-from opensearchpy.exceptions import NotFoundError
-from opensearchpy.helpers import bulk
+from opensearchpy.helpers import bulk, scan, streaming_bulk
 import logging
 
-from .config import INDEX_BODY
+from .config import INDEX_BODY, INDEX_PROFILES, INDEX_PROFILE, INDEX_VERSIONS_TO_KEEP, DEAD_LETTER_PATH, INDEX_PROJECTION_PATH
+from .dimensionality_reduction import PCAProjection, load_projection
 
 logger = logging.getLogger(__name__)
 
@@ -24,53 +35,461 @@ def opensearch_client(OPENSEARCH_ENDPOINT, AWS_ACCESS_KEY, AWS_SECRET_KEY, AWS_R
 
 
 
-def create_index(client, index_name, embedding_dimension):
-    # Update the embedding dimension in the index body
-    index_body = INDEX_BODY.copy()
+def get_index_body(embedding_dimension, profile=INDEX_PROFILE):
+    """
+    Returns the body of the index for the given embedding dimension, with the shards, replicas, refresh interval,
+    HNSW parameters and compression of the given profile of INDEX_PROFILES. A hash of the settings and mappings
+    is stored in the mapping's _meta, so that a later run can tell whether the existing index still matches.
+    """
+    profile_settings = INDEX_PROFILES[profile]
+    index_body = copy.deepcopy(INDEX_BODY)
+    index_body['settings']['index'].update({
+        'number_of_shards': profile_settings['number_of_shards'],
+        'number_of_replicas': profile_settings['number_of_replicas'],
+        'refresh_interval': profile_settings['refresh_interval']
+    })
+    parameters = {'m': profile_settings['m'], 'ef_construction': profile_settings['ef_construction']}
+    if profile_settings['engine'] == 'faiss':
+        parameters['ef_search'] = profile_settings['ef_search']
+    else:
+        # nmslib reads ef_search from the index settings
+        index_body['settings']['index']['knn.algo_param.ef_search'] = profile_settings['ef_search']
+    compression = profile_settings.get('compression')
+    if compression == 'fp16':
+        if profile_settings['engine'] != 'faiss':
+            raise ValueError("fp16 compression of the index needs the faiss engine.")
+        parameters['encoder'] = {'name': 'sq', 'parameters': {'type': 'fp16'}}
+    elif compression == 'int8':
+        if profile_settings['engine'] != 'lucene':
+            raise ValueError("int8 compression of the index needs the lucene engine.")
+        parameters['encoder'] = {'name': 'sq', 'parameters': {'bits': 7}}
+    elif compression:
+        # product quantization needs a model trained with the k-NN train API before the index is created
+        raise ValueError(f"Unsupported compression of the index '{compression}', expected fp16 or int8.")
     index_body['mappings']['properties']['embedding']['dimension'] = embedding_dimension
-    
-    # Delete the index if it exists
-    try:
-        client.indices.delete(index=index_name)
-    except NotFoundError:
-        logger.info(f"Index '{index_name}' does not exist. Creating a new one.")
-    
-    response = client.indices.create(index=index_name, body=index_body)
+    index_body['mappings']['properties']['embedding']['method'] = {
+        'name': 'hnsw',
+        'engine': profile_settings['engine'],
+        'space_type': profile_settings['space_type'],
+        'parameters': parameters
+    }
+    body_hash = hashlib.sha1(json.dumps(index_body, sort_keys=True).encode('utf-8')).hexdigest()
+    index_body['mappings']['_meta'] = {'body_hash': body_hash}
+    return index_body
+
+
+def index_is_up_to_date(client, index_name, embedding_dimension, profile=INDEX_PROFILE) -> bool:
+    """
+    Tells whether the index, or the index behind the alias, exists and was created with the current
+    settings and mappings, e.g. the same embedding dimension, so that it can be updated in place.
+    """
+    if not client.indices.exists(index=index_name):
+        logger.info(f"Index '{index_name}' does not exist.")
+        return False
+    index_body = get_index_body(embedding_dimension, profile)
+    mapping = client.indices.get_mapping(index=index_name)
+    mappings = next(iter(mapping.values()))['mappings']
+    if mappings.get('_meta', {}).get('body_hash') != index_body['mappings']['_meta']['body_hash']:
+        logger.info(f"The mapping of index '{index_name}' changed.")
+        return False
+    logger.info(f"Index '{index_name}' is up to date, keeping it.")
+    return True
+
+
+def get_index_dimension(client, index_name) -> int:
+    """
+    Returns the dimension of the embeddings of the index, or of the index behind the alias, from its mapping.
+    """
+    mapping = client.indices.get_mapping(index=index_name)
+    mappings = next(iter(mapping.values()))['mappings']
+    return mappings['properties']['embedding']['dimension']
+
+
+def get_live_index(client, alias) -> str:
+    """
+    Returns the name of the index behind the alias, or the alias itself for an index from before indices were versioned.
+    """
+    if client.indices.exists_alias(name=alias):
+        return next(iter(client.indices.get_alias(name=alias)))
+    return alias
+
+
+def get_index_projection_path(index_name) -> str:
+    """
+    Returns the path of the projection artifact of a version of the index, see build_index_version.
+    """
+    return INDEX_PROJECTION_PATH.format(index_name=index_name)
+
+
+def load_index_projection(client, alias) -> Optional[PCAProjection]:
+    """
+    Returns the projection the embeddings of the live index behind the alias were reduced with, so the queries
+    are projected like them, or None if the index does not exist or its embeddings were not reduced.
+    """
+    if not client.indices.exists(index=alias):
+        return None
+    index_name = get_live_index(client, alias)
+    return load_projection(get_index_projection_path(index_name), get_index_dimension(client, index_name))
+
+
+def get_index_versions(client, alias) -> Dict[int, str]:
+    """
+    Returns the versioned indices of an alias, named "{alias}_v{N}", by version number.
+    """
+    pattern = re.compile(rf'^{re.escape(alias)}_v(\d+)$')
+    versions = {}
+    for index_name in client.indices.get(index=f'{alias}_v*'):
+        match = pattern.match(index_name)
+        if match:
+            versions[int(match.group(1))] = index_name
+    return versions
+
+
+def create_versioned_index(client, alias, embedding_dimension, profile=INDEX_PROFILE) -> str:
+    """
+    Creates the next version of the index behind an alias, "{alias}_v{N}", next to the live one,
+    so it can be built in the background while the alias keeps serving searches.
+
+    Returns:
+        str: The name of the new index.
+    """
+    versions = get_index_versions(client, alias)
+    index_name = f'{alias}_v{max(versions, default=0) + 1}'
+    response = client.indices.create(index=index_name, body=get_index_body(embedding_dimension, profile))
     logger.info(f"Created index '{index_name}': {response}")
+    return index_name
+
+
+def validate_index(client, index_name, expected_count, max_missing_ratio=0.01) -> None:
+    """
+    Checks a freshly built index before it goes live: it must hold at least (1 - max_missing_ratio) of the
+    expected documents, and a k-NN query with the vector of one of its documents must find that document.
+
+    Raises:
+        ValueError: If the index is not fit to go live.
+    """
+    client.indices.refresh(index=index_name)
+    count = client.count(index=index_name)['count']
+    if count == 0 or count < expected_count * (1 - max_missing_ratio):
+        raise ValueError(f"Index '{index_name}' holds {count} documents, {expected_count} were expected.")
+
+    # Papers and parent chunks are stored without a vector.
+    sample_query = {'size': 1, 'query': {'exists': {'field': 'embedding'}}, '_source': ['embedding']}
+    samples = client.search(index=index_name, body=sample_query)['hits']['hits']
+    if not samples:
+        raise ValueError(f"Index '{index_name}' holds no document with an embedding.")
+    sample = samples[0]
+    smoke_query = {
+        'size': 10,
+        'query': {'knn': {'embedding': {'vector': sample['_source']['embedding'], 'k': 10}}},
+        '_source': False
+    }
+    hits = client.search(index=index_name, body=smoke_query)['hits']['hits']
+    if sample['_id'] not in {hit['_id'] for hit in hits}:
+        raise ValueError(f"The smoke query on index '{index_name}' did not find the document it was made from.")
+    logger.info(f"Index '{index_name}' is valid, with {count} documents.")
+
+
+def swap_alias(client, alias, index_name) -> None:
+    """
+    Points the alias to the given index, in one atomic update, so searches go from the old index to the new one
+    without a moment without an index. An index named like the alias, from before indices were versioned,
+    is deleted in the same update.
+    """
+    actions = [{'add': {'index': index_name, 'alias': alias}}]
+    if client.indices.exists_alias(name=alias):
+        for old_index in client.indices.get_alias(name=alias):
+            if old_index != index_name:
+                actions.insert(0, {'remove': {'index': old_index, 'alias': alias}})
+    elif client.indices.exists(index=alias):
+        actions.insert(0, {'remove_index': {'index': alias}})
+    client.indices.update_aliases(body={'actions': actions})
+    logger.info(f"Alias '{alias}' now points to index '{index_name}'.")
+
+
+def prune_index_versions(client, alias, keep=INDEX_VERSIONS_TO_KEEP) -> None:
+    """
+    Deletes the old versions of the index behind an alias, except for the latest keep ones before the live one,
+    which are kept for a rollback.
+    """
+    live = set(client.indices.get_alias(name=alias))
+    older = [
+        index_name for version, index_name in sorted(get_index_versions(client, alias).items(), reverse=True)
+        if index_name not in live
+    ]
+    for index_name in older[keep:]:
+        client.indices.delete(index=index_name)
+        if os.path.exists(get_index_projection_path(index_name)):
+            os.remove(get_index_projection_path(index_name))
+        logger.info(f"Deleted old index '{index_name}'.")
+
+
+def build_index_version(
+    client,
+    alias,
+    embedding_dimension,
+    documents_with_embeddings: Iterable[dict],
+    thread_count=4,
+    keep=INDEX_VERSIONS_TO_KEEP,
+    profile=INDEX_PROFILE,
+    projection_path: Optional[str] = None
+) -> int:
+    """
+    Rebuilds the index behind an alias blue/green: the documents are bulk loaded into a new version of the index
+    while the alias keeps serving the live one, and the alias is swapped only once the new version is validated,
+    so searches never see a missing or partial index. The previous versions beyond keep are deleted.
+    If the validation fails, the alias is left as it was and a ValueError is raised.
+    The projection artifact at projection_path, if the embeddings were reduced, is copied to the projection path
+    of the new version before the swap, see load_index_projection, so its queries are projected like its vectors.
 
+    Returns:
+        int: The number of indexed documents.
+    """
+    index_name = create_versioned_index(client, alias, embedding_dimension, profile)
+    number_of_documents = 0
 
+    def counted(documents):
+        nonlocal number_of_documents
+        for doc in documents:
+            number_of_documents += 1
+            yield doc
 
+    with bulk_load_mode(client, index_name, profile):
+        number_of_documents_indexed = index_documents(
+            client, index_name, counted(documents_with_embeddings), thread_count=thread_count
+        )
+    validate_index(client, index_name, number_of_documents)
+    if projection_path:
+        # the projection may be fitted while the documents stream in, so it is only copied now
+        os.makedirs(os.path.dirname(get_index_projection_path(index_name)) or ".", exist_ok=True)
+        shutil.copyfile(projection_path, get_index_projection_path(index_name))
+    swap_alias(client, alias, index_name)
+    prune_index_versions(client, alias, keep)
+    return number_of_documents_indexed
 
-def index_documents(client, index_name, documents_with_embeddings, batch_size=500):
-    total_documents = len(documents_with_embeddings)
-    logger.info(f"Indexing {total_documents} documents into index '{index_name}' with batch size {batch_size}.")
+
+def rollback_alias(client, alias) -> str:
+    """
+    Points the alias back to the version of the index before the live one.
+
+    Returns:
+        str: The name of the index the alias now points to.
+    """
+    live = set(client.indices.get_alias(name=alias))
+    versions = get_index_versions(client, alias)
+    live_versions = [version for version, index_name in versions.items() if index_name in live]
+    previous = [version for version in versions if version < min(live_versions)]
+    if not previous:
+        raise ValueError(f"Alias '{alias}' has no previous index version to roll back to.")
+    index_name = versions[max(previous)]
+    swap_alias(client, alias, index_name)
+    return index_name
+
+
+@contextmanager
+def bulk_load_mode(client, index_name, profile=INDEX_PROFILE):
+    """
+    Prepares an index for a bulk load: refreshes are turned off and replicas removed, so segments are not
+    rebuilt every refresh interval and every document is indexed once instead of once per copy. When the load
+    succeeds, the refresh interval and replicas of the profile are restored, the index is force-merged into one
+    segment, which holds one HNSW graph to search instead of one per segment, and the graphs are loaded into
+    the memory of the k-NN plugin so the first queries are not slow.
+
+        with bulk_load_mode(client, index_name):
+            index_documents(client, index_name, documents)
+    """
+    profile_settings = INDEX_PROFILES[profile]
+    logger.info(f"Turning off refreshes and replicas of index '{index_name}' for the bulk load.")
+    client.indices.put_settings(index=index_name, body={'index': {'refresh_interval': '-1', 'number_of_replicas': 0}})
+    try:
+        yield
+    finally:
+        client.indices.put_settings(index=index_name, body={'index': {
+            'refresh_interval': profile_settings['refresh_interval'],
+            'number_of_replicas': profile_settings['number_of_replicas']
+        }})
+        client.indices.refresh(index=index_name)
+        logger.info(f"Restored refreshes and replicas of index '{index_name}'.")
+
+    logger.info(f"Force merging index '{index_name}'...")
+    client.indices.forcemerge(index=index_name, max_num_segments=1, request_timeout=3600)
+    logger.info(f"Warming up the k-NN graphs of index '{index_name}'...")
+    client.transport.perform_request('GET', f'/_plugins/_knn/warmup/{index_name}', params={'request_timeout': 600})
+
+
+def get_indexed_chunk_ids(client, index_name) -> Dict[str, str]:
+    """
+    Returns the ids of all the documents of the index, with the DOI of their paper.
+    """
+    indexed = {}
+    for hit in scan(client, index=index_name, query={'query': {'match_all': {}}}, _source=['metadata.doi'], size=5000):
+        indexed[hit['_id']] = hit.get('_source', {}).get('metadata', {}).get('doi')
+    logger.info(f"Found {len(indexed)} documents in index '{index_name}'.")
+    return indexed
+
+
+def delete_documents(client, index_name, ids: Iterable[str], batch_size=500) -> int:
+    """
+    Deletes the documents with the given ids from the index.
+
+    Returns:
+        int: The number of deleted documents.
+    """
+    actions = ({'_op_type': 'delete', '_index': index_name, '_id': doc_id} for doc_id in ids)
+    success, failed = bulk(client, actions, chunk_size=batch_size, raise_on_error=False)
+    logger.info(f"Deleted {success} documents from index '{index_name}', {len(failed)} failures.")
+    return success
+
+
+def serialize_source(doc) -> str:
+    """
+    Serializes the source of an embedded document to JSON once, up front, with the vector as a plain list
+    of float32 values in their shortest form, about half the size of the default float64 representation.
+    The bulk helpers send JSON strings as they are, so the size of every action is known before sending it.
+    The vector is L2-normalized, so that the inner product space of the index ranks by cosine similarity.
+    Records without an embedding, e.g. papers and parent chunks, are serialized as they are.
+    """
+    source = {key: value for key, value in doc.items() if key not in ('id', 'embedding')}
+    if doc.get('embedding') is None:
+        return json.dumps(source, default=str)
+
+    embedding = np.asarray(doc['embedding'], dtype=np.float32)
+    norm = np.linalg.norm(embedding)
+    if norm > 0:
+        embedding = embedding / norm
+    vector = '{"embedding": [' + ', '.join(map(str, embedding)) + ']'
+    if not source:
+        return vector + '}'
+    return vector + ', ' + json.dumps(source, default=str)[1:]
+
+
+def _chunk_actions(actions: Iterable[dict], chunk_size: int, max_chunk_bytes: int) -> Iterator[List[dict]]:
+    chunk, chunk_bytes = [], 0
+    for action in actions:
+        # The size of the source plus the action line of the bulk request.
+        action_bytes = len(action['_source'].encode('utf-8')) + len(action['_index']) + len(action['_id']) + 40
+        if chunk and (len(chunk) == chunk_size or chunk_bytes + action_bytes > max_chunk_bytes):
+            yield chunk
+            chunk, chunk_bytes = [], 0
+        chunk.append(action)
+        chunk_bytes += action_bytes
+    if chunk:
+        yield chunk
+
+
+def _index_chunk(client, chunk: List[dict], max_retries: int, initial_backoff: float, max_backoff: float):
+    """
+    Indexes one chunk of actions with streaming_bulk, which retries the documents rejected with a 429
+    with exponential backoff. A failed request, e.g. a connection error, fails every document of the chunk.
+
+    Returns:
+        Tuple[int, List[Tuple[dict, dict]]]: The number of indexed documents, and every failed action with its error.
+    """
+    actions_by_id = {action['_id']: action for action in chunk}
+    success, failed = 0, []
+    for ok, item in streaming_bulk(
+        client,
+        chunk,
+        chunk_size=len(chunk),
+        max_chunk_bytes=2 ** 31,
+        max_retries=max_retries,
+        initial_backoff=initial_backoff,
+        max_backoff=max_backoff,
+        raise_on_error=False,
+        raise_on_exception=False
+    ):
+        if ok:
+            success += 1
+        else:
+            info = next(iter(item.values()))
+            failed.append((actions_by_id.get(str(info.get('_id'))), info))
+    return success, failed
+
+
+def _write_dead_letters(dead_letter_path: str, failed) -> None:
+    directory = os.path.dirname(dead_letter_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(dead_letter_path, 'a') as f:
+        for action, info in failed:
+            f.write(json.dumps({
+                '_index': info.get('_index', action and action['_index']),
+                '_id': info.get('_id'),
+                'status': info.get('status'),
+                'error': str(info.get('error')),
+                '_source': json.loads(action['_source']) if action else None
+            }) + '\n')
+
+
+def index_documents(
+    client,
+    index_name,
+    documents_with_embeddings: Iterable[dict],
+    batch_size=500,
+    start_id=0,
+    thread_count=4,
+    max_chunk_bytes=10 * 1024 * 1024,
+    max_retries=5,
+    initial_backoff=2,
+    max_backoff=60,
+    dead_letter_path=DEAD_LETTER_PATH
+):
+    """
+    Indexes embedded documents with bulk requests sent by thread_count threads. Requests hold at most batch_size
+    documents and max_chunk_bytes bytes, documents rejected with a 429 are retried with exponential backoff, and
+    documents that still fail are appended to a JSONL dead letter file, so that none is lost silently.
+    Documents are read from the input only as fast as they are indexed, so it can be a generator.
+
+    Args:
+        client (OpenSearch): The OpenSearch client.
+        index_name (str): The name of the index.
+        documents_with_embeddings (Iterable[dict]): The embedded documents, e.g. from generate_embeddings.
+        batch_size (int, optional): The max number of documents per bulk request. Defaults to 500.
+        start_id (int, optional): The id of the first document without a chunk id. Defaults to 0.
+        thread_count (int, optional): The number of bulk requests in flight. Defaults to 4.
+        max_chunk_bytes (int, optional): The max size of a bulk request. Defaults to 10MB.
+        max_retries (int, optional): The max number of retries of a document rejected with a 429. Defaults to 5.
+        initial_backoff (float, optional): The wait before the first retry, in seconds, doubled every retry. Defaults to 2.
+        max_backoff (float, optional): The max wait between two retries, in seconds. Defaults to 60.
+        dead_letter_path (str, optional): The JSONL file the failed documents are appended to.
+
+    Returns:
+        int: The number of indexed documents.
+    """
+    logger.info(f"Indexing documents into index '{index_name}' with {thread_count} threads and batch size {batch_size}.")
+
+    actions = (
+        {
+            '_index': index_name,
+            # Deterministic chunk ids make re-indexing a chunk an update, positions are the fallback
+            '_id': str(doc.get('id', start_id + i)),
+            '_source': serialize_source(doc)
+        }
+        for i, doc in enumerate(documents_with_embeddings)
+    )
 
     success_count = 0
     failure_count = 0
+    pending = deque()
+
+    def collect(future):
+        nonlocal success_count, failure_count
+        success, failed = future.result()
+        success_count += success
+        failure_count += len(failed)
+        if failed:
+            _write_dead_letters(dead_letter_path, failed)
+            logger.error(f"{len(failed)} documents failed to index, written to {dead_letter_path}.")
+        logger.info(f"Indexed {success_count} documents so far, {failure_count} failures.")
 
-    for i in range(0, total_documents, batch_size):
-        batch = documents_with_embeddings[i:i + batch_size]
-        actions = []
-        for j, doc in enumerate(batch):
-            action = {
-                '_index': index_name,
-                '_id': i + j,  # Ensure unique IDs across batches
-                '_source': {
-                    'embedding': doc['embedding'],
-                    'text': doc['text'],
-                    'metadata': doc['metadata']
-                }
-            }
-            actions.append(action)
-
-        try:
-            success, failed = bulk(client, actions)
-            success_count += success
-            failure_count += len(failed)
-            logger.info(f"Indexed batch {i // batch_size + 1}: {success} successes, {len(failed)} failures.")
-        except Exception as e:
-            logger.error(f"Error indexing batch {i // batch_size + 1}: {e}")
-            # Optionally, implement retry logic here
+    with ThreadPoolExecutor(max_workers=thread_count) as executor:
+        for chunk in _chunk_actions(actions, batch_size, max_chunk_bytes):
+            pending.append(executor.submit(_index_chunk, client, chunk, max_retries, initial_backoff, max_backoff))
+            # Bound the chunks in flight, so a generator input is not read ahead of the cluster.
+            while len(pending) >= 2 * thread_count:
+                collect(pending.popleft())
+        while pending:
+            collect(pending.popleft())
 
     logger.info(f"Finished indexing. Total successes: {success_count}, Total failures: {failure_count}.")
-    return success_count
\ No newline at end of file
+    return success_count
@@ -0,0 +1,146 @@
+import io
+import json
+import threading
+import numpy as np
+from botocore.exceptions import ClientError
+
+from ..src.bedrock_embedding import AdaptiveConcurrency, BedrockEmbeddingExecutor, generate_bedrock_embeddings
+from ..src.data_transformer import Chunk
+from ..src.embedding_cache import EmbeddingCache
+
+
+class StubBedrockClient:
+    """
+    Stands in for bedrock-runtime: embeds a text as [len(text), position in the input], throttles the first
+    num_throttles calls, fails every call after the first fail_after ones, as if the run were interrupted,
+    and records the texts it embedded, the number of calls in flight and the concurrency limit it saw.
+    """
+    def __init__(self, texts, num_throttles=0, executor=None, fail_after=None):
+        self.positions = {text: i for i, text in enumerate(texts)}
+        self.num_throttles = num_throttles
+        self.fail_after = fail_after
+        self.executor = executor
+        self.calls = 0
+        self.embedded_texts = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.limits = []
+        self._lock = threading.Lock()
+
+    def invoke_model(self, modelId, body, accept, contentType):
+        text = json.loads(body)["inputText"]
+        with self._lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            if self.executor is not None:
+                self.limits.append(self.executor.concurrency.limit)
+            throttled = self.calls <= self.num_throttles
+            failed = self.fail_after is not None and self.calls > self.fail_after
+        try:
+            if throttled:
+                raise ClientError({"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}}, "InvokeModel")
+            if failed:
+                raise ConnectionError("Connection lost")
+            with self._lock:
+                self.embedded_texts.append(text)
+            embedding = [float(len(text)), float(self.positions.get(text, -1))]
+            return {"body": io.BytesIO(json.dumps({"embedding": embedding}).encode("utf-8"))}
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+def get_executor(client, **kwargs):
+    executor = BedrockEmbeddingExecutor(client, backoff_factor=0.0, **kwargs)
+    client.executor = executor
+    return executor
+
+
+def test_throttling_halves_and_successes_grow_concurrency():
+    concurrency = AdaptiveConcurrency(initial=8, maximum=16, cooldown=0.0)
+    concurrency.acquire()
+    concurrency.release(throttled=True)
+    assert concurrency.limit == 4
+
+    for _ in range(20):
+        concurrency.acquire()
+        concurrency.release()
+    assert 4 < concurrency.limit <= 16
+
+
+def test_throttling_within_cooldown_counts_once():
+    concurrency = AdaptiveConcurrency(initial=8, maximum=16, cooldown=60.0)
+    for _ in range(3):
+        concurrency.acquire()
+        concurrency.release(throttled=True)
+    assert concurrency.limit == 4
+
+
+def test_executor_adapts_to_throttling_and_keeps_input_order():
+    texts = [f"text {'x' * i}" for i in range(64)]
+    client = StubBedrockClient(texts, num_throttles=3)
+    executor = get_executor(client, max_concurrency=8, initial_concurrency=8)
+
+    embeddings = executor.embed_documents(texts)
+
+    assert embeddings == [[float(len(text)), float(i)] for i, text in enumerate(texts)]
+    assert client.calls == len(texts) + 3
+    assert min(client.limits) < 8
+    assert executor.concurrency.limit > min(client.limits)
+    assert client.max_in_flight <= 8
+
+
+def test_executor_raises_other_errors():
+    class FailingClient(StubBedrockClient):
+        def invoke_model(self, **kwargs):
+            raise ClientError({"Error": {"Code": "ValidationException", "Message": "Bad input"}}, "InvokeModel")
+
+    executor = get_executor(FailingClient(["a"]))
+    try:
+        executor.embed_documents(["a"])
+    except ClientError as e:
+        assert e.response["Error"]["Code"] == "ValidationException"
+    else:
+        raise AssertionError("ClientError not raised")
+    assert executor.concurrency.in_flight == 0
+
+
+def get_chunks(texts):
+    paper = {"doi": "10.1000/test"}
+    parent_text = " ".join(texts)
+    chunks, start = [], 0
+    for i, text in enumerate(texts):
+        chunks.append(Chunk(paper, "Results", None, parent_text, start, start + len(text), f"chunk-{i}"))
+        start += len(text) + 1
+    return chunks
+
+
+def test_generate_bedrock_embeddings_resumes_from_the_cache(tmp_path):
+    texts = [f"chunk {i}" for i in range(10)]
+    chunks = get_chunks(texts)
+    cache_path = str(tmp_path / "embeddings.sqlite")
+
+    # the run is interrupted in its second checkpoint, after the first one was stored
+    client = StubBedrockClient(texts, fail_after=6)
+    with EmbeddingCache(cache_path, "amazon.titan-embed-text-v1:bedrock") as cache:
+        try:
+            generate_bedrock_embeddings(chunks, get_executor(client, max_concurrency=2), cache, batch_size=4)
+        except ConnectionError:
+            pass
+        else:
+            raise AssertionError("ConnectionError not raised")
+
+    # the resumed run only sends the texts that were not stored
+    client = StubBedrockClient(texts)
+    with EmbeddingCache(cache_path, "amazon.titan-embed-text-v1:bedrock") as cache:
+        records = generate_bedrock_embeddings(chunks, get_executor(client), cache, batch_size=4)
+    assert sorted(client.embedded_texts) == sorted(texts[4:])
+    assert [record["id"] for record in records] == [chunk.chunk_id for chunk in chunks]
+    assert [record["text"] for record in records] == texts
+    assert np.allclose([record["embedding"][1] for record in records], range(10))
+
+    client = StubBedrockClient(texts)
+    with EmbeddingCache(cache_path, "amazon.titan-embed-text-v1:bedrock") as cache:
+        generate_bedrock_embeddings(chunks, get_executor(client), cache)
+    assert client.calls == 0
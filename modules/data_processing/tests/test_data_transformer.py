@@ -0,0 +1,139 @@
+import re
+import pytest
+
+from ..src.data_transformer import (
+    PARAGRAPH_BOUNDARY, SENTENCE_BOUNDARY, WORD_BOUNDARY, _boundary_score, iter_chunk_spans, split_offsets_into_windows
+)
+
+
+def word_offsets(text):
+    # one token per word, the whitespace in the gaps, like a word level fast tokenizer
+    return [match.span() for match in re.finditer(r"\S+", text)]
+
+
+def subword_offsets(text):
+    # words of more than 3 characters are cut into two tokens, the second one without whitespace before it
+    offsets = []
+    for start, end in word_offsets(text):
+        if end - start > 3:
+            offsets += [(start, start + 2), (start + 2, end)]
+        else:
+            offsets.append((start, end))
+    return offsets
+
+
+class FakeTokenizer:
+    """
+    Stands in for a fast tokenizer, with the offset mapping of word_offsets or subword_offsets.
+    """
+    is_fast = True
+
+    def __init__(self, offsets=word_offsets):
+        self.offsets = offsets
+        self.calls = 0
+
+    def __call__(self, texts, add_special_tokens, return_offsets_mapping, return_attention_mask):
+        self.calls += 1
+        return {"offset_mapping": [self.offsets(text) for text in texts]}
+
+
+def words(n, start=0):
+    return " ".join(f"word{i}" for i in range(start, start + n))
+
+
+def test_boundary_scores():
+    text = "One two. Three\nfour\n\nfive"
+    offsets = word_offsets(text)
+
+    assert _boundary_score(text, offsets, 0) == 0
+    assert _boundary_score(text, offsets, 1) == WORD_BOUNDARY
+    assert _boundary_score(text, offsets, 2) == SENTENCE_BOUNDARY
+    assert _boundary_score(text, offsets, 3) > SENTENCE_BOUNDARY
+    assert _boundary_score(text, offsets, 4) == PARAGRAPH_BOUNDARY
+    # the second half of a word cut in two tokens
+    assert _boundary_score("Three", [(0, 2), (2, 5)], 1) == 0
+
+
+def test_windows_stay_within_chunk_size_and_cover_every_token():
+    text = words(237)
+    offsets = word_offsets(text)
+
+    windows = split_offsets_into_windows(text, offsets, chunk_size=20, chunk_overlap=5)
+
+    assert windows[0][0] == 0
+    assert windows[-1][1] == len(offsets)
+    assert all(0 < end - start <= 20 for start, end in windows)
+    for (start, end), (next_start, next_end) in zip(windows, windows[1:]):
+        assert start < next_start < end < next_end
+
+
+def test_consecutive_windows_overlap_by_chunk_overlap():
+    text = words(200)
+
+    windows = split_offsets_into_windows(text, word_offsets(text), chunk_size=20, chunk_overlap=5)
+
+    # every word starts on a word boundary, so the overlap is exact
+    assert all(end - next_start == 5 for (_, end), (next_start, _) in zip(windows, windows[1:]))
+    assert split_offsets_into_windows(text, word_offsets(text), chunk_size=20, chunk_overlap=0)[1][0] == 20
+
+
+def test_overlap_must_be_lower_than_chunk_size():
+    with pytest.raises(ValueError):
+        split_offsets_into_windows("a b", [(0, 1), (2, 3)], chunk_size=2, chunk_overlap=2)
+
+
+def test_windows_end_at_the_best_boundary_in_the_second_half():
+    # a sentence ends before word 17 and a paragraph before word 14, within the last 10 of the first 20 words
+    text = words(14) + "\n\n" + words(3, 14) + ". " + words(20, 17)
+    offsets = word_offsets(text)
+    assert split_offsets_into_windows(text, offsets, chunk_size=20, chunk_overlap=0)[0] == (0, 14)
+
+    text = words(17) + ". " + words(20, 17)
+    assert split_offsets_into_windows(text, word_offsets(text), chunk_size=20, chunk_overlap=0)[0] == (0, 17)
+
+    # a paragraph in the first half would make too small a window, the window ends at the last word boundary
+    text = words(4) + "\n\n" + words(30, 4)
+    assert split_offsets_into_windows(text, word_offsets(text), chunk_size=20, chunk_overlap=0)[0] == (0, 20)
+
+
+def test_windows_are_not_cut_mid_word():
+    text = words(100)
+    offsets = subword_offsets(text)
+
+    windows = split_offsets_into_windows(text, offsets, chunk_size=15, chunk_overlap=4)
+
+    assert all(end - start <= 15 for start, end in windows)
+    for start, end in windows:
+        assert start == 0 or _boundary_score(text, offsets, start)
+        assert end == len(offsets) or _boundary_score(text, offsets, end)
+
+
+@pytest.mark.parametrize("offsets", [word_offsets, subword_offsets])
+def test_chunk_spans_are_exact_character_spans(offsets):
+    texts = ["  " + words(90) + "\n\n" + words(40, 90) + ".  ", "", words(3), "Short text."]
+    tokenizer = FakeTokenizer(offsets)
+
+    spans = list(iter_chunk_spans(texts, tokenizer, chunk_size=16, chunk_overlap=4, batch_size=2))
+
+    assert tokenizer.calls == 2
+    assert sorted({i for i, _, _ in spans}) == [0, 2, 3]
+    for i, start, end in spans:
+        chunk = texts[i][start:end]
+        assert chunk == chunk.strip() and chunk
+        # a span starts and ends on token boundaries
+        token_spans = offsets(texts[i])
+        assert start in {token_start for token_start, _ in token_spans}
+        assert end in {token_end for _, token_end in token_spans}
+        assert len([span for span in token_spans if start <= span[0] and span[1] <= end]) <= 16
+    # together the chunks cover every token of the texts
+    for i, text in enumerate(texts):
+        for token_start, token_end in offsets(text):
+            assert any(j == i and start <= token_start and token_end <= end for j, start, end in spans)
+    assert [texts[i][start:end] for i, start, end in spans if i > 1] == [words(3), "Short text."]
+
+
+def test_chunk_spans_need_a_fast_tokenizer():
+    tokenizer = FakeTokenizer()
+    tokenizer.is_fast = False
+    with pytest.raises(ValueError):
+        list(iter_chunk_spans(["text"], tokenizer, chunk_size=16, chunk_overlap=4))
@@ -0,0 +1,47 @@
+import os
+import numpy as np
+import pytest
+
+from ..src.retrieval_backends import LocalVectorBackend, export_local_index
+from ..src.vector_quantization import exact_top_k, sample_queries
+
+
+def get_records(n=500, dimension=32, seed=0):
+    vectors = np.random.RandomState(seed).normal(size=(n, dimension)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    paper = {"id": "paper-10.1000/test", "doc_type": "paper", "metadata": {"doi": "10.1000/test", "title": "A paper"}}
+    parent = {"id": "parent-0", "doc_type": "parent", "metadata": {"doi": "10.1000/test"}, "parent_text": "The parent."}
+    chunks = [
+        {
+            "id": f"chunk-{i}",
+            "doc_type": "chunk",
+            "embedding": vector.tolist(),
+            "text": f"chunk {i}",
+            "parent_id": "parent-0",
+            "metadata": {"doi": "10.1000/test", "section": "Results"}
+        }
+        for i, vector in enumerate(vectors)
+    ]
+    return [paper, parent] + chunks, vectors
+
+
+@pytest.mark.parametrize("compression", [None, "fp16", "int8", "pq"])
+def test_local_index_round_trip(compression, tmp_path):
+    records, vectors = get_records()
+    directory = str(tmp_path / "index")
+
+    assert export_local_index(directory, iter(records), compression=compression, batch_size=64) == len(records)
+    assert not os.path.exists(directory + ".tmp")
+
+    queries = sample_queries(vectors, num_queries=10)
+    exact = exact_top_k(vectors, queries, 5)
+    with LocalVectorBackend(directory) as backend:
+        assert backend.count == len(vectors)
+        assert (backend.quantizer.name if backend.quantizer is not None else None) == compression
+        for query, expected in zip(queries, exact):
+            # the candidates of every query are rescored with the float32 vectors
+            hits = backend.search(query, k=5)
+            assert [hit["id"] for hit in hits] == [f"chunk-{row}" for row in expected]
+            assert np.allclose([hit["score"] for hit in hits], vectors[expected] @ query, atol=1e-5)
+            assert all(hit["parent_text"] == "The parent." for hit in hits)
+            assert all(hit["metadata"]["title"] == "A paper" for hit in hits)
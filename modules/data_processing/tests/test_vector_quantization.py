@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from ..src.vector_quantization import (
+    evaluate_quantizer, exact_top_k, get_quantizer, load_quantizer, sample_queries, search_codes
+)
+
+
+def get_vectors(n=3000, dimension=64, seed=0):
+    vectors = np.random.RandomState(seed).normal(size=(n, dimension)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+@pytest.fixture(scope="module")
+def vectors():
+    return get_vectors()
+
+
+@pytest.mark.parametrize("name", ["fp16", "int8", "pq"])
+def test_saved_quantizer_encodes_and_scores_the_same(name, vectors, tmp_path):
+    quantizer = get_quantizer(name).fit(vectors)
+    path = str(tmp_path / "quantizer.npz")
+    quantizer.save(path)
+
+    loaded = load_quantizer(path)
+
+    assert type(loaded) is type(quantizer)
+    codes = quantizer.encode(vectors)
+    assert np.array_equal(loaded.encode(vectors), codes)
+    assert np.allclose(loaded.scores(codes, vectors[0]), quantizer.scores(codes, vectors[0]))
+
+
+@pytest.mark.parametrize("name", ["fp16", "int8", "pq"])
+def test_rescored_search_matches_the_exact_search_on_a_toy_matrix(name):
+    vectors = get_vectors(n=300, dimension=16)
+    quantizer = get_quantizer(name).fit(vectors)
+    codes = quantizer.encode(vectors)
+    queries = sample_queries(vectors, num_queries=20)
+
+    exact = exact_top_k(vectors, queries, 5)
+
+    for query, expected in zip(queries, exact):
+        # enough candidates to rescore all of them
+        rows, scores = search_codes(codes, quantizer, query, 5, vectors, oversample=len(vectors))
+        assert rows.tolist() == expected.tolist()
+        assert np.allclose(scores, vectors[rows] @ query)
+
+
+def test_search_codes_without_rescoring_returns_k_rows_best_first(vectors):
+    quantizer = get_quantizer("fp16").fit(vectors)
+    codes = quantizer.encode(vectors)
+
+    rows, scores = search_codes(codes, quantizer, vectors[0], 10)
+
+    assert len(rows) == 10
+    assert rows[0] == 0
+    assert np.all(np.diff(scores) <= 0)
+
+
+@pytest.mark.parametrize("name, min_recall", [("fp16", 1.0), ("int8", 1.0), ("pq", 0.9)])
+def test_rescored_recall_with_the_default_oversample(name, min_recall, vectors):
+    # random vectors are the worst case of product quantization, which only reaches about 0.93 on them
+    quantizer = get_quantizer(name).fit(vectors)
+
+    report = evaluate_quantizer(vectors, quantizer, quantizer.encode(vectors), sample_queries(vectors))
+
+    assert report["recall@10_rescored"] >= min_recall
+    assert report["recall@10_rescored"] >= report["recall@10"]
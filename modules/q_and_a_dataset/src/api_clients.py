@@ -3,6 +3,9 @@ from dotenv import load_dotenv, find_dotenv
 from openai import OpenAI
 from opensearchpy import OpenSearch, RequestsHttpConnection
 from requests_aws4auth import AWS4Auth
+from ...data_processing.src.retrieval_backends import get_retrieval_backend
+from ...data_processing.src.vector_storage import load_index_projection
+from .config import INDEX_NAME
 
 load_dotenv(find_dotenv())
 
@@ -11,6 +14,9 @@ AWS_SECRET_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
 AWS_REGION = os.getenv("AWS_REGION")
 OPENSEARCH_ENDPOINT = os.getenv("OPENSEARCH_ENDPOINT")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "opensearch")
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "local_index")
+RESCORE_OVERSAMPLE = float(os.getenv("RESCORE_OVERSAMPLE", 0)) or None
 
 def get_openai_client(open_api_key=OPENAI_API_KEY):
     gpt_client = OpenAI(api_key=open_api_key)
@@ -32,3 +38,19 @@ def get_opensearch_client(
     )
     return client
 
+def get_search_backend(
+    backend=RETRIEVAL_BACKEND,
+    local_index_dir=LOCAL_INDEX_DIR,
+    index_name=INDEX_NAME,
+    rescore_oversample=RESCORE_OVERSAMPLE
+):
+    if backend == "local":
+        return get_retrieval_backend("local", local_index_dir=local_index_dir, rescore_oversample=rescore_oversample)
+    client = get_opensearch_client()
+    return get_retrieval_backend(
+        "opensearch",
+        index_name=index_name,
+        client=client,
+        rescore_oversample=rescore_oversample,
+        projection=load_index_projection(client, index_name)
+    )
@@ -2,7 +2,7 @@ import json
 from tqdm import tqdm
 from pathlib import Path
 from .examples import EXAMPLES
-from .api_clients import get_openai_client, get_opensearch_client
+from .api_clients import get_openai_client, get_search_backend
 from .retrieval import get_query_embedding, get_context
 from .gpt import build_prompt, get_gpt_response
 from .config import DATA_PATH
@@ -16,8 +16,8 @@ def run(EXAMPLES, DATA_PATH):
     logger.info("Setting up OpenAI API client...")
     gpt_client = get_openai_client()
     
-    logger.info("Setting up OpenSearch client...")
-    opensearch_client = get_opensearch_client()
+    logger.info("Setting up the retrieval backend...")
+    search_backend = get_search_backend()
     
     #logger.info("Slicing EXAMPLES to 40 for now to save time as we are testing things out. Will change this later.")
     #EXAMPLES = EXAMPLES[:15]
@@ -26,7 +26,7 @@ def run(EXAMPLES, DATA_PATH):
     for example in tqdm(EXAMPLES):
         query_text = example['about_me'] + " " + example['question']
         query_embedding = get_query_embedding(query_text)
-        context = get_context(opensearch_client, query_embedding)
+        context = get_context(search_backend, query_embedding)
         prompt = build_prompt(query_text, context)
         response = get_gpt_response(gpt_client, prompt)
 
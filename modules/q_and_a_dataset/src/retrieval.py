@@ -1,28 +1,22 @@
 from sentence_transformers import SentenceTransformer
 from .config import INDEX_NAME, EMBEDDING_MODEL_ID
+from ...data_processing.src.retrieval_backends import RetrievalBackend, OpenSearchBackend
 
 def get_query_embedding(query_text: str, EMBEDDING_MODEL_ID: str = EMBEDDING_MODEL_ID) -> list:
     model = SentenceTransformer(EMBEDDING_MODEL_ID)
     return model.encode(query_text)
 
 def get_context(client, query_embedding: list, size: int = 3, index_name: str = INDEX_NAME) -> str:    
-    search_body = {
-        "size": size,
-        "query": {
-            "knn": {
-                "embedding": {
-                    "vector": query_embedding,
-                    "k": 5
-                }
-            }
-        },
-        "_source": ["text", "metadata"]
-    }
-
-    response = client.search(index=index_name, body=search_body)
+    # an OpenSearch client searches the index_name index, a RetrievalBackend e.g. a local index
+    backend = client if isinstance(client, RetrievalBackend) else OpenSearchBackend(client, index_name)
+    results = backend.search(query_embedding, k=5)
     
-    context = " ".join([hit['_source']['text'] for hit in response['hits']['hits'][:size]])
+    # the context is made of the parent chunks of the matching chunks, when the index has them
+    texts = []
+    for result in results:
+        text = result['parent_text'] or result['text']
+        if text not in texts:
+            texts.append(text)
+    context = " ".join(texts[:size])
     
     return context
-
-